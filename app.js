@@ -4,9 +4,13 @@ const EXPRESS = require('express');
 const MONGOOSE = require('mongoose');
 //post request handling
 const BODYPARSER = require('body-parser');
-//for python script integration
+//for the subnet calculator scripts and serving pages
 const { exec } = require('child_process')
 const PATH = require('path');
+//decodes streamed utf8 without splitting multi-byte characters across chunks
+const { StringDecoder } = require('string_decoder');
+//python rag query server (scripts/rag_server.py)
+const RAG_SERVER_URL = process.env.RAG_SERVER_URL || 'http://127.0.0.1:5005';
 
 
 //initialise the express application on port 3000
@@ -176,28 +180,65 @@ APP.post('/chat', async(req, res) => {
 	const accessibleCourses = req.session.user.courses; //courses user can access
 
 	try {
-	 
-		const coursesBase64 = Buffer.from(JSON.stringify(accessibleCourses)).toString('base64');
-		//console.log("Courses Base64:", coursesBase64);
+		//stream the answer from the long running python rag server (scripts/rag_server.py)
+		const RAGRESPONSE = await axios.post(`${RAG_SERVER_URL}/query/stream`, {
+			query: USERMESSAGE,
+			courses: accessibleCourses,
+			token: MOODLETOKEN,
+			user_id: USERID, //used for the per user rate limit
+			role: USERROLE //teachers are queued ahead of students when busy
+		}, { responseType: 'stream' });
+
+		//frames are newline delimited json, pass them straight to the browser as they arrive
+		res.setHeader('Content-Type', 'application/x-ndjson');
+		res.setHeader('Cache-Control', 'no-cache');
+
+		const DECODER = new StringDecoder('utf8');
+		let buffered = '';
+		let botResponse = '';
+
+		//keep a copy of the full answer for the conversation log, a malformed frame is skipped rather than thrown
+		const collectFrames = (lines) => {
+			lines.filter(line => line.trim()).forEach(line => {
+				try {
+					const FRAME = JSON.parse(line);
+					if (FRAME.type === 'token' || FRAME.type === 'sources') {
+						botResponse += FRAME.content;
+					}
+				} catch (parseErr) {
+					console.error('Skipping malformed frame from RAG server:', parseErr.message);
+				}
+			});
+		};
 
-		exec(`python3 ${PATH.join(__dirname, 'scripts', 'langchain_response.py')} "${USERMESSAGE}" "${accessibleCourses}" "${MOODLETOKEN}"`, async (error, stdout, stderr) => {
-			if (error) {
-				console.error(`Error executing Python script: ${error}`);
-				return res.status(500).json({ error: 'Internal Server Error' });
-			}
-		
-			if (stderr) {
-				console.error(`stderr: ${stderr}`);
+		RAGRESPONSE.data.on('data', (chunk) => {
+			res.write(chunk);
+
+			buffered += DECODER.write(chunk);
+			const LINES = buffered.split('\n');
+			buffered = LINES.pop();
+			collectFrames(LINES);
+		});
+
+		//stop generating if the browser goes away before the answer is finished
+		//(res 'close' rather than req 'close', which newer node versions emit once the request body is read)
+		res.on('close', () => {
+			if (!res.writableFinished) {
+				RAGRESPONSE.data.destroy();
 			}
-		
-			const BOTRESPONSE = stdout.trim();
+		});
+
+		RAGRESPONSE.data.on('end', async () => {
+			res.end();
+			collectFrames([buffered + DECODER.end()]);
+
+			const BOTRESPONSE = botResponse.trim();
 			//console.log("BOTRESPONSE:", BOTRESPONSE); // debug logging
-		
 			if (!BOTRESPONSE) {
-				return res.status(500).json({ error: 'Bot response is empty' });
+				return console.error('Bot response is empty');
 			}
-		
-			// save to mongodb and send back the response
+
+			// save to mongodb once the whole response has been sent
 			const NEWCONVERSATION = new CONVERSATION({
 				user_id: USERID,
 				username: USERNAME,
@@ -206,16 +247,31 @@ APP.post('/chat', async(req, res) => {
 				botResponse: BOTRESPONSE,
 				timestamp: new Date()
 			});
-			await NEWCONVERSATION.save();
-			//console.log("Saved Conversation:", NEWCONVERSATION); //debug logging
-		
-			res.json({ userMessage: USERMESSAGE, botResponse: BOTRESPONSE });
+			try {
+				await NEWCONVERSATION.save();
+				//console.log("Saved Conversation:", NEWCONVERSATION); //debug logging
+			} catch (saveErr) {
+				console.error('Error saving conversation:', saveErr.message);
+			}
+		});
+
+		RAGRESPONSE.data.on('error', (err) => {
+			console.error('Error streaming response from RAG server:', err.message);
+			res.end();
 		});
-		
-		
-		
 	} catch (err) {
-		console.error('Error filtering contexts:', err);
+		//pass busy/rate limited/warming up responses from the rag server back to the client
+		if (err.response && (err.response.status === 503 || err.response.status === 429)) {
+			const RETRYAFTER = err.response.headers['retry-after'];
+			if (RETRYAFTER) {
+				res.setHeader('Retry-After', RETRYAFTER);
+			}
+			const MESSAGE = err.response.status === 429
+				? `You are sending messages too quickly, please retry in ${RETRYAFTER || 'a few'} s.`
+				: `TigersAI is busy, please retry in ${RETRYAFTER || 'a few'} s.`;
+			return res.status(err.response.status).json({ error: MESSAGE });
+		}
+		console.error('Error getting response from RAG server:', err.message);
 		return res.status(500).json({ error: 'Internal Server Error' });
 	}
 });
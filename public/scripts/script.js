@@ -62,17 +62,63 @@ function sendMessage() {
 		},
 		body: JSON.stringify({ userMessage: USERMESSAGE })
 	})
-	.then(response => response.json())
-	.then(data => {
-		//console.log('Response Data:', data);  // debug log the response data
-		//remove "Processing..." message
-		PROCESSINGELEMENT.remove();
-		displayMessage(data.botResponse, 'bot');
+	.then(async response => {
+		//errors (e.g. busy or logged out) come back as a single json body
+		if (!response.ok) {
+			const data = await response.json();
+			PROCESSINGELEMENT.remove();
+			displayMessage(data.error, 'bot');
+			return;
+		}
+
+		//the answer is streamed as newline delimited json frames, render it as it arrives
+		const READER = response.body.getReader();
+		const DECODER = new TextDecoder();
+		let buffered = '';
+		let botResponse = '';
+		let responseText = null;
+
+		while (true) {
+			const { done, value } = await READER.read();
+			if (done) break;
+
+			buffered += DECODER.decode(value, { stream: true });
+			const LINES = buffered.split('\n');
+			buffered = LINES.pop();
+
+			LINES.filter(line => line.trim()).forEach(line => {
+				//skip a malformed frame rather than dropping the rest of the answer
+				let FRAME;
+				try {
+					FRAME = JSON.parse(line);
+				} catch (parseErr) {
+					console.error('Skipping malformed frame:', parseErr.message);
+					return;
+				}
+				if (FRAME.type === 'token' || FRAME.type === 'sources') {
+					botResponse += FRAME.content;
+				} else if (FRAME.type === 'error') {
+					botResponse += `\n\n${FRAME.content}`;
+				} else {
+					return;
+				}
+
+				//remove "Processing..." message once the first frame arrives
+				if (!responseText) {
+					PROCESSINGELEMENT.remove();
+					responseText = displayMessage('', 'bot').lastChild;
+				}
+				responseText.innerHTML = marked.parse(botResponse);
+			});
+		}
 	})
 	.catch(error => {
 		console.error('Error:', error);
 	})
 	.finally(() => {
+		//the stream may end (or fail) before any frame arrived, don't leave "Processing..." behind
+		PROCESSINGELEMENT.remove();
+
 		// re-enable input field and send button
 		userInputField.disabled = false;
 		sendButton.disabled = false;
@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+from typing import Dict, List
+import numpy as np
+import faiss
+from numpy.typing import NDArray
+from modules.ann_index import build_ann_index, search_parameters
+from modules.chunk_cache import ChunkEmbeddingCache
+from modules.embedder import get_embedder, cache_key
+
+EMBED_MODEL = "BAAI/bge-small-en"
+VECTOR_DB_DIR = "faiss_index"
+EMBEDDING_CACHE_DIR = "embedding_cache"
+
+BENCHMARK_K = int(os.getenv("BENCHMARK_K", "10")) # recall@k
+BENCHMARK_QUERIES = int(os.getenv("BENCHMARK_QUERIES", "1000")) # queries sampled from the corpus when no query file is given
+NPROBE_SWEEP = [1, 4, 16, 64]
+EF_SEARCH_SWEEP = [16, 32, 64, 128]
+
+
+def load_corpus_vectors() -> NDArray[np.float32]:
+	"""
+	Loads the vectors of every embedded chunk, from the embedding cache or, if it is empty, from the flat index.
+
+	Returns:
+		NDArray[np.float32]: The chunk vectors, one per row.
+	"""
+	cache = ChunkEmbeddingCache(EMBEDDING_CACHE_DIR, cache_key(EMBED_MODEL))
+	if len(cache):
+		return np.array(cache.vectors)
+	index = faiss.read_index(os.path.join(VECTOR_DB_DIR, "index.faiss"))
+	return index.reconstruct_n(0, index.ntotal)
+
+def load_queries(corpus: NDArray[np.float32], path: str = None) -> NDArray[np.float32]:
+	"""
+	Embeds the questions in a file, one per line, or samples chunk vectors from the corpus as queries.
+
+	Args:
+		corpus (NDArray[np.float32]): The chunk vectors.
+		path (str): A file of questions to benchmark with.
+
+	Returns:
+		NDArray[np.float32]: The query vectors, one per row.
+	"""
+	if path:
+		with open(path, "r") as f:
+			questions = [line.strip() for line in f if line.strip()]
+		return np.array(get_embedder(EMBED_MODEL).embed_documents(questions), dtype=np.float32)
+	rng = np.random.default_rng(0)
+	return corpus[rng.choice(len(corpus), min(BENCHMARK_QUERIES, len(corpus)), replace=False)]
+
+def benchmark_index(index: faiss.Index, queries: NDArray[np.float32], ground_truth: NDArray[np.int64], params: faiss.SearchParameters) -> Dict[str, float]:
+	"""
+	Runs the queries one at a time, as the query server does, and measures recall and latency.
+
+	Args:
+		index (faiss.Index): The index to benchmark.
+		queries (NDArray[np.float32]): The query vectors.
+		ground_truth (NDArray[np.int64]): The exact top k vector IDs of each query.
+		params (faiss.SearchParameters): The search parameters.
+
+	Returns:
+		Dict[str, float]: The recall@k and the p50 and p99 latency in milliseconds.
+	"""
+	latencies = []
+	hits = 0
+	for query, expected in zip(queries, ground_truth):
+		start = time.perf_counter()
+		_, indices = index.search(query.reshape(1, -1), BENCHMARK_K, params=params)
+		latencies.append((time.perf_counter() - start) * 1000)
+		hits += len(set(indices[0].tolist()) & set(expected.tolist()))
+	return {
+		"recall": hits / ground_truth.size,
+		"p50_ms": float(np.percentile(latencies, 50)),
+		"p99_ms": float(np.percentile(latencies, 99))
+	}
+
+def run_benchmark(query_path: str = None) -> List[Dict]:
+	"""
+	Builds each index type over the current corpus and reports recall@k against the exact flat index, query
+	latency and index memory, sweeping nprobe for IVF and efSearch for HNSW.
+
+	Args:
+		query_path (str): A file of questions to benchmark with, one per line.
+
+	Returns:
+		List[Dict]: One result per index type and search setting.
+	"""
+	corpus = load_corpus_vectors()
+	queries = load_queries(corpus, query_path)
+	nlist = max(1, int(4 * np.sqrt(len(corpus))))
+	print(f"{len(corpus)} vectors, {len(queries)} queries, recall@{BENCHMARK_K}, nlist={nlist}")
+
+	configs = [
+		("flat", {}, "-", [None]),
+		("ivf_flat", {"nlist": nlist}, "nprobe", NPROBE_SWEEP),
+		("ivf_pq", {"nlist": nlist}, "nprobe", NPROBE_SWEEP),
+		("hnsw", {}, "efSearch", EF_SEARCH_SWEEP)
+	]
+
+	results = []
+	ground_truth = None
+	for index_type, build_params, knob, values in configs:
+		start = time.perf_counter()
+		try:
+			index = build_ann_index(corpus, index_type, **build_params)
+		except ValueError as e:
+			print(f"Skipping {index_type}: {e}")
+			continue
+		build_seconds = time.perf_counter() - start
+		memory_mb = faiss.serialize_index(index).nbytes / 1024 / 1024
+
+		if ground_truth is None:
+			# the exact flat index is always built first
+			_, ground_truth = index.search(queries, BENCHMARK_K)
+
+		for value in values:
+			params = search_parameters(index, nprobe=value or 1, ef_search=value or 16)
+			result = {"index_type": index_type, knob: value, "build_s": build_seconds, "memory_mb": memory_mb}
+			result.update(benchmark_index(index, queries, ground_truth, params))
+			results.append(result)
+			print(f"{index_type:<9} {knob}={value if value is not None else '-':<4} recall={result['recall']:.3f} "
+				f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms memory={memory_mb:.1f}MB build={build_seconds:.1f}s")
+	return results
+
+if __name__ == "__main__":
+	run_benchmark(sys.argv[1] if len(sys.argv) > 1 else None)
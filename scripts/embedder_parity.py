@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+from typing import Dict, List
+import numpy as np
+from modules.embedder import Embedder, BACKENDS, EMBED_MODEL
+from modules.mmap_store import ColumnarDocstore, current_mmap_dir
+
+VECTOR_DB_DIR = "faiss_index"
+PARITY_CORPUS = int(os.getenv("PARITY_CORPUS", "2000")) # chunks sampled from the index
+PARITY_K = int(os.getenv("PARITY_K", "10"))
+PARITY_MIN_OVERLAP = float(os.getenv("PARITY_MIN_OVERLAP", "0.9")) # mean top k overlap with torch a backend must reach
+
+DEFAULT_QUESTIONS = [
+	"What are the differences between TCP and UDP, and when should you use each?",
+	"What is port 443 used for?",
+	"How do I calculate the subnet mask for a /26 network?",
+	"What does the OSI transport layer do?",
+	"How does DNS resolve a domain name?",
+	"What is the difference between a switch and a router?",
+	"How many usable hosts are in a /29 IPv4 subnet?",
+	"What is an IPv6 link-local address?",
+	"What does the ping command do?",
+	"When is the assignment due?"
+]
+
+
+def load_texts(query_path: str = None) -> Dict[str, List[str]]:
+	"""
+	Samples chunks from the exported docstore as the corpus, and loads the questions to rank it with.
+
+	Args:
+		query_path (str): A file of questions, one per line. DEFAULT_QUESTIONS are used if not given.
+
+	Returns:
+		Dict[str, List[str]]: The 'corpus' and 'queries' texts.
+	"""
+	docstore = ColumnarDocstore(current_mmap_dir(VECTOR_DB_DIR))
+	rng = np.random.default_rng(0)
+	positions = rng.choice(len(docstore), min(PARITY_CORPUS, len(docstore)), replace=False)
+	corpus = [docstore.page_content(int(position)) for position in positions]
+
+	queries = DEFAULT_QUESTIONS
+	if query_path:
+		with open(query_path, "r") as f:
+			queries = [line.strip() for line in f if line.strip()]
+	return {"corpus": corpus, "queries": queries}
+
+def check_parity(query_path: str = None) -> bool:
+	"""
+	Embeds the same corpus and questions with every backend and compares each backend's retrieval rankings with
+	the PyTorch backend's, along with the vector similarity and embedding speed.
+
+	Args:
+		query_path (str): A file of questions, one per line.
+
+	Returns:
+		bool: True if every backend's mean top k overlap with PyTorch is at least PARITY_MIN_OVERLAP.
+	"""
+	texts = load_texts(query_path)
+	print(f"{len(texts['corpus'])} chunks, {len(texts['queries'])} questions, top {PARITY_K}")
+
+	reference = None
+	passed = True
+	for backend in BACKENDS:
+		embedder = Embedder(EMBED_MODEL, backend)
+		start = time.perf_counter()
+		corpus = np.array(embedder.embed_documents(texts["corpus"]), dtype=np.float32)
+		throughput = len(corpus) / (time.perf_counter() - start)
+
+		latencies = []
+		queries = []
+		for query in texts["queries"]:
+			start = time.perf_counter()
+			queries.append(embedder.embed_documents([query])[0])
+			latencies.append((time.perf_counter() - start) * 1000)
+		queries = np.array(queries, dtype=np.float32)
+		rankings = np.argsort(-(queries @ corpus.T), axis=1)[:, :PARITY_K]
+
+		if reference is None:
+			reference = {"corpus": corpus, "rankings": rankings}
+			overlap, top1, cosine = 1.0, 1.0, 1.0
+		else:
+			overlap = np.mean([len(set(a) & set(b)) / PARITY_K for a, b in zip(rankings, reference["rankings"])])
+			top1 = np.mean(rankings[:, 0] == reference["rankings"][:, 0])
+			cosine = np.mean(np.sum(corpus * reference["corpus"], axis=1))
+			passed &= overlap >= PARITY_MIN_OVERLAP
+
+		print(f"{backend:<10} top{PARITY_K} overlap={overlap:.3f} top1 agreement={top1:.3f} mean cosine={cosine:.4f} "
+			f"query p50={np.percentile(latencies, 50):.1f}ms ingest={throughput:.0f} chunks/s")
+	return passed
+
+if __name__ == "__main__":
+	if not check_parity(sys.argv[1] if len(sys.argv) > 1 else None):
+		print(f"A backend's rankings differ from PyTorch by more than the threshold ({PARITY_MIN_OVERLAP}).")
+		sys.exit(1)
@@ -0,0 +1,202 @@
+import os
+import sys
+import time
+import socket
+import hashlib
+import tempfile
+import threading
+import email.utils
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from modules.moodle_functions import download_moodle_file, download_moodle_files, save_part_version
+
+# a stand-in for Moodle's file downloads, serving files from memory with Range and If-Range support and injected
+# faults, for testing resumed downloads and measuring download throughput. Run it to check the downloader against
+# it, e.g. python fake_moodle_server.py, or python fake_moodle_server.py serve 8081 to only serve
+FAKE_MOODLE_FILE_MB = float(os.getenv("FAKE_MOODLE_FILE_MB", "4")) # size of each generated file
+FAKE_MOODLE_FILES = int(os.getenv("FAKE_MOODLE_FILES", "8")) # files downloaded in the throughput run
+
+
+class FakeMoodleHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	files = {} # filename -> {"data": bytes, "timemodified": int}
+	drops = {} # filename -> bytes sent before the connection is cut, once
+	changes = {} # filename -> new contents served after the connection is cut
+	requests = 0
+	range_requests = 0
+	bytes_sent = 0
+	lock = threading.Lock()
+
+	def log_message(self, format, *args):
+		pass
+
+	@staticmethod
+	def etag(file: dict) -> str:
+		return '"' + hashlib.md5(file["data"]).hexdigest() + '"'
+
+	def do_GET(self):
+		cls = type(self)
+		filename = self.path.split("?")[0].rsplit("/", 1)[-1]
+		with cls.lock:
+			file = cls.files.get(filename)
+			cls.requests += 1
+		if file is None:
+			self.send_error(404)
+			return
+
+		data = file["data"]
+		last_modified = email.utils.formatdate(file["timemodified"], usegmt=True)
+		validators = (self.etag(file), last_modified)
+		# a range is only honoured while If-Range still matches the file, otherwise the whole file is sent
+		offset = 0
+		range_header = self.headers.get("Range")
+		if range_header and self.headers.get("If-Range", validators[0]) in validators:
+			offset = int(range_header.split("=")[1].split("-")[0])
+			with cls.lock:
+				cls.range_requests += 1
+			if offset >= len(data):
+				self.send_response(416)
+				self.send_header("Content-Range", f"bytes */{len(data)}")
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				return
+
+		self.send_response(206 if offset else 200)
+		if offset:
+			self.send_header("Content-Range", f"bytes {offset}-{len(data) - 1}/{len(data)}")
+		self.send_header("Content-Length", str(len(data) - offset))
+		self.send_header("ETag", validators[0])
+		self.send_header("Last-Modified", last_modified)
+		self.end_headers()
+
+		with cls.lock:
+			drop = cls.drops.pop(filename, None)
+		body = data[offset:offset + drop] if drop is not None else data[offset:]
+		try:
+			self.wfile.write(body)
+			self.wfile.flush()
+		except (BrokenPipeError, ConnectionResetError):
+			self.close_connection = True
+		with cls.lock:
+			cls.bytes_sent += len(body)
+			if drop is not None:
+				# the download is cut short, and the file may change on Moodle before it is retried
+				if filename in cls.changes:
+					cls.files[filename] = {"data": cls.changes.pop(filename), "timemodified": file["timemodified"] + 60}
+		if drop is not None:
+			self.close_connection = True
+			self.connection.shutdown(socket.SHUT_RDWR)
+
+
+def run_fake_moodle(host: str = "127.0.0.1", port: int = 8081) -> ThreadingHTTPServer:
+	"""
+	Starts a fake Moodle file server on a background thread.
+
+	Args:
+		host (str): The address to listen on.
+		port (int): The port to listen on, 0 picks a free port.
+
+	Returns:
+		ThreadingHTTPServer: The running server, its address is server.server_address.
+	"""
+	server = ThreadingHTTPServer((host, port), FakeMoodleHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def add_file(filename: str, data: bytes, timemodified: int = 1700000000) -> dict:
+	FakeMoodleHandler.files[filename] = {"data": data, "timemodified": timemodified}
+	return {"filename": filename, "filesize": len(data), "timemodified": timemodified}
+
+def check_downloads(base_url: str) -> bool:
+	"""
+	Downloads files from the fake server with faults injected, and checks each download is byte for byte the
+	file on the server: an interrupted download resumed with a range request, a complete partial file answered
+	with 416, a file that changes on Moodle mid-download, and a partial file left from an older version.
+
+	Args:
+		base_url (str): The URL of the fake server.
+
+	Returns:
+		bool: True if every check passed.
+	"""
+	size = int(FAKE_MOODLE_FILE_MB * 1024 * 1024)
+	passed = True
+	with tempfile.TemporaryDirectory() as output_dir, requests.Session() as session:
+		def run(name: str, file: dict, expected: bytes, ranges: int):
+			nonlocal passed
+			file = {**file, "fileurl": f"{base_url}/pluginfile.php/{file['filename']}"}
+			before = FakeMoodleHandler.range_requests
+			download_moodle_file(session, file, "token", output_dir, chunk_size=64 * 1024, backoff=0.01)
+			with open(os.path.join(output_dir, file["filename"]), "rb") as f:
+				ok = f.read() == expected and FakeMoodleHandler.range_requests - before == ranges
+			ok &= not os.path.exists(os.path.join(output_dir, f"{file['filename']}.part.json"))
+			passed &= ok
+			print(f"{name:<40}{'ok' if ok else 'FAILED'}")
+
+		# cut off half way, then resumed from where it stopped
+		data = os.urandom(size)
+		file = add_file("resume.pdf", data)
+		FakeMoodleHandler.drops["resume.pdf"] = size // 2
+		run("resume after interruption", file, data, ranges=1)
+
+		# the partial file is already complete, the server answers the range with 416
+		data = os.urandom(size)
+		file = add_file("complete.pdf", data)
+		partpath = os.path.join(output_dir, "complete.pdf.part")
+		with open(partpath, "wb") as f:
+			f.write(data)
+		save_part_version(partpath, {"filesize": len(data), "timemodified": file["timemodified"], "etag": FakeMoodleHandler.etag(FakeMoodleHandler.files["complete.pdf"]), "last_modified": None})
+		run("416 on a complete partial file", file, data, ranges=1)
+
+		# the file changes on Moodle after the connection is cut, If-Range no longer matches so the whole new file is sent
+		old, new = os.urandom(size), os.urandom(size)
+		file = add_file("changed.pdf", old)
+		FakeMoodleHandler.drops["changed.pdf"] = size // 2
+		FakeMoodleHandler.changes["changed.pdf"] = new
+		run("file changed mid-download", file, new, ranges=0)
+
+		# a partial file left by an earlier run, from a version that has since changed on Moodle, is started again
+		old, new = os.urandom(size), os.urandom(size)
+		partpath = os.path.join(output_dir, "stale.pdf.part")
+		with open(partpath, "wb") as f:
+			f.write(old[:size // 2])
+		save_part_version(partpath, {"filesize": size, "timemodified": 1700000000, "etag": None, "last_modified": None})
+		file = add_file("stale.pdf", new, timemodified=1700000600)
+		run("partial file from an older version", file, new, ranges=0)
+	return passed
+
+def measure_throughput(base_url: str) -> dict:
+	"""
+	Downloads FAKE_MOODLE_FILES files from the fake server with download_moodle_files and reports its metrics.
+
+	Args:
+		base_url (str): The URL of the fake server.
+
+	Returns:
+		dict: The download metrics.
+	"""
+	size = int(FAKE_MOODLE_FILE_MB * 1024 * 1024)
+	files = []
+	for i in range(FAKE_MOODLE_FILES):
+		file = add_file(f"throughput{i}.pdf", os.urandom(size))
+		files.append({**file, "fileurl": f"{base_url}/pluginfile.php/{file['filename']}"})
+	with tempfile.TemporaryDirectory() as output_dir:
+		start = time.perf_counter()
+		metrics = download_moodle_files(files, "token", output_dir)
+		print(f"{len(files)} files of {FAKE_MOODLE_FILE_MB}MB in {time.perf_counter() - start:.2f}s, "
+			f"{metrics['throughput'] / 1e6:.1f}MB/s, {metrics['failed']} failed")
+	return metrics
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "serve":
+		server = run_fake_moodle(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8081)
+		print(f"Fake Moodle listening on {server.server_address[0]}:{server.server_address[1]}")
+		threading.Event().wait()
+
+	server = run_fake_moodle(port=0)
+	base_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+	passed = check_downloads(base_url)
+	measure_throughput(base_url)
+	server.shutdown()
+	if not passed:
+		sys.exit(1)
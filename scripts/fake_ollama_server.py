@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a stand-in for Ollama's /api/generate, for testing and load testing the LLM client and query server without a model
+FAKE_OLLAMA_TOKEN_DELAY = float(os.getenv("FAKE_OLLAMA_TOKEN_DELAY", "0.02")) # seconds between streamed tokens
+FAKE_OLLAMA_TOKENS = int(os.getenv("FAKE_OLLAMA_TOKENS", "20")) # tokens per answer
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	inflight = 0
+	max_inflight = 0
+	requests = 0
+	lock = threading.Lock()
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, status: int, body: dict):
+		payload = json.dumps(body).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def do_GET(self):
+		if self.path == "/stats":
+			with self.lock:
+				self.send_json(200, {"requests": self.requests, "inflight": self.inflight, "max_inflight": self.max_inflight})
+		else:
+			self.send_json(200, {"status": "Ollama is running"})
+
+	def do_POST(self):
+		if self.path != "/api/generate":
+			self.send_json(404, {"error": "not found"})
+			return
+		body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+		cls = type(self)
+		with cls.lock:
+			cls.requests += 1
+			cls.inflight += 1
+			cls.max_inflight = max(cls.max_inflight, cls.inflight)
+		try:
+			tokens = [f"token{i} " for i in range(FAKE_OLLAMA_TOKENS)]
+			if not body.get("stream", True):
+				time.sleep(FAKE_OLLAMA_TOKEN_DELAY * len(tokens))
+				self.send_json(200, {"model": body.get("model"), "response": "".join(tokens), "done": True})
+				return
+
+			self.send_response(200)
+			self.send_header("Content-Type", "application/x-ndjson")
+			self.send_header("Transfer-Encoding", "chunked")
+			self.end_headers()
+			for token in tokens:
+				time.sleep(FAKE_OLLAMA_TOKEN_DELAY)
+				self.write_chunk({"model": body.get("model"), "response": token, "done": False})
+			self.write_chunk({"model": body.get("model"), "response": "", "done": True})
+			self.wfile.write(b"0\r\n\r\n")
+		except (BrokenPipeError, ConnectionResetError):
+			# the client stopped reading early
+			self.close_connection = True
+		finally:
+			with cls.lock:
+				cls.inflight -= 1
+
+	def write_chunk(self, frame: dict):
+		line = (json.dumps(frame) + "\n").encode("utf-8")
+		self.wfile.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+		self.wfile.flush()
+
+
+def run_fake_ollama(host: str = "127.0.0.1", port: int = 11434) -> ThreadingHTTPServer:
+	"""
+	Starts a fake Ollama server on a background thread.
+
+	Args:
+		host (str): The address to listen on.
+		port (int): The port to listen on, 0 picks a free port.
+
+	Returns:
+		ThreadingHTTPServer: The running server, its address is server.server_address.
+	"""
+	server = ThreadingHTTPServer((host, port), FakeOllamaHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+if __name__ == "__main__":
+	server = run_fake_ollama(port=int(sys.argv[1]) if len(sys.argv) > 1 else 11434)
+	print(f"Fake Ollama listening on {server.server_address[0]}:{server.server_address[1]}")
+	threading.Event().wait()
@@ -1,7 +1,12 @@
-from modules.moodle_functions import get_course_contents, get_moodle_file_urls, modify_moodle_file_urls, download_moodle_files
+from modules.moodle_functions import (get_course_contents, get_moodle_file_urls, get_moodle_file_info, modify_moodle_file_urls,
+	download_moodle_files, get_site_info, get_user_courses, get_all_courses)
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
+import sys
 import json
+import time
+import threading
 
 #load env vars
 load_dotenv()
@@ -10,13 +15,213 @@ load_dotenv()
 MOODLE_SERVER: str = os.getenv("MOODLE_SERVER")
 MOODLE_AUTH_TOKEN: str = os.getenv("MOODLE_AUTH_TOKEN")
 MOODLE_COURSE_ID: int = os.getenv("MOODLE_COURSE_ID")
+MOODLE_COURSE_IDS: str = os.getenv("MOODLE_COURSE_IDS", "") # comma separated list of courses for a batch ingest
+MOODLE_DISCOVER_ALL_COURSES: bool = os.getenv("MOODLE_DISCOVER_ALL_COURSES", "false").lower() == "true"
+
+# globals for batch ingests
+INGEST_WORKERS: int = int(os.getenv("MOODLE_INGEST_WORKERS", "8")) # courses ingested at once
+INGEST_TIME_BUDGET: float = float(os.getenv("MOODLE_INGEST_TIME_BUDGET", "3600")) # seconds before remaining courses are left for the next run
+
+METADATA_PATH = "moodle_file_metadata.json"
+DOWNLOAD_DIR = "ingested_moodle_data"
+COURSE_MANIFEST_DIR = "moodle_manifests"
+PENDING_PATH = os.path.join(COURSE_MANIFEST_DIR, "pending.json") # courses the last run didn't finish, ingested first
+
+
+def get_ingest_course_ids() -> list:
+	"""
+	Works out which courses to ingest: the course IDs given on the command line, then MOODLE_COURSE_IDS, then
+	MOODLE_COURSE_ID. If none are set the courses are discovered from Moodle, either every course on the site
+	(MOODLE_DISCOVER_ALL_COURSES=true) or the courses the token's user is enrolled in.
+
+	Returns:
+		list: The IDs of the courses to ingest.
+	"""
+	course_ids = sys.argv[1:] or [course_id for course_id in MOODLE_COURSE_IDS.split(",") if course_id.strip()]
+	if not course_ids and MOODLE_COURSE_ID:
+		course_ids = [MOODLE_COURSE_ID]
+	if course_ids:
+		return [int(course_id) for course_id in course_ids]
+
+	if MOODLE_DISCOVER_ALL_COURSES:
+		courses = get_all_courses(MOODLE_SERVER, MOODLE_AUTH_TOKEN)
+	else:
+		site_info = get_site_info(MOODLE_SERVER, MOODLE_AUTH_TOKEN)
+		courses = get_user_courses(MOODLE_SERVER, MOODLE_AUTH_TOKEN, site_info.get('userid'))
+	return [course['id'] for course in courses]
+
+def load_file_metadata(path: str = METADATA_PATH) -> dict:
+	"""
+	Loads the merged file metadata of every ingested course.
+
+	Args:
+		path (str): The path of the merged metadata file.
+
+	Returns:
+		dict: A dictionary of "<course_id>/<filename>" paths to their Moodle 'url' and 'course_id'.
+	"""
+	if os.path.exists(path):
+		with open(path, "r") as f:
+			return json.load(f)
+	return {}
+
+def write_json_atomic(data: dict, path: str):
+	"""
+	Writes a dictionary as JSON through a temporary file, so a crash can't leave a half written file.
+
+	Args:
+		data (dict): The data to write.
+		path (str): The file path to write to.
+
+	Returns:
+		None
+	"""
+	with open(f"{path}.tmp", "w") as f:
+		json.dump(data, f, indent=4)
+	os.replace(f"{path}.tmp", path)
+
+def merge_course_metadata(metadata: dict, course_id: int, course_files: dict) -> dict:
+	"""
+	Replaces one course's entries in the merged file metadata, leaving every other course untouched.
+
+	Args:
+		metadata (dict): The merged metadata of every ingested course.
+		course_id (int): The ID of the course that was ingested.
+		course_files (dict): The course's files, keyed by their path in the download directory.
+
+	Returns:
+		dict: The merged metadata.
+	"""
+	# drop files no longer in the course, then add the current ones
+	merged = {filename: info for filename, info in metadata.items() if str(info.get('course_id')) != str(course_id)}
+	merged.update(course_files)
+	return merged
+
+def remove_deleted_files(old_metadata: dict, metadata: dict):
+	"""
+	Deletes the downloaded copies of files that are no longer in any course, so the next embedding run deletes
+	their chunks from the index.
+
+	Args:
+		old_metadata (dict): The merged metadata before a course was ingested.
+		metadata (dict): The merged metadata after the course was ingested.
+
+	Returns:
+		None
+	"""
+	# files ingested before courses had their own directories are keyed by filename alone, and are removed here
+	# the first time their course is ingested again
+	for filename in old_metadata.keys() - metadata.keys():
+		path = os.path.join(DOWNLOAD_DIR, filename)
+		if os.path.exists(path):
+			print(f"Removing file deleted from Moodle: {filename}")
+			os.remove(path)
+
+def load_pending_courses(path: str = PENDING_PATH) -> list:
+	"""
+	Loads the courses the previous run ran out of time for.
+
+	Args:
+		path (str): The path of the pending courses file.
+
+	Returns:
+		list: The IDs of the unfinished courses.
+	"""
+	if os.path.exists(path):
+		with open(path, "r") as f:
+			return json.load(f)
+	return []
+
+def schedule_courses(course_ids: list, pending: list) -> list:
+	"""
+	Orders the courses to ingest so the ones the previous run didn't finish go first, instead of missing the time
+	budget again at the end of every run.
+
+	Args:
+		course_ids (list): The IDs of the courses to ingest.
+		pending (list): The IDs of the courses the previous run didn't finish.
+
+	Returns:
+		list: The course IDs, unfinished courses first.
+	"""
+	pending = [course_id for course_id in pending if course_id in course_ids]
+	return pending + [course_id for course_id in course_ids if course_id not in pending]
+
+def ingest_course(course_id: int, deadline: float = None) -> tuple:
+	"""
+	Fetches a course's contents, writes its manifest and downloads its files. Each course is downloaded to its own
+	directory, with its own download state, so courses ingested at once never write the same files.
+
+	Args:
+		course_id (int): The ID of the course to ingest.
+		deadline (float): The time.monotonic() time downloads stop at, no limit if not given.
+
+	Returns:
+		tuple: The course's files, as returned by modify_moodle_file_urls but keyed by "<course_id>/<filename>",
+		and whether every file was downloaded before the deadline.
+	"""
+	course_contents = get_course_contents(MOODLE_SERVER, MOODLE_AUTH_TOKEN, course_id)
+	if isinstance(course_contents, dict):
+		# moodle returns errors as a single object instead of a list of sections
+		raise RuntimeError(course_contents.get('error') or course_contents.get('message') or course_contents)
+
+	course_files = modify_moodle_file_urls(get_moodle_file_urls(course_contents), course_id)
+	write_json_atomic(course_files, os.path.join(COURSE_MANIFEST_DIR, f"{course_id}.json"))
+	download_metrics = download_moodle_files(get_moodle_file_info(course_contents), MOODLE_AUTH_TOKEN, os.path.join(DOWNLOAD_DIR, str(course_id)),
+		deadline=deadline)
+	print(f"Course {course_id}: {download_metrics}")
+	return {f"{course_id}/{filename}": info for filename, info in course_files.items()}, not download_metrics['unfinished']
+
+def ingest_courses(course_ids: list, workers: int = INGEST_WORKERS, time_budget: float = INGEST_TIME_BUDGET) -> dict:
+	"""
+	Ingests several courses concurrently, merging each course's files into the metadata file as soon as the
+	course is done. Downloads stop when the time budget runs out, and the courses not finished are written to
+	PENDING_PATH and ingested first by the next run. Their partial downloads are resumed then.
+
+	Args:
+		course_ids (list): The IDs of the courses to ingest.
+		workers (int): The number of courses ingested at once.
+		time_budget (float): The number of seconds to spend on the batch.
+
+	Returns:
+		dict: The IDs of the courses 'ingested', 'failed' and 'unfinished'.
+	"""
+	os.makedirs(COURSE_MANIFEST_DIR, exist_ok=True)
+	deadline = time.monotonic() + time_budget
+	course_ids = schedule_courses(course_ids, load_pending_courses())
+	metadata = load_file_metadata()
+	lock = threading.Lock()
+	results = {'ingested': [], 'failed': [], 'unfinished': []}
+
+	def run(course_id: int):
+		nonlocal metadata
+		if time.monotonic() >= deadline:
+			with lock:
+				results['unfinished'].append(course_id)
+			return
+		try:
+			course_files, finished = ingest_course(course_id, deadline)
+		except Exception as e:
+			print(f"Failed to ingest course {course_id}: {e}")
+			with lock:
+				results['failed'].append(course_id)
+			return
+		with lock:
+			old_metadata = metadata
+			metadata = merge_course_metadata(metadata, course_id, course_files)
+			write_json_atomic(metadata, METADATA_PATH)
+			remove_deleted_files(old_metadata, metadata)
+			# the files downloaded so far are merged either way, an unfinished course is completed by the next run
+			results['ingested' if finished else 'unfinished'].append(course_id)
+
+	# courses still running at the deadline stop their downloads, so this returns shortly after the budget
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		list(executor.map(run, course_ids))
+	write_json_atomic(results['unfinished'], PENDING_PATH)
+	return results
 
 if __name__ == "__main__":
-	course_contents = get_course_contents(MOODLE_SERVER, MOODLE_AUTH_TOKEN, MOODLE_COURSE_ID)
-	moodle_file_urls = get_moodle_file_urls(course_contents)
-	modified_moodle_file_urls = modify_moodle_file_urls(moodle_file_urls, MOODLE_COURSE_ID)
-	print(modified_moodle_file_urls)
-	with open("moodle_file_metadata.json", "w") as f:
-		json.dump(modified_moodle_file_urls, f, indent=4)
-	download_moodle_files(moodle_file_urls, MOODLE_AUTH_TOKEN)
-	
+	start = time.monotonic()
+	results = ingest_courses(get_ingest_course_ids())
+	print(f"Ingested {len(results['ingested'])} courses in {time.monotonic() - start:.1f}s, "
+		f"{len(results['failed'])} failed ({results['failed']}), {len(results['unfinished'])} left for the next run ({results['unfinished']}).")
@@ -0,0 +1,158 @@
+import sys
+import json
+from typing import Dict, List, Tuple
+import numpy as np
+from modules.embedder import get_embedder
+from modules.prompting import IntentRouter, INTENT_THRESHOLDS_FILE, normalise_query
+
+# calibrates the intent router's thresholds against labelled questions, e.g. python intent_calibration.py [labelled.tsv]
+# a course question routed to a canned answer is a false positive, the user never gets an answer from their course
+THRESHOLD_GRID = np.round(np.arange(0.80, 0.991, 0.01), 2)
+THRESHOLD_MARGIN = 0.01 # added above the highest scoring course question of an intent
+COURSE = "course" # the label of questions that must go to retrieval
+
+# course questions worded like the intents (dates, times, greetings, thanks, off-topic sounding), and paraphrases of
+# each intent that are not among its examples
+DEFAULT_LABELLED_QUESTIONS = [
+	("what day is the exam", COURSE),
+	("what day is the assignment due", COURSE),
+	("when is the assignment due?", COURSE),
+	("what is the date of the final exam", COURSE),
+	("what's the due date for lab 3", COURSE),
+	("what time is the lab", COURSE),
+	("what time does the tutorial start", COURSE),
+	("what is the time limit for the quiz", COURSE),
+	("what time zone are the deadlines in", COURSE),
+	("is the lecture today", COURSE),
+	("hi, how do I calculate a subnet mask?", COURSE),
+	("hello, what is port 443 used for", COURSE),
+	("hey can you explain the OSI model", COURSE),
+	("good morning, what does DHCP do?", COURSE),
+	("thanks, can you also explain TCP vs UDP?", COURSE),
+	("thank you, what about IPv6 link-local addresses", COURSE),
+	("how are VLANs configured", COURSE),
+	("how are you meant to configure a static route", COURSE),
+	("what's up with my packet tracer lab not saving", COURSE),
+	("are you able to explain NAT", COURSE),
+	("what is the weighting of the final exam", COURSE),
+	("what is the meaning of a default gateway", COURSE),
+	("who is the course coordinator", COURSE),
+	("tell me about the assessment criteria", COURSE),
+	("what should I study for the exam", COURSE),
+	("recommend me some resources for subnetting", COURSE),
+	("what is the current IP address of the lab server", COURSE),
+	("what is the date format used by syslog", COURSE),
+	("what does the time to live field do", COURSE),
+	("what is the current version of the assignment spec", COURSE),
+	("hiya", "greeting"),
+	("hello there chatbot", "greeting"),
+	("morning!", "greeting"),
+	("how have you been", "wellbeing"),
+	("how's your day going", "wellbeing"),
+	("what's today's date?", "date"),
+	("which day is it today", "date"),
+	("what's the time right now", "time"),
+	("do you know what time it is", "time"),
+	("thanks heaps", "thanks"),
+	("awesome thank you", "thanks"),
+	("what's the forecast for tomorrow", "out_of_scope"),
+	("can you tell me a funny joke", "out_of_scope"),
+	("what movie should I watch tonight", "out_of_scope"),
+	("who won the game yesterday", "out_of_scope"),
+]
+
+
+def load_labelled_questions(path: str = None) -> List[Tuple[str, str]]:
+	"""
+	Loads the labelled questions to calibrate with.
+
+	Args:
+		path (str): A file of tab separated question and label lines, the label being an intent name or "course".
+			DEFAULT_LABELLED_QUESTIONS are used if not given.
+
+	Returns:
+		List[Tuple[str, str]]: The questions and their labels.
+	"""
+	if not path:
+		return DEFAULT_LABELLED_QUESTIONS
+	with open(path, "r") as f:
+		return [tuple(line.rstrip("\n").split("\t")) for line in f if line.strip()]
+
+def route_all(router: IntentRouter, vectors: np.ndarray, thresholds: np.ndarray) -> List[str]:
+	# the intent each question is routed to with the given thresholds, or COURSE if it goes to retrieval
+	vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+	scores = vectors @ router.centroids.T
+	best = scores.argmax(axis=1)
+	return [router.names[i] if scores[row, i] >= thresholds[i] else COURSE for row, i in enumerate(best)]
+
+def evaluate(labels: List[str], routed: List[str]) -> Dict[str, float]:
+	"""
+	Measures how a set of thresholds routes the labelled questions.
+
+	Args:
+		labels (List[str]): The label of each question.
+		routed (List[str]): The intent each question was routed to, or "course".
+
+	Returns:
+		Dict[str, float]: The 'false_positive_rate' (course questions given a canned answer), the 'recall' (intent
+			questions given the right canned answer) and the 'misrouted' intent questions given the wrong one.
+	"""
+	course = [route for label, route in zip(labels, routed) if label == COURSE]
+	intent = [(label, route) for label, route in zip(labels, routed) if label != COURSE]
+	return {
+		"false_positive_rate": sum(route != COURSE for route in course) / max(len(course), 1),
+		"recall": sum(label == route for label, route in intent) / max(len(intent), 1),
+		"misrouted": sum(route not in (label, COURSE) for label, route in intent)
+	}
+
+def calibrate(path: str = None) -> Dict[str, float]:
+	"""
+	Embeds the labelled questions, reports the false positive rate and recall of the current thresholds and of
+	each threshold in THRESHOLD_GRID, and works out per-intent thresholds: just above the highest scoring course
+	question routed to the intent, never below the current threshold and at most 1.0, which disables the intent.
+
+	Args:
+		path (str): A file of labelled questions.
+
+	Returns:
+		Dict[str, float]: The calibrated threshold of each intent.
+	"""
+	questions = load_labelled_questions(path)
+	embeddings = get_embedder()
+	router = IntentRouter(embeddings)
+	labels = [label for _, label in questions]
+	vectors = np.asarray(embeddings.embed_documents([question for question, _ in questions]), dtype=np.float32)
+	print(f"{labels.count(COURSE)} course questions, {len(labels) - labels.count(COURSE)} intent questions")
+
+	# questions that are an intent example are answered by exact match, before any threshold applies
+	exact = [question for question, label in questions if label == COURSE and normalise_query(question) in router.exact]
+	print(f"course questions matched exactly: {len(exact)} {exact}")
+
+	print(f"{'threshold':<12}{'false positives':>16}{'recall':>8}{'misrouted':>10}")
+	for threshold in THRESHOLD_GRID:
+		result = evaluate(labels, route_all(router, vectors, np.full(len(router.names), threshold, dtype=np.float32)))
+		print(f"{threshold:<12.2f}{result['false_positive_rate']:>16.3f}{result['recall']:>8.3f}{result['misrouted']:>10}")
+
+	scores = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)) @ router.centroids.T
+	calibrated = {}
+	for i, name in enumerate(router.names):
+		course_scores = [scores[row, i] for row, label in enumerate(labels) if label == COURSE and scores[row].argmax() == i]
+		floor = float(router.thresholds[i])
+		# similarities never exceed 1.0, an intent that would need more is disabled rather than given an unreachable threshold
+		calibrated[name] = min(round(max([floor] + [float(score) + THRESHOLD_MARGIN for score in course_scores]), 3), 1.0)
+	disabled = [name for name in router.names if calibrated[name] >= 1.0]
+	if disabled:
+		print(f"intents disabled, only answered by exact match: {disabled}")
+
+	calibrated_thresholds = np.array([calibrated[name] for name in router.names], dtype=np.float32)
+	for setting, thresholds in (("current", router.thresholds), ("calibrated", calibrated_thresholds)):
+		result = evaluate(labels, route_all(router, vectors, thresholds))
+		print(f"{setting} thresholds: false positive rate={result['false_positive_rate']:.3f} recall={result['recall']:.3f} "
+			f"misrouted={result['misrouted']} {dict(zip(router.names, np.round(thresholds.astype(float), 3).tolist()))}")
+	return calibrated
+
+if __name__ == "__main__":
+	thresholds = calibrate(sys.argv[1] if len(sys.argv) > 1 else None)
+	with open(INTENT_THRESHOLDS_FILE, "w") as f:
+		json.dump(thresholds, f, indent=4)
+	print(f"Wrote the calibrated thresholds to {INTENT_THRESHOLDS_FILE}, the intent router uses them from its next start.")
@@ -2,14 +2,23 @@ import sys
 import os
 import json
 import base64
-from langchain.llms import Ollama
-from langchain.chains import RetrievalQA
+import asyncio
+from typing import List, Dict, AsyncIterator
 from langchain.prompts import PromptTemplate
 from langchain.vectorstores import FAISS
-from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.docstore.document import Document
 from better_profanity import profanity
 from dotenv import load_dotenv
-from modules.prompting import get_hardcoded_responses
+from modules.prompting import get_intent_router
+from modules.course_retrieval import (CourseIndex, load_course_index, parse_course_ids, course_filtered_search, hybrid_search,
+	RETRIEVAL_NPROBE, RETRIEVAL_EF_SEARCH)
+from modules.bm25_index import BM25Index, load_bm25_index
+from modules.context_packing import get_context_packer
+from modules.reranker import get_reranker, RERANK_CANDIDATES
+from modules.ann_index import set_search_defaults
+from modules.mmap_store import load_mmap_db
+from modules.embedder import Embedder, get_embedder
+from modules.llm_client import LLMClient, get_llm_client
 
 
 load_dotenv()
@@ -18,6 +27,14 @@ load_dotenv()
 MOODLE_AUTH_TOKEN: str = os.getenv("MOODLE_AUTH_TOKEN")
 
 VECTOR_DB_DIR = "faiss_index"
+EMBED_MODEL = "BAAI/bge-small-en"
+RETRIEVAL_K = 10
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense") # dense, hybrid to fuse dense and BM25 results, or mongodb to search the embeddings in MongoDB
+RERANK = os.getenv("RERANK", "false").lower() == "true" # over-fetch candidates and rerank them with a cross-encoder
+CONTEXT_PACKING = os.getenv("CONTEXT_PACKING", "true").lower() == "true" # merge, dedupe and trim chunks to the token budget
+
+PROFANITY_RESPONSE = "I'm sorry, I can't respond to that request."
+NO_CONTENT_RESPONSE = "Sorry, I couldn't find relevant information."
 
 #initialize profanity filter
 profanity.load_censor_words()
@@ -35,59 +52,212 @@ QA_PROMPT = PromptTemplate(
 	Answer:"""
 )
 
-def qa_with_retriever(query: str, accessible_courses: list, token: str)-> str:
+def load_vector_db(embeddings: Embedder = None) -> FAISS:
 	"""
-	Retrieves and answers a user query based on accessible course content using a retrieval-based QA chain.
+	Loads the FAISS vector index from disk using the embedding model it was built with. The memory mapped export
+	is opened when there is one, falling back to unpickling the full index.
 
 	Args:
-		query (str): The user's input question
-		accessible_courses (list): A list of course IDs the user has access to.
-		token (str): The users moodle access token.
+		embeddings (Embedder): An already initialised embedding model. The shared embedder is used if not given.
 
 	Returns:
-		str: A markdown-formatted string containing the generated answer and a list of source URLs.
+		FAISS: The loaded FAISS vector store.
 	"""
-	embeddings = HuggingFaceEmbeddings(model_name="BAAI/bge-small-en")
-	db = FAISS.load_local(VECTOR_DB_DIR, embeddings, allow_dangerous_deserialization=True)
+	if embeddings is None:
+		embeddings = get_embedder(EMBED_MODEL)
+	db = load_mmap_db(VECTOR_DB_DIR, embeddings)
+	if db is None:
+		db = FAISS.load_local(VECTOR_DB_DIR, embeddings, allow_dangerous_deserialization=True)
+	set_search_defaults(db.index, RETRIEVAL_NPROBE, RETRIEVAL_EF_SEARCH)
+	return db
 
-	retriever = db.as_retriever(search_type="similarity", search_kwargs={"k": 10})
-	all_docs = retriever.get_relevant_documents(query)
+def load_llm() -> LLMClient:
+	"""
+	Returns the shared client used to generate answers.
 
-	# Filter retrieved documents
-	filtered_docs = [doc for doc in all_docs if any(course in doc.metadata.get("course_id", "") for course in accessible_courses)]
+	Returns:
+		LLMClient: The pooled Ollama client.
+	"""
+	return get_llm_client()
 
-	if not filtered_docs:
-		print("Response: No relevant content found for your accessible courses.")
-		return "Sorry, I couldn't find relevant information."
+def build_prompt(docs: List[Document], query: str) -> str:
+	"""
+	Fills QA_PROMPT with the retrieved documents as context, the same way a LangChain "stuff" chain does.
 
-	llm = Ollama(model="llama3.2:3b")
-	qa_chain = RetrievalQA.from_chain_type(
-		llm=llm,
-		retriever=retriever,  #retriever
-		return_source_documents=True,
-		chain_type_kwargs={"prompt": QA_PROMPT}
-	)
+	Args:
+		docs (List[Document]): The retrieved documents.
+		query (str): The user's input question.
 
-	# pass the filtered documents as `input_documents`
-	response = qa_chain.combine_documents_chain.run(input_documents=filtered_docs, question=query)
+	Returns:
+		str: The prompt to send to the LLM.
+	"""
+	context = "\n\n".join(doc.page_content for doc in docs)
+	return QA_PROMPT.format(context=context, question=query)
 
-	# print unique Moodle sources
-	seen_urls = set(doc.metadata.get("moodle_url", "") for doc in filtered_docs)
+def source_urls(docs: List[Document]) -> List[str]:
+	"""
+	Lists the unique Moodle URLs of the retrieved documents, in retrieval order.
 
-	# format response as markdown
-	formatted_response = f"**Answer:**\n\n{response.strip()}\n\n"
-	formatted_response += "### Moodle Sources:\n"
-	for url in seen_urls:
+	Args:
+		docs (List[Document]): The retrieved documents.
+
+	Returns:
+		List[str]: The Moodle URLs.
+	"""
+	return list(dict.fromkeys(doc.metadata.get("moodle_url", "") for doc in docs))
+
+def format_sources(urls: List[str], token: str) -> str:
+	"""
+	Formats Moodle URLs as a markdown list with the user's token appended.
+
+	Args:
+		urls (List[str]): The Moodle URLs of the retrieved documents.
+		token (str): The users moodle access token.
+
+	Returns:
+		str: The markdown formatted "Moodle Sources" section.
+	"""
+	sources = "### Moodle Sources:\n"
+	for url in urls:
 		if url:
 			# append token
 			if '?' in url:
 				url_with_token = f"{url}&token={token}"
 			else:
 				url_with_token = f"{url}?token={token}"
-			formatted_response += f"- [{url_with_token}]({url_with_token})\n"
+			sources += f"- [{url_with_token}]({url_with_token})\n"
+	return sources
+
+def format_response(answer: str, urls: List[str], token: str) -> str:
+	"""
+	Joins a markdown answer and its Moodle sources into the response sent to the user.
+
+	Args:
+		answer (str): The markdown formatted answer.
+		urls (List[str]): The Moodle URLs of the retrieved documents.
+		token (str): The users moodle access token.
+
+	Returns:
+		str: The markdown formatted response.
+	"""
+	return f"{answer}\n\n{format_sources(urls, token)}"
+
+def retrieve_documents(query: str, accessible_courses: list, db: FAISS = None, course_index: CourseIndex = None, query_vector: List[float] = None,
+		bm25: BM25Index = None) -> List[Document]:
+	"""
+	Retrieves the documents most relevant to a query from the courses the user has access to, optionally
+	reranked with a cross-encoder, and packed into the context token budget.
+
+	Args:
+		query (str): The user's input question
+		accessible_courses (list): A list of course IDs the user has access to, or a comma separated string of them.
+		db (FAISS): A preloaded vector store, loaded from VECTOR_DB_DIR if not given. Not used in mongodb mode.
+		course_index (CourseIndex): A preloaded course index, loaded from VECTOR_DB_DIR if not given.
+		query_vector (List[float]): The embedding of the query, if it has already been embedded.
+		bm25 (BM25Index): A preloaded BM25 index for hybrid retrieval, loaded from VECTOR_DB_DIR if not given.
+
+	Returns:
+		List[Document]: Up to RETRIEVAL_K documents (RERANK_TOP_N when reranking, or the passages packed from them)
+			ordered by similarity, fused rank in hybrid mode, or cross-encoder score.
+	"""
+	# search only the vectors of the user's courses
+	course_ids = parse_course_ids(accessible_courses)
+	k = RERANK_CANDIDATES if RERANK else RETRIEVAL_K
+	if RETRIEVAL_MODE == "mongodb":
+		# imported here so pymongo is only needed in mongodb mode
+		from modules.mongodb_retriever import get_mongodb_retriever
+		if query_vector is None:
+			query_vector = get_embedder(EMBED_MODEL).embed_query(query)
+		docs = get_mongodb_retriever().search(query_vector, course_ids, k)
+	else:
+		if db is None:
+			db = load_vector_db()
+		if course_index is None:
+			course_index = load_course_index(db, VECTOR_DB_DIR)
+		if RETRIEVAL_MODE == "hybrid":
+			if bm25 is None:
+				bm25 = load_bm25_index(db, VECTOR_DB_DIR)
+			docs = hybrid_search(db, course_index, bm25, query, course_ids, k=k, query_vector=query_vector)
+		else:
+			docs = course_filtered_search(db, course_index, query, course_ids, k=k, query_vector=query_vector)
+
+	if RERANK:
+		docs = get_reranker().rerank(query, docs)
+
+	if CONTEXT_PACKING:
+		docs = get_context_packer().pack(docs)
+	return docs
+
+def qa_with_retriever(query: str, accessible_courses: list, token: str, db: FAISS = None, llm: LLMClient = None, course_index: CourseIndex = None,
+		query_vector: List[float] = None, bm25: BM25Index = None)-> str:
+	"""
+	Retrieves and answers a user query based on accessible course content using a retrieval-based QA chain.
+
+	Args:
+		query (str): The user's input question
+		accessible_courses (list): A list of course IDs the user has access to, or a comma separated string of them.
+		token (str): The users moodle access token.
+		db (FAISS): A preloaded vector store, loaded from VECTOR_DB_DIR if not given.
+		llm (LLMClient): A preloaded LLM client, the shared client if not given.
+		course_index (CourseIndex): A preloaded course index, loaded from VECTOR_DB_DIR if not given.
+		query_vector (List[float]): The embedding of the query, if it has already been embedded.
+		bm25 (BM25Index): A preloaded BM25 index for hybrid retrieval, loaded from VECTOR_DB_DIR if not given.
+
+	Returns:
+		str: A markdown-formatted string containing the generated answer and a list of source URLs.
+	"""
+	filtered_docs = retrieve_documents(query, accessible_courses, db, course_index, query_vector, bm25)
+
+	if not filtered_docs:
+		print("Response: No relevant content found for your accessible courses.")
+		return NO_CONTENT_RESPONSE
+
+	if llm is None:
+		llm = load_llm()
+	response = llm.invoke(build_prompt(filtered_docs, query))
+
+	# format response as markdown
+	formatted_response = format_response(f"**Answer:**\n\n{response.strip()}", source_urls(filtered_docs), token)
 	print(formatted_response)
 	return formatted_response  # return Markdown formatted response
 
+async def astream_qa_with_retriever(query: str, accessible_courses: list, token: str, db: FAISS = None, llm: LLMClient = None, course_index: CourseIndex = None, docs: List[Document] = None,
+		query_vector: List[float] = None, bm25: BM25Index = None) -> AsyncIterator[Dict[str, str]]:
+	"""
+	Streaming version of qa_with_retriever. Yields the answer as frames while the LLM generates it, so the
+	first tokens reach the user without waiting for the whole answer. Frames are dictionaries with a "type"
+	of "token" (a piece of the markdown answer) or "sources" (the Moodle sources section, always last).
+
+	Args:
+		query (str): The user's input question
+		accessible_courses (list): A list of course IDs the user has access to, or a comma separated string of them.
+		token (str): The users moodle access token.
+		db (FAISS): A preloaded vector store, loaded from VECTOR_DB_DIR if not given.
+		llm (LLMClient): A preloaded LLM client, the shared client if not given.
+		course_index (CourseIndex): A preloaded course index, loaded from VECTOR_DB_DIR if not given.
+		docs (List[Document]): Already retrieved documents to answer from, retrieved if not given.
+		query_vector (List[float]): The embedding of the query, if it has already been embedded.
+		bm25 (BM25Index): A preloaded BM25 index for hybrid retrieval, loaded from VECTOR_DB_DIR if not given.
+
+	Yields:
+		Dict[str, str]: The response frames, {"type": "token" | "sources", "content": str}.
+	"""
+	# retrieval is blocking, run it off the event loop
+	filtered_docs = docs
+	if filtered_docs is None:
+		filtered_docs = await asyncio.to_thread(retrieve_documents, query, accessible_courses, db, course_index, query_vector, bm25)
+
+	if not filtered_docs:
+		yield {"type": "token", "content": NO_CONTENT_RESPONSE}
+		return
+
+	if llm is None:
+		llm = load_llm()
+	yield {"type": "token", "content": "**Answer:**\n\n"}
+	async for chunk in llm.astream(build_prompt(filtered_docs, query)):
+		yield {"type": "token", "content": chunk}
+	yield {"type": "sources", "content": "\n\n" + format_sources(source_urls(filtered_docs), token)}
+
 #basic profanity filter
 def profanity_filter(query: str) -> bool:
 	"""
@@ -99,26 +269,29 @@ def profanity_filter(query: str) -> bool:
 	Returns:
 		bool: True if profanity is parsed, False otherwise.
 	"""
-	if profanity.contains_profanity(query):
-		print("I'm sorry, I can't respond to that request.")
-		return True
-	return False
+	return profanity.contains_profanity(query)
 
 
 if __name__ == "__main__":
 	query = sys.argv[1]
 	#profanity filtering
 	if profanity_filter(query):
+		print(PROFANITY_RESPONSE)
 		sys.exit(0)
-	#hardcoded response filtering
-	hardcoded_responses = get_hardcoded_responses()
-	lower_query = query.lower().strip()
-	if lower_query in hardcoded_responses:
-		print(f"<p>{hardcoded_responses[lower_query]}</p>")
+	#canned responses for greetings, the date and time, thanks and off-topic queries
+	embeddings = get_embedder(EMBED_MODEL)
+	router = get_intent_router(embeddings)
+	routed_response = router.match_exact(query)
+	query_vector = None
+	if routed_response is None:
+		query_vector = embeddings.embed_query(query)
+		routed_response = router.match_vector(query_vector)
+	if routed_response is not None:
+		print(f"<p>{routed_response}</p>")
 		sys.exit(0)
 	#llm response
 	accessible_courses = sys.argv[2]
 	#accessible_courses = json.loads(base64.b64decode(base64_courses).decode("utf-8"))
 	moodle_token = sys.argv[3]
-	qa_with_retriever(query, accessible_courses, moodle_token)
+	qa_with_retriever(query, accessible_courses, moodle_token, query_vector=query_vector)
 	
\ No newline at end of file
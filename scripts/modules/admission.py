@@ -0,0 +1,219 @@
+import os
+import math
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from typing import Dict, List
+
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32")) # queries waiting for a slot before new ones are shed
+ADMISSION_RATE_LIMIT = float(os.getenv("ADMISSION_RATE_LIMIT", "10")) # queries per minute per user
+ADMISSION_RATE_BURST = int(os.getenv("ADMISSION_RATE_BURST", "5")) # queries a user may send back to back
+ADMISSION_SAMPLES = 1000 # recent wait and service times kept for percentiles
+MAX_TRACKED_USERS = 10000 # rate limit buckets kept before idle ones are dropped
+
+# lower is served first, unknown roles are treated as students
+PRIORITIES = {"teacher": 0, "admin": 0, "student": 1, "bulk": 2}
+DEFAULT_PRIORITY = PRIORITIES["student"]
+
+
+class AdmissionRejected(Exception):
+	"""
+	Raised when a query is not admitted, either because the service is overloaded or the user is over their rate limit.
+	"""
+	def __init__(self, message: str, retry_after: float, rate_limited: bool = False):
+		super().__init__(message)
+		self.retry_after = max(1, math.ceil(retry_after))
+		self.rate_limited = rate_limited
+
+
+class Ticket:
+	"""
+	A query waiting for, or holding, a slot.
+	"""
+	def __init__(self, priority: int):
+		self.priority = priority
+		self.created = time.monotonic()
+		self.admitted = None
+		self.rejected = None
+
+
+class TokenBucket:
+	def __init__(self, rate: float, burst: int):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = float(burst)
+		self.updated = time.monotonic()
+
+	def take(self) -> float:
+		"""
+		Takes a token if one is available.
+
+		Returns:
+			float: 0 if a token was taken, otherwise the seconds until one is available.
+		"""
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens >= 1:
+			self.tokens -= 1
+			return 0.0
+		return (1 - self.tokens) / self.rate
+
+
+def percentile(samples: List[float], q: float) -> float:
+	if not samples:
+		return 0.0
+	ordered = sorted(samples)
+	return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class AdmissionController:
+	"""
+	Decides which queries the RAG service works on. At most max_inflight queries are answered at once and the
+	rest wait in a bounded priority queue, teachers ahead of students ahead of bulk jobs, first come first served
+	within a priority. When the queue is full a new query takes the place of the lowest priority waiting query if
+	it outranks it, otherwise it is shed straight away with an estimate of when to retry, so a burst is answered
+	with fast "busy" responses instead of every query timing out. Each user is also limited to a steady rate of
+	queries with a small burst allowance.
+	"""
+	def __init__(self, max_inflight: int, max_queue: int = ADMISSION_MAX_QUEUE, queue_timeout: float = 30.0,
+			rate_limit: float = ADMISSION_RATE_LIMIT, rate_burst: int = ADMISSION_RATE_BURST):
+		self.max_inflight = max_inflight
+		self.max_queue = max_queue
+		self.queue_timeout = queue_timeout
+		self.rate = rate_limit / 60
+		self.rate_burst = rate_burst
+		self.condition = threading.Condition()
+		self.queue = [] # (priority, sequence, ticket) heap
+		self.sequence = itertools.count()
+		self.inflight = 0
+		self.buckets = {} # user id -> TokenBucket
+		self.queue_waits = deque(maxlen=ADMISSION_SAMPLES)
+		self.service_times = deque(maxlen=ADMISSION_SAMPLES)
+		self.admitted = 0
+		self.shed = 0
+		self.timed_out = 0
+		self.rate_limited = 0
+
+	def estimated_wait(self, position: int) -> float:
+		"""
+		Estimates how long a query at a queue position would wait, from the recent service times.
+
+		Args:
+			position (int): The number of queries ahead of it in the queue.
+
+		Returns:
+			float: The estimated wait in seconds.
+		"""
+		service_time = sum(self.service_times) / len(self.service_times) if self.service_times else 1.0
+		return service_time * (position // self.max_inflight + 1)
+
+	def check_rate(self, user_id: str):
+		if not user_id or self.rate <= 0:
+			return
+		if len(self.buckets) > MAX_TRACKED_USERS:
+			# forget users whose bucket has refilled, they are back to a full burst anyway
+			now = time.monotonic()
+			self.buckets = {user: bucket for user, bucket in self.buckets.items() if (now - bucket.updated) * self.rate < self.rate_burst}
+		bucket = self.buckets.get(user_id)
+		if bucket is None:
+			bucket = self.buckets[user_id] = TokenBucket(self.rate, self.rate_burst)
+		retry_after = bucket.take()
+		if retry_after:
+			self.rate_limited += 1
+			raise AdmissionRejected(f"Too many queries, please retry in {math.ceil(retry_after)}s", retry_after, rate_limited=True)
+
+	def dispatch(self):
+		# hands free slots to the best waiting queries, called with the condition held
+		while self.queue and self.inflight < self.max_inflight:
+			_, _, ticket = heapq.heappop(self.queue)
+			ticket.admitted = time.monotonic()
+			self.inflight += 1
+		self.condition.notify_all()
+
+	def acquire(self, user_id: str = None, role: str = None) -> Ticket:
+		"""
+		Waits for a slot to answer a query.
+
+		Args:
+			user_id (str): The user sending the query, used for the rate limit.
+			role (str): The user's role, e.g. teacher, student or bulk, used for the priority.
+
+		Returns:
+			Ticket: The admitted query, to be passed to release() once it is answered.
+		"""
+		ticket = Ticket(PRIORITIES.get(role, DEFAULT_PRIORITY))
+		with self.condition:
+			self.check_rate(user_id)
+			if len(self.queue) >= self.max_queue:
+				lowest = max(self.queue)
+				if lowest[0] <= ticket.priority:
+					self.shed += 1
+					retry_after = self.estimated_wait(len(self.queue))
+					raise AdmissionRejected(f"Service is busy, please retry in {math.ceil(retry_after)}s", retry_after)
+				# make room by shedding the lowest priority, most recent waiting query
+				self.queue.remove(lowest)
+				heapq.heapify(self.queue)
+				lowest[2].rejected = self.estimated_wait(len(self.queue))
+				self.shed += 1
+
+			heapq.heappush(self.queue, (ticket.priority, next(self.sequence), ticket))
+			self.dispatch()
+			deadline = ticket.created + self.queue_timeout
+			while ticket.admitted is None and ticket.rejected is None:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					self.queue = [entry for entry in self.queue if entry[2] is not ticket]
+					heapq.heapify(self.queue)
+					self.timed_out += 1
+					retry_after = self.estimated_wait(len(self.queue))
+					raise AdmissionRejected(f"Service is busy, please retry in {math.ceil(retry_after)}s", retry_after)
+				self.condition.wait(remaining)
+
+			if ticket.rejected is not None:
+				raise AdmissionRejected(f"Service is busy, please retry in {math.ceil(ticket.rejected)}s", ticket.rejected)
+			self.admitted += 1
+			self.queue_waits.append(ticket.admitted - ticket.created)
+			return ticket
+
+	def release(self, ticket: Ticket):
+		"""
+		Frees the slot of an answered query and records its service time.
+
+		Args:
+			ticket (Ticket): The ticket returned by acquire().
+
+		Returns:
+			None
+		"""
+		with self.condition:
+			self.inflight -= 1
+			self.service_times.append(time.monotonic() - ticket.admitted)
+			self.dispatch()
+
+	def stats(self) -> Dict[str, float]:
+		"""
+		Returns the admission counters.
+
+		Returns:
+			Dict[str, float]: The queue depth and slots in use, the admitted, shed, timed out and rate limited queries,
+				and the queue wait and service time percentiles in seconds, kept separately so time spent queueing
+				can be told apart from time spent answering.
+		"""
+		with self.condition:
+			waits = list(self.queue_waits)
+			service_times = list(self.service_times)
+			return {
+				"queue_depth": len(self.queue),
+				"inflight": self.inflight,
+				"admitted": self.admitted,
+				"shed": self.shed,
+				"timed_out": self.timed_out,
+				"rate_limited": self.rate_limited,
+				"queue_wait_p50": percentile(waits, 0.5),
+				"queue_wait_p95": percentile(waits, 0.95),
+				"service_time_p50": percentile(service_times, 0.5),
+				"service_time_p95": percentile(service_times, 0.95)
+			}
@@ -0,0 +1,164 @@
+import os
+import json
+from typing import Dict, Optional
+import numpy as np
+import faiss
+from numpy.typing import NDArray
+
+ANN_CONFIG_FILE = "ann_index.json"
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# IVF needs this many training points per list for k-means to give balanced lists
+MIN_POINTS_PER_LIST = 39
+TRAIN_SAMPLE_SIZE = 256 * 1024
+
+
+def index_factory_string(index_type: str, nlist: int = 1024, pq_m: int = 16, pq_nbits: int = 8, hnsw_m: int = 32) -> str:
+	"""
+	Returns the faiss index factory description of an index type.
+
+	Args:
+		index_type (str): One of INDEX_TYPES.
+		nlist (int): The number of IVF lists (clusters).
+		pq_m (int): The number of PQ sub-quantizers, which must divide the vector dimension.
+		pq_nbits (int): The number of bits per PQ sub-quantizer code.
+		hnsw_m (int): The number of neighbours of each HNSW node.
+
+	Returns:
+		str: The index factory description.
+	"""
+	if index_type == "flat":
+		return "Flat"
+	if index_type == "ivf_flat":
+		return f"IVF{nlist},Flat"
+	if index_type == "ivf_pq":
+		return f"IVF{nlist},PQ{pq_m}x{pq_nbits}"
+	if index_type == "hnsw":
+		return f"HNSW{hnsw_m},Flat"
+	raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+
+def build_ann_index(vectors: NDArray[np.float32], index_type: str, nlist: int = 1024, pq_m: int = 16, pq_nbits: int = 8,
+		hnsw_m: int = 32, ef_construction: int = 200) -> faiss.Index:
+	"""
+	Builds an index of the given type over a set of vectors, training it first if it needs training. The vectors
+	keep their row number as their ID, so the index can replace a flat index without changing the docstore mapping.
+	IVF indexes use fewer lists when there are too few vectors to train nlist lists.
+
+	Args:
+		vectors (NDArray[np.float32]): The vectors to index, one per row.
+		index_type (str): One of INDEX_TYPES.
+		nlist (int): The number of IVF lists.
+		pq_m (int): The number of PQ sub-quantizers.
+		pq_nbits (int): The number of bits per PQ sub-quantizer code.
+		hnsw_m (int): The number of neighbours of each HNSW node.
+		ef_construction (int): The HNSW candidate list size while building, higher builds a better graph more slowly.
+
+	Returns:
+		faiss.Index: The trained index containing the vectors.
+	"""
+	vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+	if index_type in ("ivf_flat", "ivf_pq"):
+		nlist = max(1, min(nlist, len(vectors) // MIN_POINTS_PER_LIST))
+	if index_type == "ivf_pq" and len(vectors) < 2 ** pq_nbits:
+		raise ValueError(f"IVF-PQ needs at least {2 ** pq_nbits} vectors to train, only {len(vectors)} are indexed")
+
+	index = faiss.index_factory(vectors.shape[1], index_factory_string(index_type, nlist, pq_m, pq_nbits, hnsw_m))
+	if index_type == "hnsw":
+		index.hnsw.efConstruction = ef_construction
+	if not index.is_trained:
+		sample = vectors
+		if len(vectors) > TRAIN_SAMPLE_SIZE:
+			sample = vectors[np.random.default_rng(0).choice(len(vectors), TRAIN_SAMPLE_SIZE, replace=False)]
+		index.train(sample)
+	index.add(vectors)
+	return index
+
+def index_type_of(index: faiss.Index) -> str:
+	"""
+	Works out which of INDEX_TYPES an index is.
+
+	Args:
+		index (faiss.Index): The index.
+
+	Returns:
+		str: The index type.
+	"""
+	index = faiss.downcast_index(index)
+	if isinstance(index, faiss.IndexIVFPQ):
+		return "ivf_pq"
+	if isinstance(index, faiss.IndexIVF):
+		return "ivf_flat"
+	if isinstance(index, faiss.IndexHNSW):
+		return "hnsw"
+	return "flat"
+
+def search_parameters(index: faiss.Index, selector: faiss.IDSelector = None, nprobe: int = 16, ef_search: int = 64) -> faiss.SearchParameters:
+	"""
+	Builds the search parameters of a query for the type of the index.
+
+	Args:
+		index (faiss.Index): The index being searched.
+		selector (faiss.IDSelector): Restricts the search to the selected vector IDs.
+		nprobe (int): The number of IVF lists searched, higher is more accurate and slower.
+		ef_search (int): The HNSW candidate list size, higher is more accurate and slower.
+
+	Returns:
+		faiss.SearchParameters: The search parameters.
+	"""
+	index_type = index_type_of(index)
+	if index_type in ("ivf_flat", "ivf_pq"):
+		return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+	if index_type == "hnsw":
+		return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+	return faiss.SearchParameters(sel=selector)
+
+def set_search_defaults(index: faiss.Index, nprobe: int = 16, ef_search: int = 64):
+	"""
+	Sets the accuracy parameters used by searches that don't pass search parameters, such as LangChain's.
+
+	Args:
+		index (faiss.Index): The index.
+		nprobe (int): The number of IVF lists searched.
+		ef_search (int): The HNSW candidate list size.
+
+	Returns:
+		None
+	"""
+	index = faiss.downcast_index(index)
+	if isinstance(index, faiss.IndexIVF):
+		index.nprobe = nprobe
+	elif isinstance(index, faiss.IndexHNSW):
+		index.hnsw.efSearch = ef_search
+
+def load_ann_config(index_dir: str) -> Optional[Dict]:
+	"""
+	Loads the settings the index in a directory was last built with.
+
+	Args:
+		index_dir (str): The FAISS index directory.
+
+	Returns:
+		Dict: The index type, its parameters and the number of vectors it was trained on, or None if the index has
+			never been rebuilt.
+	"""
+	path = os.path.join(index_dir, ANN_CONFIG_FILE)
+	if os.path.exists(path):
+		with open(path, "r") as f:
+			return json.load(f)
+	return None
+
+def save_ann_config(index_dir: str, config: Dict):
+	"""
+	Records the settings an index was built with.
+
+	Args:
+		index_dir (str): The FAISS index directory.
+		config (Dict): The index type, its parameters and the number of vectors it was trained on.
+
+	Returns:
+		None
+	"""
+	path = os.path.join(index_dir, ANN_CONFIG_FILE)
+	with open(f"{path}.tmp", "w") as f:
+		json.dump(config, f, indent=4)
+	os.replace(f"{path}.tmp", path)
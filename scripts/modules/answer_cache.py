@@ -0,0 +1,190 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Set, Tuple, Optional
+import numpy as np
+from numpy.typing import NDArray
+
+INDEX_VERSION_FILE = "index_version"
+
+
+def write_index_version(index_dir: str) -> str:
+	"""
+	Records a new version for the index in the given directory. Called whenever the index is changed so
+	anything derived from the old index (such as cached answers) can be invalidated.
+
+	Args:
+		index_dir (str): The FAISS index directory.
+
+	Returns:
+		str: The new index version.
+	"""
+	version = str(time.time_ns())
+	with open(os.path.join(index_dir, INDEX_VERSION_FILE), "w") as f:
+		f.write(version)
+	return version
+
+def read_index_version(index_dir: str) -> str:
+	"""
+	Reads the current version of the index in the given directory.
+
+	Args:
+		index_dir (str): The FAISS index directory.
+
+	Returns:
+		str: The index version, or an empty string if the index has never been versioned.
+	"""
+	path = os.path.join(index_dir, INDEX_VERSION_FILE)
+	if not os.path.exists(path):
+		return ""
+	with open(path, "r") as f:
+		return f.read().strip()
+
+
+class CachedAnswer:
+	"""
+	An answer generated for a query, stored without the user's Moodle token so it can be
+	returned to any user with the same courses.
+	"""
+	def __init__(self, query_vector: NDArray[np.float32], answer: str, source_urls: List[str], ttl: float):
+		self.query_vector = query_vector
+		self.answer = answer
+		self.source_urls = source_urls
+		self.expires_at = time.monotonic() + ttl
+		self.size = query_vector.nbytes + len(answer.encode("utf-8")) + sum(len(url) for url in source_urls)
+
+
+class SemanticAnswerCache:
+	"""
+	A cache of generated answers keyed on the query embedding, the set of courses searched and the
+	index version. A lookup returns a cached answer when a previous query for the same courses and
+	index version has a cosine similarity of at least the threshold. Entries are evicted least
+	recently used first once the entry or memory limit is reached, and expire after the TTL.
+	"""
+	def __init__(self, threshold: float = 0.95, max_entries: int = 1000, ttl: float = 3600, max_bytes: int = 64 * 1024 * 1024):
+		self.threshold = threshold
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict() # entry id -> CachedAnswer, least recently used first
+		self.buckets = {} # (courses, index version) -> list of entry ids
+		self.entry_buckets = {} # entry id -> (courses, index version)
+		self.size = 0
+		self.next_id = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def bucket_key(course_ids: Set[int], index_version: str) -> Tuple[Tuple[int, ...], str]:
+		return tuple(sorted(course_ids)), index_version
+
+	@staticmethod
+	def normalise(query_vector) -> NDArray[np.float32]:
+		vector = np.asarray(query_vector, dtype=np.float32)
+		norm = np.linalg.norm(vector)
+		return vector / norm if norm else vector
+
+	def lookup(self, query_vector, course_ids: Set[int], index_version: str) -> Optional[CachedAnswer]:
+		"""
+		Finds a cached answer for a query similar to the given one.
+
+		Args:
+			query_vector: The embedding of the user's query.
+			course_ids (Set[int]): The course IDs the query searches.
+			index_version (str): The version of the index the query searches.
+
+		Returns:
+			CachedAnswer: The most similar cached answer above the threshold, or None on a miss.
+		"""
+		vector = self.normalise(query_vector)
+		with self.lock:
+			bucket = list(self.buckets.get(self.bucket_key(course_ids, index_version), []))
+			entry_ids = [entry_id for entry_id in bucket if not self.expire(entry_id)]
+			if entry_ids:
+				similarities = np.stack([self.entries[entry_id].query_vector for entry_id in entry_ids]) @ vector
+				best = int(np.argmax(similarities))
+				if similarities[best] >= self.threshold:
+					self.hits += 1
+					self.entries.move_to_end(entry_ids[best])
+					return self.entries[entry_ids[best]]
+			self.misses += 1
+			return None
+
+	def store(self, query_vector, course_ids: Set[int], index_version: str, answer: str, source_urls: List[str]):
+		"""
+		Caches the answer generated for a query.
+
+		Args:
+			query_vector: The embedding of the user's query.
+			course_ids (Set[int]): The course IDs the query searched.
+			index_version (str): The version of the index the query searched.
+			answer (str): The generated answer, without the Moodle sources section.
+			source_urls (List[str]): The Moodle URLs of the documents the answer was generated from.
+
+		Returns:
+			None
+		"""
+		entry = CachedAnswer(self.normalise(query_vector), answer, source_urls, self.ttl)
+		if entry.size > self.max_bytes:
+			return
+		with self.lock:
+			entry_id = self.next_id
+			self.next_id += 1
+			key = self.bucket_key(course_ids, index_version)
+			self.entries[entry_id] = entry
+			self.buckets.setdefault(key, []).append(entry_id)
+			self.entry_buckets[entry_id] = key
+			self.size += entry.size
+
+			# evict least recently used entries until back under the limits
+			while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+				self.remove(next(iter(self.entries)))
+
+	def clear(self):
+		"""
+		Removes every cached answer, e.g. when the index has changed.
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			self.entries.clear()
+			self.buckets.clear()
+			self.entry_buckets.clear()
+			self.size = 0
+
+	def stats(self) -> Dict[str, float]:
+		"""
+		Returns the cache counters used to tune the similarity threshold.
+
+		Returns:
+			Dict[str, float]: The hits, misses, hit rate, number of entries and memory used.
+		"""
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"hit_rate": self.hits / lookups if lookups else 0.0,
+				"entries": len(self.entries),
+				"bytes": self.size,
+				"threshold": self.threshold
+			}
+
+	def expire(self, entry_id: int) -> bool:
+		# must be called with the lock held
+		if self.entries[entry_id].expires_at > time.monotonic():
+			return False
+		self.remove(entry_id)
+		return True
+
+	def remove(self, entry_id: int):
+		# must be called with the lock held
+		entry = self.entries.pop(entry_id)
+		key = self.entry_buckets.pop(entry_id)
+		self.buckets[key].remove(entry_id)
+		if not self.buckets[key]:
+			del self.buckets[key]
+		self.size -= entry.size
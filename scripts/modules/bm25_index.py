@@ -0,0 +1,210 @@
+import os
+import re
+import json
+from typing import List, Dict, Tuple, Optional
+import numpy as np
+from langchain.vectorstores import FAISS
+
+BM25_VOCAB_FILE = "bm25_vocab.json"
+BM25_OFFSETS_FILE = "bm25_offsets.npy"
+BM25_DOC_IDS_FILE = "bm25_doc_ids.npy"
+BM25_FREQS_FILE = "bm25_freqs.npy"
+BM25_DOC_LENGTHS_FILE = "bm25_doc_lengths.npy"
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# keeps dotted and hyphenated tokens whole, e.g. 192.168.0.1, 802.11 or show-running-config
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-:/][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+	"""
+	Splits text into lowercase terms for the sparse index.
+
+	Args:
+		text (str): The text to split.
+
+	Returns:
+		List[str]: The terms, in order.
+	"""
+	return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+	"""
+	A BM25 inverted index over the chunks in the FAISS index, keyed by FAISS vector ID so the course bitmaps
+	filter both indexes the same way. The postings are stored as CSR arrays (a term's document IDs and term
+	frequencies are one slice each), which are memory mapped at query time. New chunks are buffered by add()
+	and merged into the arrays when the index is saved, so ingest can grow the index incrementally.
+	"""
+	def __init__(self, vocab: Dict[str, int], offsets: np.ndarray, doc_ids: np.ndarray, freqs: np.ndarray, doc_lengths: np.ndarray):
+		self.vocab = vocab
+		self.offsets = offsets
+		self.doc_ids = doc_ids
+		self.freqs = freqs
+		self.doc_lengths = doc_lengths
+		self.pending = [] # (term id, doc id, frequency) of chunks added since the last save
+		self.pending_lengths = []
+
+	@property
+	def ntotal(self) -> int:
+		return len(self.doc_lengths) + len(self.pending_lengths)
+
+	@classmethod
+	def empty(cls) -> "BM25Index":
+		return cls({}, np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32))
+
+	@classmethod
+	def from_db(cls, db: FAISS) -> "BM25Index":
+		"""
+		Builds the sparse index from the text of every document in a FAISS store.
+
+		Args:
+			db (FAISS): The FAISS vector store.
+
+		Returns:
+			BM25Index: The sparse index of the store.
+		"""
+		bm25 = cls.empty()
+		for faiss_id in range(db.index.ntotal):
+			bm25.add(faiss_id, db.docstore.search(db.index_to_docstore_id[faiss_id]).page_content)
+		bm25.merge()
+		return bm25
+
+	def add(self, doc_id: int, text: str):
+		"""
+		Adds a chunk to the index. Chunks must be added in FAISS vector ID order.
+
+		Args:
+			doc_id (int): The FAISS vector ID of the chunk.
+			text (str): The text of the chunk.
+
+		Returns:
+			None
+		"""
+		if doc_id != self.ntotal:
+			raise ValueError(f"Expected chunk {self.ntotal} to be added next, got {doc_id}")
+		terms = tokenize(text)
+		counts = {}
+		for term in terms:
+			term_id = self.vocab.setdefault(term, len(self.vocab))
+			counts[term_id] = counts.get(term_id, 0) + 1
+		self.pending.extend((term_id, doc_id, count) for term_id, count in counts.items())
+		self.pending_lengths.append(len(terms))
+
+	def merge(self):
+		"""
+		Merges the buffered chunks into the posting arrays.
+
+		Returns:
+			None
+		"""
+		if not self.pending_lengths:
+			return
+		new = np.array(self.pending, dtype=np.int64).reshape(-1, 3)
+		term_ids = np.concatenate([np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets)), new[:, 0]])
+		doc_ids = np.concatenate([self.doc_ids, new[:, 1]])
+		freqs = np.concatenate([self.freqs, new[:, 2]])
+
+		# a stable sort by term keeps each term's postings in document order, as new chunks have the highest IDs
+		order = np.argsort(term_ids, kind="stable")
+		self.offsets = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(self.vocab)))]).astype(np.int64)
+		self.doc_ids = doc_ids[order].astype(np.int32)
+		self.freqs = freqs[order].astype(np.int32)
+		self.doc_lengths = np.concatenate([self.doc_lengths, self.pending_lengths]).astype(np.int32)
+		self.pending = []
+		self.pending_lengths = []
+
+	def save(self, index_dir: str):
+		"""
+		Saves the index alongside the FAISS index files, merging any buffered chunks first.
+
+		Args:
+			index_dir (str): The FAISS index directory.
+
+		Returns:
+			None
+		"""
+		self.merge()
+		arrays = {BM25_OFFSETS_FILE: self.offsets, BM25_DOC_IDS_FILE: self.doc_ids, BM25_FREQS_FILE: self.freqs, BM25_DOC_LENGTHS_FILE: self.doc_lengths}
+		paths = [os.path.join(index_dir, name) for name in (BM25_VOCAB_FILE, *arrays)]
+		with open(f"{paths[0]}.tmp", "w") as f:
+			json.dump(self.vocab, f)
+		for path, array in zip(paths[1:], arrays.values()):
+			with open(f"{path}.tmp", "wb") as f:
+				np.save(f, array)
+		for path in paths:
+			os.replace(f"{path}.tmp", path)
+
+	@classmethod
+	def load(cls, index_dir: str) -> Optional["BM25Index"]:
+		"""
+		Loads an index saved by save(), memory mapping the posting arrays.
+
+		Args:
+			index_dir (str): The FAISS index directory.
+
+		Returns:
+			BM25Index: The sparse index, or None if the index directory has no sparse index.
+		"""
+		vocab_path = os.path.join(index_dir, BM25_VOCAB_FILE)
+		if not os.path.exists(vocab_path):
+			return None
+		with open(vocab_path, "r") as f:
+			vocab = json.load(f)
+		arrays = [np.load(os.path.join(index_dir, name), mmap_mode="r") for name in (BM25_OFFSETS_FILE, BM25_DOC_IDS_FILE, BM25_FREQS_FILE, BM25_DOC_LENGTHS_FILE)]
+		return cls(vocab, *arrays)
+
+	def search(self, query: str, k: int, allowed: np.ndarray = None) -> List[Tuple[int, float]]:
+		"""
+		Scores the chunks containing the query terms with BM25.
+
+		Args:
+			query (str): The user's input question.
+			k (int): The number of chunks to return.
+			allowed (np.ndarray): A packed little-endian bitmap of the vector IDs that may be returned, as built by
+				CourseIndex.bitmap. Every chunk may be returned if not given.
+
+		Returns:
+			List[Tuple[int, float]]: Up to k (vector ID, score) pairs, highest score first.
+		"""
+		term_ids = {self.vocab[term] for term in tokenize(query) if term in self.vocab}
+		if not term_ids or not len(self.doc_lengths):
+			return []
+		average_length = float(np.mean(self.doc_lengths))
+
+		doc_ids = []
+		scores = []
+		for term_id in term_ids:
+			docs = np.asarray(self.doc_ids[self.offsets[term_id]:self.offsets[term_id + 1]], dtype=np.int64)
+			freqs = np.asarray(self.freqs[self.offsets[term_id]:self.offsets[term_id + 1]], dtype=np.float32)
+			idf = np.log(1 + (len(self.doc_lengths) - len(docs) + 0.5) / (len(docs) + 0.5))
+			if allowed is not None:
+				keep = ((allowed[docs >> 3] >> (docs & 7)) & 1).astype(bool)
+				docs, freqs = docs[keep], freqs[keep]
+			lengths = self.doc_lengths[docs] / average_length
+			doc_ids.append(docs)
+			scores.append(idf * freqs * (BM25_K1 + 1) / (freqs + BM25_K1 * (1 - BM25_B + BM25_B * lengths)))
+
+		docs, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+		totals = np.bincount(inverse, weights=np.concatenate(scores))
+		top = np.argsort(-totals, kind="stable")[:k]
+		return [(int(docs[i]), float(totals[i])) for i in top]
+
+
+def load_bm25_index(db: FAISS, index_dir: str) -> BM25Index:
+	"""
+	Loads the sparse index built at ingest time, rebuilding it from the docstore when it is missing or out of
+	date with the FAISS index.
+
+	Args:
+		db (FAISS): The loaded FAISS vector store.
+		index_dir (str): The FAISS index directory.
+
+	Returns:
+		BM25Index: The sparse index of the store.
+	"""
+	bm25 = BM25Index.load(index_dir)
+	if bm25 is None or bm25.ntotal != db.index.ntotal:
+		bm25 = BM25Index.from_db(db)
+	return bm25
@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from typing import List, Dict
+import numpy as np
+from numpy.typing import NDArray
+
+VECTORS_FILE = "vectors.f32"
+KEYS_FILE = "keys.txt"
+META_FILE = "meta.json"
+
+
+def chunk_hash(text: str) -> str:
+	"""
+	Hashes the normalised text of a chunk, so chunks that only differ in whitespace share a hash.
+
+	Args:
+		text (str): The text of the chunk.
+
+	Returns:
+		str: A charset of hexidecimal digits representing the hashed value.
+	"""
+	normalised = re.sub(r"\s+", " ", text).strip()
+	return hashlib.blake2b(normalised.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ChunkEmbeddingCache:
+	"""
+	A persistent cache of chunk hashes to embedding vectors. Vectors are appended to a flat float32 file that
+	is read through a memory map, and the hashes are appended to a text file in the same row order, so
+	opening the cache doesn't load the vectors into memory and adding to it never rewrites existing rows.
+	"""
+	def __init__(self, cache_dir: str, model_name: str):
+		self.cache_dir = cache_dir
+		self.model_name = model_name
+		self.vectors_path = os.path.join(cache_dir, VECTORS_FILE)
+		self.keys_path = os.path.join(cache_dir, KEYS_FILE)
+		self.meta_path = os.path.join(cache_dir, META_FILE)
+		self.lock = threading.Lock()
+		self.rows = {} # chunk hash -> row in the vectors file
+		self.dim = None
+		self.vectors = None
+		os.makedirs(cache_dir, exist_ok=True)
+		self.load()
+
+	def load(self):
+		"""
+		Opens the cache files, discarding them if they were written by a different embedding model.
+
+		Returns:
+			None
+		"""
+		meta = {}
+		if os.path.exists(self.meta_path):
+			with open(self.meta_path, "r") as f:
+				meta = json.load(f)
+		if meta.get("model") != self.model_name:
+			for path in (self.vectors_path, self.keys_path):
+				if os.path.exists(path):
+					os.remove(path)
+			with open(self.meta_path, "w") as f:
+				json.dump({"model": self.model_name, "dim": None}, f)
+			return
+
+		self.dim = meta.get("dim")
+		if not self.dim or not os.path.exists(self.keys_path) or not os.path.exists(self.vectors_path):
+			return
+		with open(self.keys_path, "r") as f:
+			keys = f.read().split()
+
+		# a crash between writing a vector and its hash leaves extra vectors at the end, drop them
+		row_count = min(len(keys), os.path.getsize(self.vectors_path) // (self.dim * 4))
+		with open(self.vectors_path, "r+b") as f:
+			f.truncate(row_count * self.dim * 4)
+		self.rows = {key: row for row, key in enumerate(keys[:row_count])}
+		self.map_vectors()
+
+	def map_vectors(self):
+		# must be called with the lock held (or before the cache is shared)
+		if self.rows:
+			self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.rows), self.dim))
+
+	def get_many(self, hashes: List[str]) -> Dict[str, NDArray[np.float32]]:
+		"""
+		Looks up the cached vectors of the given chunk hashes.
+
+		Args:
+			hashes (List[str]): The chunk hashes to look up.
+
+		Returns:
+			Dict[str, NDArray[np.float32]]: The vectors of the hashes found in the cache.
+		"""
+		with self.lock:
+			return {key: np.array(self.vectors[self.rows[key]]) for key in hashes if key in self.rows}
+
+	def put_many(self, hashes: List[str], vectors: List[List[float]]):
+		"""
+		Adds the vectors of newly embedded chunks to the cache.
+
+		Args:
+			hashes (List[str]): The chunk hashes.
+			vectors (List[List[float]]): The embedding vectors of the chunks, in the same order.
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			new = {}
+			for key, vector in zip(hashes, vectors):
+				if key not in self.rows and key not in new:
+					new[key] = vector
+			if not new:
+				return
+			matrix = np.asarray(list(new.values()), dtype=np.float32)
+			if self.dim is None:
+				self.dim = matrix.shape[1]
+				with open(self.meta_path, "w") as f:
+					json.dump({"model": self.model_name, "dim": self.dim}, f)
+
+			# vectors first, so a hash is only ever written once its vector is on disk
+			with open(self.vectors_path, "ab") as f:
+				f.write(matrix.tobytes())
+			with open(self.keys_path, "a") as f:
+				f.write("".join(f"{key}\n" for key in new))
+			for key in new:
+				self.rows[key] = len(self.rows)
+			self.map_vectors()
+
+	def __len__(self) -> int:
+		return len(self.rows)
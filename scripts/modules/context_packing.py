@@ -0,0 +1,210 @@
+import os
+import re
+import logging
+import threading
+from typing import List, Dict, Set, Tuple
+from langchain.docstore.document import Document
+
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "unsloth/Llama-3.2-3B-Instruct") # tokenizer of the answering model, an ungated copy of meta-llama's
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500")) # tokens of retrieved text sent to the LLM
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_NEAR_DUPLICATE_THRESHOLD", "0.8")) # shingle overlap above which a passage is dropped
+MIN_TRUNCATED_TOKENS = 64 # smallest tail of a passage worth including when it doesn't fit whole
+SHINGLE_SIZE = 5
+CHARS_PER_TOKEN = 4 # estimate used when the tokenizer can't be loaded
+
+_packer = None
+_packer_lock = threading.Lock()
+
+
+class Passage:
+	"""
+	A span of a source file built from one or more retrieved chunks, ranked by its best ranked chunk.
+	"""
+	def __init__(self, doc: Document, rank: int):
+		self.metadata = dict(doc.metadata)
+		self.text = doc.page_content
+		self.rank = rank
+		self.start = doc.metadata.get("start_index")
+		self.end = self.start + len(self.text) if self.start is not None else None
+
+	def merge(self, other: "Passage") -> bool:
+		"""
+		Extends this passage with a chunk from the same source that overlaps or directly follows it. Chunks whose
+		overlapping text differs (e.g. start indexes from different versions of the file) are not merged.
+
+		Args:
+			other (Passage): A passage starting at or after this one.
+
+		Returns:
+			bool: True if the passages were merged, False if they don't touch or their overlap doesn't match.
+		"""
+		if self.end is None or other.start is None or other.start > self.end:
+			return False
+		offset = other.start - self.start
+		overlap = min(self.end, other.end) - other.start
+		if self.text[offset:offset + overlap] != other.text[:overlap]:
+			return False
+		if other.end > self.end:
+			self.text += other.text[self.end - other.start:]
+			self.end = other.end
+		self.rank = min(self.rank, other.rank)
+		return True
+
+	def shingles(self) -> Set[Tuple[str, ...]]:
+		words = re.findall(r"\w+", self.text.lower())
+		return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+
+	def document(self) -> Document:
+		metadata = dict(self.metadata)
+		if self.start is not None:
+			metadata["start_index"] = self.start
+		return Document(page_content=self.text, metadata=metadata)
+
+
+class ContextPacker:
+	"""
+	Packs retrieved chunks into the LLM context. Chunks that overlap or follow each other in the same source are
+	merged into one passage so the overlap is only sent once, passages that are near-duplicates of a better ranked
+	passage (e.g. the same slides uploaded to two courses) are dropped, and the remaining passages are added in
+	relevance order until the token budget, measured with the answering model's tokenizer, is used up.
+	"""
+	def __init__(self, tokenizer_name: str = CONTEXT_TOKENIZER, budget: int = CONTEXT_TOKEN_BUDGET, threshold: float = NEAR_DUPLICATE_THRESHOLD):
+		self.budget = budget
+		self.threshold = threshold
+		self.tokenizer = None
+		self.estimated = True # token counts are estimated from characters until the tokenizer loads
+		try:
+			from transformers import AutoTokenizer
+			self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+			self.estimated = False
+		except Exception as e:
+			logging.warning(f"Could not load the {tokenizer_name} tokenizer, estimating tokens from characters: {e}")
+		self.queries = 0
+		self.tokens_before = 0
+		self.tokens_after = 0
+		self.lock = threading.Lock()
+
+	def count_tokens(self, text: str) -> int:
+		if self.tokenizer is None:
+			return len(text) // CHARS_PER_TOKEN + 1
+		return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+	def truncate(self, text: str, tokens: int) -> str:
+		if self.tokenizer is None:
+			return text[:tokens * CHARS_PER_TOKEN]
+		return self.tokenizer.decode(self.tokenizer.encode(text, add_special_tokens=False)[:tokens])
+
+	def merge_neighbours(self, docs: List[Document]) -> List[Passage]:
+		"""
+		Merges the chunks of each source that overlap or follow each other.
+
+		Args:
+			docs (List[Document]): The retrieved chunks, most relevant first.
+
+		Returns:
+			List[Passage]: The passages, most relevant first.
+		"""
+		by_source = {}
+		for rank, doc in enumerate(docs):
+			passage = Passage(doc, rank)
+			by_source.setdefault(doc.metadata.get("moodle_url") or doc.metadata.get("source"), []).append(passage)
+
+		passages = []
+		for source_passages in by_source.values():
+			source_passages.sort(key=lambda passage: (passage.start is None, passage.start or 0))
+			current = source_passages[0]
+			for passage in source_passages[1:]:
+				if not current.merge(passage):
+					passages.append(current)
+					current = passage
+			passages.append(current)
+		return sorted(passages, key=lambda passage: passage.rank)
+
+	def drop_near_duplicates(self, passages: List[Passage]) -> List[Passage]:
+		"""
+		Drops passages whose word shingles mostly appear in a better ranked passage.
+
+		Args:
+			passages (List[Passage]): The passages, most relevant first.
+
+		Returns:
+			List[Passage]: The distinct passages, most relevant first.
+		"""
+		kept = []
+		kept_shingles = []
+		for passage in passages:
+			shingles = passage.shingles()
+			if any(len(shingles & other) >= self.threshold * min(len(shingles), len(other)) for other in kept_shingles):
+				continue
+			kept.append(passage)
+			kept_shingles.append(shingles)
+		return kept
+
+	def pack(self, docs: List[Document]) -> List[Document]:
+		"""
+		Packs retrieved chunks into at most the token budget and logs the tokens saved.
+
+		Args:
+			docs (List[Document]): The retrieved chunks, most relevant first.
+
+		Returns:
+			List[Document]: The passages to send to the LLM, most relevant first.
+		"""
+		if not docs:
+			return docs
+		tokens_before = self.count_tokens("\n\n".join(doc.page_content for doc in docs))
+
+		packed = []
+		used = 0
+		for passage in self.drop_near_duplicates(self.merge_neighbours(docs)):
+			tokens = self.count_tokens(passage.text)
+			if used + tokens > self.budget:
+				# fill the rest of the budget with the start of the passage if enough of it fits
+				remaining = self.budget - used
+				if remaining >= MIN_TRUNCATED_TOKENS:
+					passage.text = self.truncate(passage.text, remaining)
+					packed.append(passage.document())
+				break
+			packed.append(passage.document())
+			used += tokens
+
+		tokens_after = self.count_tokens("\n\n".join(doc.page_content for doc in packed))
+		with self.lock:
+			self.queries += 1
+			self.tokens_before += tokens_before
+			self.tokens_after += tokens_after
+		logging.info(f"Context packing: {len(docs)} chunks -> {len(packed)} passages, {tokens_before} -> {tokens_after} tokens "
+			f"({tokens_before - tokens_after} saved).")
+		return packed
+
+	def stats(self) -> Dict[str, float]:
+		"""
+		Returns the packing counters.
+
+		Returns:
+			Dict[str, float]: The number of queries packed, the tokens before and after packing, the average saved per query
+				and whether the token counts are 'estimated' from characters because the tokenizer couldn't be loaded.
+		"""
+		with self.lock:
+			return {
+				"queries": self.queries,
+				"tokens_before": self.tokens_before,
+				"tokens_after": self.tokens_after,
+				"tokens_saved_per_query": (self.tokens_before - self.tokens_after) / self.queries if self.queries else 0.0,
+				"budget": self.budget,
+				"estimated": self.estimated
+			}
+
+
+def get_context_packer() -> ContextPacker:
+	"""
+	Returns the process-wide context packer, loading the tokenizer the first time.
+
+	Returns:
+		ContextPacker: The shared context packer.
+	"""
+	global _packer
+	with _packer_lock:
+		if _packer is None:
+			_packer = ContextPacker()
+		return _packer
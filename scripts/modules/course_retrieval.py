@@ -0,0 +1,370 @@
+import os
+import json
+from typing import List, Dict, Set, Optional
+import numpy as np
+import faiss
+from langchain.vectorstores import FAISS
+from langchain.docstore.document import Document
+from modules.ann_index import search_parameters, index_type_of
+from modules.bm25_index import BM25Index
+
+COURSE_INDEX_FILE = "course_index.npz"
+RETRIEVAL_NPROBE = int(os.getenv("RETRIEVAL_NPROBE", "16")) # IVF lists searched per query
+RETRIEVAL_EF_SEARCH = int(os.getenv("RETRIEVAL_EF_SEARCH", "64")) # HNSW candidate list size per query
+RETRIEVAL_EXACT_LIMIT = int(os.getenv("RETRIEVAL_EXACT_LIMIT", "4096")) # allowed vectors at or below which a filtered search is exact
+RETRIEVAL_WIDEN_STEPS = 3 # times a filtered search that comes back short is repeated with 4x the nprobe or efSearch
+HYBRID_CANDIDATES = int(os.getenv("RETRIEVAL_HYBRID_CANDIDATES", "50")) # candidates from each index before fusion
+RRF_K = 60
+
+
+def parse_course_id(value) -> Optional[int]:
+	"""
+	Converts a single course ID to an integer.
+
+	Args:
+		value: A course ID as an int or a string (e.g. 12, "12" or " 12 ").
+
+	Returns:
+		int: The course ID, or None if the value is not a valid course ID.
+	"""
+	try:
+		return int(str(value).strip())
+	except ValueError:
+		return None
+
+def parse_course_ids(accessible_courses) -> Set[int]:
+	"""
+	Parses the courses a user can access into a set of integer course IDs. Accepts a list of IDs,
+	a comma separated string (as passed on the command line) or a JSON array string.
+
+	Args:
+		accessible_courses: The course IDs the user has access to.
+
+	Returns:
+		Set[int]: The valid course IDs.
+	"""
+	if accessible_courses is None:
+		return set()
+	if isinstance(accessible_courses, str):
+		try:
+			accessible_courses = json.loads(accessible_courses)
+		except json.JSONDecodeError:
+			accessible_courses = accessible_courses.split(",")
+		if not isinstance(accessible_courses, list):
+			accessible_courses = [accessible_courses]
+	course_ids = (parse_course_id(course) for course in accessible_courses)
+	return {course_id for course_id in course_ids if course_id is not None}
+
+def document_course_ids(doc: Document) -> Set[int]:
+	"""
+	Returns the courses a document belongs to. A chunk shared by several courses lists them all in its
+	"course_ids" metadata (empty once the chunk has been deleted), older documents only have a single "course_id".
+
+	Args:
+		doc (Document): The document.
+
+	Returns:
+		Set[int]: The valid course IDs of the document.
+	"""
+	if "course_ids" in doc.metadata:
+		return parse_course_ids(doc.metadata["course_ids"])
+	return parse_course_ids([doc.metadata.get("course_id")])
+
+def document_course_urls(doc: Document) -> Dict[int, str]:
+	"""
+	Returns the Moodle URL of a document's file in each of its courses. A chunk shared by several files has a URL
+	per file, older documents only have their single "moodle_url".
+
+	Args:
+		doc (Document): The document.
+
+	Returns:
+		Dict[int, str]: A dictionary of course IDs to Moodle URLs.
+	"""
+	if "course_urls" in doc.metadata:
+		return doc.metadata["course_urls"]
+	urls = doc.metadata.get("file_urls", {})
+	course_urls = {}
+	for file, course in doc.metadata.get("file_courses", {}).items():
+		course_id = parse_course_id(course)
+		if course_id is not None and urls.get(file):
+			course_urls.setdefault(course_id, urls[file])
+	return course_urls
+
+def source_for_courses(doc: Document, course_ids: Set[int]) -> Document:
+	"""
+	Points a document's moodle_url at a copy of its file in one of the given courses, so a chunk shared between
+	courses links each user to a file they can open.
+
+	Args:
+		doc (Document): The document.
+		course_ids (Set[int]): The course IDs the user has access to.
+
+	Returns:
+		Document: The document, or a copy of it with a different moodle_url.
+	"""
+	course_urls = document_course_urls(doc)
+	urls = [course_urls[course_id] for course_id in sorted(course_ids & course_urls.keys())]
+	if not urls or doc.metadata.get("moodle_url") in urls:
+		return doc
+	# a copy, the docstore's own document must not change
+	return Document(page_content=doc.page_content, metadata={**doc.metadata, "moodle_url": urls[0]})
+
+
+class CourseIndex:
+	"""
+	An index of integer course IDs to the FAISS vector IDs ingested from that course. Each course
+	is kept as a packed bitmap over the vector IDs so a query's courses can be combined with a bitwise
+	OR and passed to FAISS as a constant-time membership test.
+	"""
+	def __init__(self, vector_ids: Dict[int, np.ndarray], ntotal: int):
+		self.vector_ids = vector_ids
+		self.ntotal = ntotal
+		self.bitmaps = {}
+		for course_id, ids in vector_ids.items():
+			mask = np.zeros(ntotal, dtype=bool)
+			mask[ids] = True
+			self.bitmaps[course_id] = np.packbits(mask, bitorder="little")
+
+	@classmethod
+	def from_db(cls, db: FAISS) -> "CourseIndex":
+		"""
+		Builds the course index from the course metadata of every document in a FAISS store.
+
+		Args:
+			db (FAISS): The FAISS vector store.
+
+		Returns:
+			CourseIndex: The course index of the store.
+		"""
+		docstore = db.docstore
+		if hasattr(docstore, "course_column"):
+			# a columnar docstore already has the courses as an integer column, in vector order
+			faiss_ids = np.repeat(np.arange(len(docstore), dtype=np.int64), np.diff(docstore.course_offsets))
+			course_column = np.asarray(docstore.course_column)
+			vector_ids = {int(course_id): faiss_ids[course_column == course_id] for course_id in np.unique(course_column)}
+			return cls(vector_ids, db.index.ntotal)
+
+		course_vectors = {}
+		for faiss_id, docstore_id in db.index_to_docstore_id.items():
+			doc = db.docstore.search(docstore_id)
+			for course_id in document_course_ids(doc):
+				course_vectors.setdefault(course_id, []).append(faiss_id)
+		vector_ids = {course_id: np.array(ids, dtype=np.int64) for course_id, ids in course_vectors.items()}
+		return cls(vector_ids, db.index.ntotal)
+
+	def save(self, index_dir: str):
+		"""
+		Saves the course index alongside the FAISS index files.
+
+		Args:
+			index_dir (str): The FAISS index directory.
+
+		Returns:
+			None
+		"""
+		arrays = {str(course_id): ids for course_id, ids in self.vector_ids.items()}
+		np.savez(os.path.join(index_dir, COURSE_INDEX_FILE), ntotal=np.int64(self.ntotal), **arrays)
+
+	@classmethod
+	def load(cls, index_dir: str) -> Optional["CourseIndex"]:
+		"""
+		Loads a course index saved by save().
+
+		Args:
+			index_dir (str): The FAISS index directory.
+
+		Returns:
+			CourseIndex: The course index, or None if the index directory has no course index.
+		"""
+		path = os.path.join(index_dir, COURSE_INDEX_FILE)
+		if not os.path.exists(path):
+			return None
+		with np.load(path) as data:
+			ntotal = int(data["ntotal"])
+			vector_ids = {int(key): data[key] for key in data.files if key != "ntotal"}
+		return cls(vector_ids, ntotal)
+
+	def bitmap(self, course_ids: Set[int]) -> Optional[np.ndarray]:
+		"""
+		Combines the bitmaps of the given courses.
+
+		Args:
+			course_ids (Set[int]): The course IDs to search.
+
+		Returns:
+			np.ndarray: The packed bitmap of the allowed vector IDs, or None if none of the courses have vectors.
+		"""
+		bitmaps = [self.bitmaps[course_id] for course_id in course_ids & self.bitmaps.keys()]
+		if not bitmaps:
+			return None
+		return np.bitwise_or.reduce(bitmaps)
+
+
+def load_course_index(db: FAISS, index_dir: str) -> CourseIndex:
+	"""
+	Loads the course index built at ingest time, rebuilding it from the docstore when it is missing
+	or out of date with the FAISS index.
+
+	Args:
+		db (FAISS): The loaded FAISS vector store.
+		index_dir (str): The FAISS index directory.
+
+	Returns:
+		CourseIndex: The course index of the store.
+	"""
+	course_index = CourseIndex.load(index_dir)
+	if course_index is None or course_index.ntotal != db.index.ntotal:
+		course_index = CourseIndex.from_db(db)
+	return course_index
+
+def exact_search_ids(index: faiss.Index, faiss_ids: np.ndarray, query: np.ndarray, k: int) -> List[int]:
+	"""
+	Scores the query against every one of the given vectors, reconstructed from the index.
+
+	Args:
+		index (faiss.Index): The index holding the vectors.
+		faiss_ids (np.ndarray): The vector IDs to score.
+		query (np.ndarray): The query embedding, as a 1 x d array.
+		k (int): The number of vector IDs to return.
+
+	Returns:
+		List[int]: Up to k of the closest vector IDs, ordered by similarity.
+	"""
+	vectors = index.reconstruct_batch(faiss_ids.astype(np.int64))
+	if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+		distances = -(vectors @ query[0])
+	else:
+		distances = ((vectors - query[0]) ** 2).sum(axis=1)
+	top = np.argpartition(distances, k - 1)[:k] if len(faiss_ids) > k else np.arange(len(faiss_ids))
+	top = top[np.argsort(distances[top], kind="stable")]
+	return [int(faiss_id) for faiss_id in faiss_ids[top]]
+
+def dense_search_ids(db: FAISS, allowed: np.ndarray, ntotal: int, query: str, k: int, query_vector: List[float] = None,
+		nprobe: int = RETRIEVAL_NPROBE, ef_search: int = RETRIEVAL_EF_SEARCH, exact_limit: int = RETRIEVAL_EXACT_LIMIT) -> List[int]:
+	"""
+	Performs a similarity search restricted to the vector IDs set in a bitmap. An IVF or HNSW search only scores
+	the allowed vectors among the candidates it visits, so a selective filter can leave it short of k results.
+	When few vectors are allowed they are searched exactly, and otherwise a search that comes back short is
+	repeated with a larger nprobe or efSearch.
+
+	Args:
+		db (FAISS): The loaded FAISS vector store.
+		allowed (np.ndarray): The packed bitmap of the allowed vector IDs, from CourseIndex.bitmap.
+		ntotal (int): The number of vector IDs the bitmap covers.
+		query (str): The user's input question.
+		k (int): The number of vector IDs to return.
+		query_vector (List[float]): The embedding of the query, if it has already been embedded.
+		nprobe (int): The number of lists searched in an IVF index.
+		ef_search (int): The candidate list size of an HNSW index.
+		exact_limit (int): The number of allowed vectors at or below which an IVF or HNSW index is searched exactly.
+
+	Returns:
+		List[int]: Up to k of the closest vector IDs, ordered by similarity.
+	"""
+	# the selector keeps a pointer to the bitmap, which must stay alive until the search is done
+	selector = faiss.IDSelectorBitmap(ntotal, faiss.swig_ptr(allowed))
+	if query_vector is None:
+		query_vector = db.embeddings.embed_query(query)
+	query_array = np.array([query_vector], dtype=np.float32)
+
+	index_type = index_type_of(db.index)
+	if index_type == "flat":
+		# a flat index scores every allowed vector already
+		_, indices = db.index.search(query_array, k, params=search_parameters(db.index, selector))
+		return [int(faiss_id) for faiss_id in indices[0] if faiss_id != -1]
+
+	allowed_ids = np.flatnonzero(np.unpackbits(allowed, bitorder="little")[:ntotal])
+	wanted = min(k, len(allowed_ids))
+	nlist = faiss.extract_index_ivf(db.index).nlist if index_type != "hnsw" else None
+	if len(allowed_ids) <= exact_limit:
+		if index_type == "hnsw":
+			return exact_search_ids(db.index, allowed_ids, query_array, k)
+		# probing every list scores every allowed vector
+		nprobe = nlist
+
+	for _ in range(RETRIEVAL_WIDEN_STEPS + 1):
+		params = search_parameters(db.index, selector, nprobe, ef_search)
+		_, indices = db.index.search(query_array, k, params=params)
+		faiss_ids = [int(faiss_id) for faiss_id in indices[0] if faiss_id != -1]
+		if len(faiss_ids) >= wanted or nprobe == nlist:
+			break
+		nprobe = min(nprobe * 4, nlist) if nlist else nprobe
+		ef_search *= 4
+	return faiss_ids
+
+def documents_by_ids(db: FAISS, faiss_ids: List[int], course_ids: Set[int] = None) -> List[Document]:
+	docs = [db.docstore.search(db.index_to_docstore_id[faiss_id]) for faiss_id in faiss_ids]
+	return [source_for_courses(doc, course_ids) for doc in docs] if course_ids else docs
+
+def course_filtered_search(db: FAISS, course_index: CourseIndex, query: str, course_ids: Set[int], k: int = 10, query_vector: List[float] = None,
+		nprobe: int = RETRIEVAL_NPROBE, ef_search: int = RETRIEVAL_EF_SEARCH) -> List[Document]:
+	"""
+	Performs a similarity search restricted to the vectors of the given courses. The restriction is applied
+	inside the FAISS search with a bitmap ID selector, so all k results come from the caller's courses instead
+	of being whatever is left of a global top k.
+
+	Args:
+		db (FAISS): The loaded FAISS vector store.
+		course_index (CourseIndex): The course index of the store.
+		query (str): The user's input question.
+		course_ids (Set[int]): The course IDs the user has access to, from parse_course_ids.
+		k (int): The number of documents to return.
+		query_vector (List[float]): The embedding of the query, if it has already been embedded.
+		nprobe (int): The number of lists searched in an IVF index.
+		ef_search (int): The candidate list size of an HNSW index.
+
+	Returns:
+		List[Document]: Up to k of the closest documents, ordered by similarity, each linking to its file in
+			one of the caller's courses.
+	"""
+	allowed = course_index.bitmap(course_ids)
+	if allowed is None:
+		return []
+	return documents_by_ids(db, dense_search_ids(db, allowed, course_index.ntotal, query, k, query_vector, nprobe, ef_search), course_ids)
+
+def reciprocal_rank_fusion(rankings: List[List[int]], rrf_k: int = RRF_K) -> List[int]:
+	"""
+	Merges several rankings of the same items by summing 1 / (rrf_k + rank) over the rankings each item is in.
+
+	Args:
+		rankings (List[List[int]]): The rankings to merge, best first.
+		rrf_k (int): Damps the weight of the top ranks, 60 is the usual choice.
+
+	Returns:
+		List[int]: The items ordered by fused score, best first.
+	"""
+	scores = {}
+	for ranking in rankings:
+		for rank, item in enumerate(ranking, start=1):
+			scores[item] = scores.get(item, 0.0) + 1.0 / (rrf_k + rank)
+	return sorted(scores, key=scores.get, reverse=True)
+
+def hybrid_search(db: FAISS, course_index: CourseIndex, bm25: BM25Index, query: str, course_ids: Set[int], k: int = 10, query_vector: List[float] = None,
+		candidates: int = HYBRID_CANDIDATES, nprobe: int = RETRIEVAL_NPROBE, ef_search: int = RETRIEVAL_EF_SEARCH) -> List[Document]:
+	"""
+	Searches the given courses with both the vector index and the BM25 index and merges the two candidate lists
+	with reciprocal rank fusion, so chunks with exact matches of rare terms (port numbers, command names) rank
+	well even when their embedding doesn't.
+
+	Args:
+		db (FAISS): The loaded FAISS vector store.
+		course_index (CourseIndex): The course index of the store.
+		bm25 (BM25Index): The BM25 index of the store.
+		query (str): The user's input question.
+		course_ids (Set[int]): The course IDs the user has access to, from parse_course_ids.
+		k (int): The number of documents to return.
+		query_vector (List[float]): The embedding of the query, if it has already been embedded.
+		candidates (int): The number of candidates taken from each index.
+		nprobe (int): The number of lists searched in an IVF index.
+		ef_search (int): The candidate list size of an HNSW index.
+
+	Returns:
+		List[Document]: Up to k documents, ordered by fused rank.
+	"""
+	allowed = course_index.bitmap(course_ids)
+	if allowed is None:
+		return []
+	dense = dense_search_ids(db, allowed, course_index.ntotal, query, candidates, query_vector, nprobe, ef_search)
+	sparse = [faiss_id for faiss_id, _ in bm25.search(query, candidates, allowed)]
+	return documents_by_ids(db, reciprocal_rank_fusion([dense, sparse])[:k], course_ids)
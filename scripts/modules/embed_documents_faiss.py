@@ -1,68 +1,214 @@
 import os
+import sys
 import json
-import hashlib
-from typing import List, Dict
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Set, Tuple, Iterator, Iterable
+import numpy as np
+import faiss
+from numpy.typing import NDArray
 from langchain.document_loaders import UnstructuredFileLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.vectorstores import FAISS
 from langchain.docstore.document import Document
+from modules.course_retrieval import CourseIndex
+from modules.answer_cache import write_index_version
+from modules.mmap_store import export_mmap_store
+from modules.bm25_index import BM25Index, load_bm25_index
+from modules.ann_index import build_ann_index, index_type_of, load_ann_config, save_ann_config
+from modules.chunk_cache import ChunkEmbeddingCache, chunk_hash
+from modules.embedder import Embedder, get_embedder
+from modules.file_manifest import FileManifest, detect_changed_files
+from modules.parsed_cache import ParsedDocumentCache
 
 # load const vars
 EMBED_MODEL = "BAAI/bge-small-en"
 DOCS_DIR = "ingested_moodle_data"
 VECTOR_DB_DIR = "faiss_index"
 MANIFEST_PATH = "document_manifest.json"
+EMBEDDING_CACHE_DIR = "embedding_cache"
+PARSED_CACHE_DIR = "parsed_cache"
+TOMBSTONES_FILE = "tombstones.json"
+CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "500")) # characters per chunk, run with --rechunk after changing
+CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "100")) # characters shared by neighbouring chunks
+PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", os.cpu_count() or 1)) # processes parsing files at once
+PARSE_TIMEOUT = float(os.getenv("INGEST_PARSE_TIMEOUT", "600")) # seconds a single file may take to parse
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "64")) # chunks embedded at a time
+EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "2")) # batches embedded at once
+CHECKPOINT_EVERY = int(os.getenv("INGEST_CHECKPOINT_EVERY", "50")) # batches added between index checkpoints
+COMPACT_RATIO = float(os.getenv("INGEST_COMPACT_RATIO", "0.2")) # share of deleted chunks that triggers a compaction
+
+# approximate nearest neighbour index settings, see ann_benchmark.py to choose them
+INDEX_TYPE = os.getenv("INGEST_INDEX_TYPE", "flat") # flat, ivf_flat, ivf_pq or hnsw
+IVF_NLIST = int(os.getenv("INGEST_IVF_NLIST", "1024")) # IVF lists, roughly sqrt(number of chunks) to 4*sqrt
+PQ_M = int(os.getenv("INGEST_PQ_M", "16")) # PQ sub-quantizers, must divide the embedding dimension (384)
+PQ_NBITS = int(os.getenv("INGEST_PQ_NBITS", "8")) # bits per PQ code
+HNSW_M = int(os.getenv("INGEST_HNSW_M", "32")) # neighbours per HNSW node
+HNSW_EF_CONSTRUCTION = int(os.getenv("INGEST_HNSW_EF_CONSTRUCTION", "200")) # HNSW build-time candidate list size
+RETRAIN_GROWTH = float(os.getenv("INGEST_RETRAIN_GROWTH", "2")) # retrain IVF once the index has grown this many times since training
 
 # load metadata from json file
 with open("moodle_file_metadata.json", "r") as f:
 	moodle_metadata = json.load(f)
 
 
-def hash_file(path: str) -> str:
+def load_manifest(path: str) -> FileManifest:
 	"""
-	Takes a given file path and generates an md5 hash checksum
+	Loads the manifest of ingested files from its snapshot and journal.
 
 	Args:
-		path (str): The file path of the file to be hashed.
+		path (str): The file path of the manifest snapshot.
 
 	Returns:
-		str: A charset of hexidecimal digits representing the hashed value.
+		FileManifest: The filenames mapped to the hash, size and modification time they were ingested with.
 	"""
-	with open(path, "rb") as f:
-		return hashlib.md5(f.read()).hexdigest()
+	return FileManifest(path)
 
-def load_manifest(path: str) -> Dict[str, str]:
+def list_document_files(doc_folder: str) -> List[str]:
 	"""
-	Takes a given file path and loads the JSON data of that file.
+	Lists the document files in a folder and its course subfolders.
 
 	Args:
-		path (str): The file path of the JSON file to be loaded.
+		doc_folder (str): The directory path to list.
 
 	Returns:
-		dictionary (dict[str, str]): A JSON dictionary of the content of the file.
+		List[str]: The paths of the files relative to doc_folder, e.g. "<course_id>/<filename>", as keyed in the Moodle metadata.
 	"""
-	if os.path.exists(path):
-		with open(path, "r") as f:
-			return json.load(f)
-	return {}
+	files = []
+	for root, _, names in os.walk(doc_folder):
+		for name in names:
+			if name.endswith((".pdf", ".docx")):
+				files.append(os.path.relpath(os.path.join(root, name), doc_folder).replace(os.sep, "/"))
+	return sorted(files)
 
-def save_manifest(manifest: Dict[str, str], path: str):
+def parse_file(path: str, timeout: float = PARSE_TIMEOUT) -> List[Document]:
 	"""
-	Takes a Dictionary of String: String Key:Value pairs, and a file path and writes
-	the dictionary to that path as a JSON dictionary.
+	Parses a single document file using the Unstructured library. On POSIX systems parsing is abandoned with a
+	TimeoutError after the timeout so a pathological file can't hold up the worker.
 
 	Args:
-		manifest (Dict[str:str]): The dictionary containing the stringified key:value pairs.
-		path (str): The file path location to save the dictionary to.
+		path (str): The file path of the document to parse.
+		timeout (float): The number of seconds the file may take to parse.
 
 	Returns:
-		None
+		Document (List): The documents Unstructured parsed from the file.
+	"""
+	def on_timeout(signum, frame):
+		raise TimeoutError(f"Parsing took longer than {timeout}s")
+
+	if timeout and hasattr(signal, "SIGALRM"):
+		signal.signal(signal.SIGALRM, on_timeout)
+		signal.setitimer(signal.ITIMER_REAL, timeout)
+	try:
+		loader = UnstructuredFileLoader(path)
+		return loader.load()
+	finally:
+		if timeout and hasattr(signal, "SIGALRM"):
+			signal.setitimer(signal.ITIMER_REAL, 0)
+
+def split_documents(docs: List[Document], file: str, moodle_info: Dict[str, str]) -> List[Document]:
+	"""
+	Attaches a file's Moodle metadata to its parsed documents and splits them into overlapping chunks.
+
+	Args:
+		docs (List[Document]): The documents parsed from the file.
+		file (str): The filename of the file.
+		moodle_info (Dict[str:str]): The Moodle metadata of the document, its "url" and "course_id".
+
+	Returns:
+		Document (List): The chunks of the document.
+	"""
+	# attach Moodle metadata
+	for doc in docs:
+		doc.metadata["moodle_url"] = moodle_info.get("url", file)
+		doc.metadata["course_id"] = moodle_info.get("course_id", "unknown")
+
+	# chunk the document, recording where each chunk starts so overlapping neighbours can be merged at query time
+	splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
+	chunks = splitter.split_documents(docs)
+	for chunk in chunks:
+		set_file_courses(chunk.metadata, {file: chunk.metadata["course_id"]}, {file: chunk.metadata["moodle_url"]})
+		chunk.metadata["chunk_hash"] = chunk_hash(chunk.page_content)
+	return chunks
+
+def parse_and_split_file(path: str, moodle_info: Dict[str, str], timeout: float = PARSE_TIMEOUT, file_hash: str = None,
+		cache_dir: str = PARSED_CACHE_DIR, file: str = None) -> List[Document]:
+	"""
+	Parses a single document file, attaches its Moodle metadata and splits it into overlapping chunks. Runs in a
+	worker process. Parsed text is cached by the file's content hash, so a file that has been parsed before is only
+	re-chunked.
+
+	Args:
+		path (str): The file path of the document to parse.
+		moodle_info (Dict[str:str]): The Moodle metadata of the document, its "url" and "course_id".
+		timeout (float): The number of seconds the file may take to parse.
+		file_hash (str): The content hash of the file, the parsed text isn't cached if not given.
+		cache_dir (str): The directory of the parsed text cache.
+		file (str): The file's key in the manifest and metadata, its filename if not given.
+
+	Returns:
+		Document (List): The chunks of the document.
+	"""
+	cache = ParsedDocumentCache(cache_dir) if file_hash else None
+	docs = cache.get(file_hash) if cache else None
+	if docs is None:
+		docs = parse_file(path, timeout)
+		if cache:
+			cache.put(file_hash, docs)
+	return split_documents(docs, file or os.path.basename(path), moodle_info)
+
+def iter_new_doc_chunks(doc_folder: str, manifest: FileManifest, metadata_dict: Dict[str, Dict[str, str]],
+		workers: int = PARSE_WORKERS, timeout: float = PARSE_TIMEOUT, rechunk: bool = False) -> Iterator[Tuple[str, Dict, List[Document]]]:
+	"""
+	Parses and chunks the new or changed document files in a folder across a pool of worker processes, yielding
+	each file's chunks as soon as it is done. Only a bounded number of files are parsed ahead of the consumer, so
+	memory use doesn't grow with the number of files. Files that fail or time out are reported and skipped, and
+	stay out of the manifest so they are retried on the next run.
+
+	Args:
+		doc_folder (str): The directory path to load documents from.
+		manifest (FileManifest): The manifest of the files already ingested, files whose size and modification
+			time are unchanged are skipped without being read.
+		metadata_dict (Dict[str, Dict[str:str]]): A nested dictionary containing metadata for the documents within the doc_folder directory path.
+		workers (int): The number of worker processes parsing files.
+		timeout (float): The number of seconds a single file may take to parse.
+		rechunk (bool): Re-chunk every file, not just new or changed ones, e.g. after changing the chunk size.
+			Unchanged files are read from the parsed text cache instead of being parsed again.
+
+	Yields:
+		Tuple[str, Dict, List[Document]]: The filename, the new manifest entry and the chunks of each parsed file.
 	"""
-	with open(path, "w") as f:
-		json.dump(manifest, f, indent=2)
+	files = list_document_files(doc_folder)
+	pending_files = detect_changed_files(doc_folder, files, manifest)
+	if rechunk:
+		changed = {file for file, _ in pending_files}
+		pending_files += [(file, manifest[file]) for file in files if file not in changed and file in manifest]
+	else:
+		print(f"Skipping {len(files) - len(pending_files)} unchanged files.")
 
-def load_and_split_new_docs(doc_folder: str, manifest: Dict[str, str], metadata_dict: Dict[str, Dict[str, str]]) -> List[Document]:
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		running = {}
+		while pending_files or running:
+			# keep the workers busy without parsing too far ahead of the consumer
+			while pending_files and len(running) < workers * 2:
+				file, entry = pending_files.pop(0)
+				print(f"Processing new or changed file: {file}")
+				future = executor.submit(parse_and_split_file, os.path.join(doc_folder, file), metadata_dict.get(file, {}), timeout, entry["hash"],
+					PARSED_CACHE_DIR, file)
+				running[future] = (file, entry)
+
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				file, entry = running.pop(future)
+				try:
+					chunks = future.result()
+				except Exception as e:
+					print(f"Failed to parse {file}: {e}")
+					continue
+				yield file, entry, chunks
+
+def load_and_split_new_docs(doc_folder: str, manifest: FileManifest, metadata_dict: Dict[str, Dict[str, str]]) -> List[Document]:
 	"""
 	Retrieves document files from a specified folder and a metadata dictionary, parses the content using the Unstructured library,
 	attaches relevant metadata and performs recursive character splitting into overlapping chunks to assist with retrieval via a
@@ -70,42 +216,467 @@ def load_and_split_new_docs(doc_folder: str, manifest: Dict[str, str], metadata_
 
 	Args:
 		doc_folder (str): The directory path to load documents from.
-		manifest (Dict[str:str]): The dictionary containing the stringified key:value pairs.
+		manifest (FileManifest): The manifest of ingested files, updated with the new files but not committed.
 		metadata_dict (Dict[str, Dict[str:str]]): A nested dictionary containing metadata for the documents within the doc_folder directory path.
 
 	Returns:
 		Document (List): A LangChain representation of the documents as a list storing both text and metadata.
 	"""
 	new_docs = []
-	for file in os.listdir(doc_folder):
-		if not file.endswith((".pdf", ".docx")):
-			continue
-		path = os.path.join(doc_folder, file)
-		file_hash = hash_file(path)
+	for file, entry, chunks in iter_new_doc_chunks(doc_folder, manifest, metadata_dict):
+		new_docs.extend(chunks)
+		manifest[file] = entry  # update manifest
+	return new_docs
 
-		if manifest.get(file) == file_hash:
-			print(f"Skipping unchanged file: {file}")
-			continue
+def load_or_create_db(embeddings: Embedder) -> FAISS:
+	"""
+	Loads the existing FAISS index, if there is one.
 
-		print(f"Processing new or changed file: {file}")
-		loader = UnstructuredFileLoader(path)
-		docs = loader.load()
+	Args:
+		embeddings (Embedder): The embedding model the index is built with.
+
+	Returns:
+		FAISS: The FAISS vector store, or None if no index has been created yet.
+	"""
+	if os.path.exists(os.path.join(VECTOR_DB_DIR, "index.faiss")):
+		return FAISS.load_local(VECTOR_DB_DIR, embeddings, allow_dangerous_deserialization=True)
+	return None
+
+def load_tombstones() -> Set[str]:
+	"""
+	Loads the docstore IDs of the chunks that have been deleted but are still in the FAISS index.
+
+	Returns:
+		Set[str]: The deleted docstore IDs.
+	"""
+	path = os.path.join(VECTOR_DB_DIR, TOMBSTONES_FILE)
+	if os.path.exists(path):
+		with open(path, "r") as f:
+			return set(json.load(f))
+	return set()
+
+def save_db(db: FAISS, tombstones: Set[str] = None, bm25: BM25Index = None):
+	"""
+	Saves the FAISS index along with its memory mapped export, the course index, the BM25 index and the deleted
+	chunks, and bumps the index version.
+
+	Args:
+		db (FAISS): The FAISS vector store.
+		tombstones (Set[str]): The docstore IDs of the deleted chunks still in the index.
+		bm25 (BM25Index): The BM25 index kept up to date with the FAISS index, loaded or rebuilt if not given.
+
+	Returns:
+		None
+	"""
+	db.save_local(VECTOR_DB_DIR)
+
+	path = os.path.join(VECTOR_DB_DIR, TOMBSTONES_FILE)
+	with open(f"{path}.tmp", "w") as f:
+		json.dump(sorted(tombstones or []), f)
+	os.replace(f"{path}.tmp", path)
+
+	# read-only copy of the index and docstore that query processes memory map instead of unpickling
+	export_mmap_store(db, VECTOR_DB_DIR)
+	# course ID -> vector IDs index used to restrict searches to a user's courses
+	CourseIndex.from_db(db).save(VECTOR_DB_DIR)
+	# sparse index for hybrid retrieval, rebuilt when vector IDs have changed (e.g. by a compaction)
+	if bm25 is None or bm25.ntotal != db.index.ntotal:
+		bm25 = load_bm25_index(db, VECTOR_DB_DIR)
+	bm25.save(VECTOR_DB_DIR)
+	# lets running query servers reload the index and drop answers cached from the old one
+	write_index_version(VECTOR_DB_DIR)
+
+def compact_db(db: FAISS, tombstones: Set[str], cache: ChunkEmbeddingCache):
+	"""
+	Removes the deleted chunks from the FAISS index and docstore for good, so the index size and search time
+	only reflect the live documents.
+
+	Args:
+		db (FAISS): The FAISS vector store.
+		tombstones (Set[str]): The docstore IDs of the deleted chunks, emptied once they are removed.
+		cache (ChunkEmbeddingCache): The chunk hash to vector cache, used to rebuild approximate indexes.
+
+	Returns:
+		None
+	"""
+	if tombstones:
+		index_type = index_type_of(db.index)
+		if index_type != "flat":
+			# only a flat index renumbers the remaining vectors on removal the way the docstore mapping expects,
+			# so delete from a flat copy and rebuild the approximate index afterwards
+			db.index = build_ann_index(db_vectors(db, cache), "flat")
+		db.delete(list(tombstones))
+		if index_type != "flat":
+			update_index_type(db, cache, index_type, force=True)
+		print(f"Compacted the index, removed {len(tombstones)} deleted chunks.")
+		tombstones.clear()
+	save_db(db, tombstones)
+
+def db_vectors(db: FAISS, cache: ChunkEmbeddingCache) -> NDArray[np.float32]:
+	"""
+	Collects the vectors of every chunk in the index in vector ID order. Vectors come from the embedding cache,
+	chunks embedded before the cache existed are reconstructed from the index (approximately for IVF-PQ).
+
+	Args:
+		db (FAISS): The FAISS vector store.
+		cache (ChunkEmbeddingCache): The chunk hash to vector cache.
+
+	Returns:
+		NDArray[np.float32]: The vectors, one row per vector ID.
+	"""
+	hashes = []
+	for faiss_id in range(db.index.ntotal):
+		doc = db.docstore.search(db.index_to_docstore_id[faiss_id])
+		hashes.append(doc.metadata.get("chunk_hash") or chunk_hash(doc.page_content))
+	cached = cache.get_many(hashes)
+
+	vectors = np.empty((db.index.ntotal, db.index.d), dtype=np.float32)
+	ivf = faiss.try_extract_index_ivf(db.index)
+	if ivf is not None and len(cached) < len(hashes):
+		ivf.make_direct_map()
+	for faiss_id, key in enumerate(hashes):
+		vectors[faiss_id] = cached[key] if key in cached else db.index.reconstruct(faiss_id)
+	return vectors
+
+def ann_settings(index_type: str) -> Dict:
+	"""
+	Returns the configured build parameters of an index type.
+
+	Args:
+		index_type (str): One of the ann_index.INDEX_TYPES.
+
+	Returns:
+		Dict: The index type and the parameters it is built with.
+	"""
+	settings = {"index_type": index_type}
+	if index_type in ("ivf_flat", "ivf_pq"):
+		settings["nlist"] = IVF_NLIST
+	if index_type == "ivf_pq":
+		settings.update(pq_m=PQ_M, pq_nbits=PQ_NBITS)
+	if index_type == "hnsw":
+		settings.update(hnsw_m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION)
+	return settings
 
-		# attach Moodle metadata
-		moodle_info = metadata_dict.get(file, {})
-		for doc in docs:
-			doc.metadata["moodle_url"] = moodle_info.get("url", file)
-			doc.metadata["course_id"] = moodle_info.get("course_id", "unknown")
+def rebuild_index(db: FAISS, cache: ChunkEmbeddingCache, index_type: str = INDEX_TYPE):
+	"""
+	Rebuilds the FAISS index as the given index type, training it on the current vectors. Vector IDs are kept,
+	so the docstore and course index stay valid.
+
+	Args:
+		db (FAISS): The FAISS vector store.
+		cache (ChunkEmbeddingCache): The chunk hash to vector cache.
+		index_type (str): One of the ann_index.INDEX_TYPES.
+
+	Returns:
+		None
+	"""
+	settings = ann_settings(index_type)
+	vectors = db_vectors(db, cache)
+	db.index = build_ann_index(vectors, **settings)
+	save_ann_config(VECTOR_DB_DIR, {**settings, "trained_on": len(vectors)})
+	print(f"Rebuilt the index as {index_type} over {len(vectors)} vectors.")
+
+def update_index_type(db: FAISS, cache: ChunkEmbeddingCache, index_type: str = INDEX_TYPE, force: bool = False) -> bool:
+	"""
+	Rebuilds the index if it isn't the configured type or parameters, or if an IVF index has grown by RETRAIN_GROWTH
+	since it was trained and its lists no longer fit the data.
+
+	Args:
+		db (FAISS): The FAISS vector store.
+		cache (ChunkEmbeddingCache): The chunk hash to vector cache.
+		index_type (str): One of the ann_index.INDEX_TYPES.
+		force (bool): Rebuild even if the index is up to date.
+
+	Returns:
+		bool: True if the index was rebuilt, False otherwise.
+	"""
+	settings = ann_settings(index_type)
+	config = load_ann_config(VECTOR_DB_DIR) or {}
+	stale = (index_type_of(db.index) != index_type
+		or (index_type != "flat" and {key: config.get(key) for key in settings} != settings)
+		or (index_type in ("ivf_flat", "ivf_pq") and db.index.ntotal > RETRAIN_GROWTH * config.get("trained_on", 0)))
+	if not (stale or force):
+		return False
+	try:
+		rebuild_index(db, cache, index_type)
+	except ValueError as e:
+		print(f"Keeping the {index_type_of(db.index)} index: {e}")
+		return False
+	return True
+
+def file_courses(metadata: Dict) -> Dict[str, str]:
+	"""
+	Returns the files a chunk appears in and the course of each file. Chunks ingested before files were tracked
+	fall back to their Unstructured source path and course_id.
+
+	Args:
+		metadata (Dict): The metadata of the chunk.
+
+	Returns:
+		Dict[str, str]: A dictionary of filenames to course IDs.
+	"""
+	if "file_courses" in metadata:
+		return metadata["file_courses"]
+	return {os.path.basename(metadata.get("source", "")): metadata.get("course_id")}
+
+def file_urls(metadata: Dict) -> Dict[str, str]:
+	"""
+	Returns the Moodle URL of each file a chunk appears in. Chunks ingested before URLs were tracked per file
+	fall back to their single moodle_url.
+
+	Args:
+		metadata (Dict): The metadata of the chunk.
+
+	Returns:
+		Dict[str, str]: A dictionary of filenames to Moodle URLs.
+	"""
+	if "file_urls" in metadata:
+		return metadata["file_urls"]
+	return {file: metadata.get("moodle_url") for file in file_courses(metadata)}
+
+def set_file_courses(metadata: Dict, courses: Dict[str, str], urls: Dict[str, str] = None):
+	"""
+	Sets the files a chunk appears in, and the courses it is searchable from. The chunk's moodle_url and course_id
+	are repointed to one of the files when the file they pointed to is no longer among them.
+
+	Args:
+		metadata (Dict): The metadata of the chunk.
+		courses (Dict[str, str]): A dictionary of filenames to course IDs.
+		urls (Dict[str, str]): A dictionary of filenames to Moodle URLs, the chunk's current URLs if not given.
+
+	Returns:
+		None
+	"""
+	urls = file_urls(metadata) if urls is None else urls
+	urls = {file: url for file, url in urls.items() if file in courses and url}
+	metadata["file_courses"] = courses
+	metadata["course_ids"] = list(dict.fromkeys(courses.values()))
+	metadata["file_urls"] = urls
+	if urls and metadata.get("moodle_url") not in urls.values():
+		file, metadata["moodle_url"] = next(iter(urls.items()))
+		metadata["course_id"] = courses[file]
+
+def merge_course_tags(metadata: Dict, other_metadata: Dict) -> bool:
+	"""
+	Adds the files and courses of a duplicate chunk to the metadata of the chunk that is kept.
+
+	Args:
+		metadata (Dict): The metadata of the chunk that is kept.
+		other_metadata (Dict): The metadata of the duplicate chunk.
 
-		new_docs.extend(docs)
-		manifest[file] = file_hash  # update manifest
+	Returns:
+		bool: True if the files or courses of the kept chunk changed, False otherwise.
+	"""
+	courses = dict(file_courses(metadata))
+	urls = dict(file_urls(metadata))
+	merged = {**courses, **file_courses(other_metadata)}
+	merged_urls = {**urls, **file_urls(other_metadata)}
+	set_file_courses(metadata, merged, merged_urls)
+	return merged != courses or metadata["file_urls"] != urls
+
+def embed_chunks(embeddings: Embedder, cache: ChunkEmbeddingCache, chunks: List[Document]) -> List[List[float]]:
+	"""
+	Embeds a batch of chunks, only running the embedding model for chunks that aren't in the embedding cache.
+
+	Args:
+		embeddings (Embedder): The embedding model.
+		cache (ChunkEmbeddingCache): The chunk hash to vector cache.
+		chunks (List[Document]): The chunks to embed.
+
+	Returns:
+		List[List[float]]: The embedding vectors of the chunks, in the same order.
+	"""
+	hashes = [chunk.metadata["chunk_hash"] for chunk in chunks]
+	vectors = cache.get_many(hashes)
+	missing = [(key, chunk.page_content) for key, chunk in zip(hashes, chunks) if key not in vectors]
+	if missing:
+		new_vectors = embeddings.embed_documents([text for _, text in missing])
+		cache.put_many([key for key, _ in missing], new_vectors)
+		vectors.update(zip([key for key, _ in missing], new_vectors))
+	return [list(vectors[key]) for key in hashes]
+
+def embed_and_store_files(parsed_files: Iterable[Tuple[str, Dict, List[Document]]], manifest: FileManifest = None,
+		batch_size: int = EMBED_BATCH_SIZE, workers: int = EMBED_WORKERS, checkpoint_every: int = CHECKPOINT_EVERY, live_files: Set[str] = None,
+		index_type: str = INDEX_TYPE) -> int:
+	"""
+	Embeds the chunks of parsed files in batches and adds them to the FAISS index incrementally, so only a bounded
+	number of chunks are held in memory at once. Batches are embedded on a pool of threads and added to the index in
+	order. After every checkpoint_every batches the index is saved and the files embedded so far are recorded in the
+	manifest, so an interrupted run resumes from the last checkpoint instead of starting again.
+
+	Chunks are deduplicated by a hash of their normalised text: a chunk already in the index (e.g. the same slides
+	uploaded to another course) is stored once and tagged with each course it appears in, and vectors are reused from
+	the embedding cache so only chunks that have never been seen before are run through the embedding model.
+
+	When a changed file is re-ingested, its chunks that are no longer in the file are deleted, as are the chunks of
+	files missing from live_files. Deleted chunks are tombstoned: they are removed from every course, so searches
+	never return them, and are dropped from the index by compact_db once they make up COMPACT_RATIO of it.
+
+	Args:
+		parsed_files (Iterable[Tuple[str, Dict, List[Document]]]): The filename, manifest entry and chunks of each file,
+			as yielded by iter_new_doc_chunks. The filename and entry may be None for chunks not tracked in the manifest.
+		manifest (FileManifest): The manifest of ingested files, committed at each checkpoint.
+		batch_size (int): The number of chunks embedded at a time.
+		workers (int): The number of batches embedded at once.
+		checkpoint_every (int): The number of batches added to the index between checkpoints.
+		live_files (Set[str]): The filenames currently on Moodle, the chunks of any other file are deleted. Nothing is
+			deleted if not given.
+		index_type (str): The FAISS index type: flat (exact), ivf_flat, ivf_pq or hnsw.
+
+	Returns:
+		int: The number of chunks added to the index.
+	"""
+	embeddings = get_embedder(EMBED_MODEL)
+	cache = ChunkEmbeddingCache(EMBEDDING_CACHE_DIR, embeddings.cache_key)
+	db = load_or_create_db(embeddings)
+
+	tombstones = load_tombstones()
+	bm25 = load_bm25_index(db, VECTOR_DB_DIR) if db is not None else BM25Index.empty()
+
+	# chunk hash -> docstore ID of every chunk already in the index, and filename -> docstore IDs of its chunks
+	indexed_chunks = {}
+	file_index = {}
+	if db is not None:
+		for docstore_id in db.index_to_docstore_id.values():
+			doc = db.docstore.search(docstore_id)
+			indexed_chunks[doc.metadata.get("chunk_hash") or chunk_hash(doc.page_content)] = docstore_id
+			if docstore_id not in tombstones:
+				for file in file_courses(doc.metadata):
+					file_index.setdefault(file, set()).add(docstore_id)
 
+	queued_chunks = {} # chunk hash -> chunk waiting to be added to the index
+	pending = deque() # batches being embedded, oldest first
+	completed_files = {} # files fully embedded since the last checkpoint
+	batch = []
+	embedded = 0
+	duplicates = 0
+	deleted = 0
+	index_changed = False
+	batches_since_checkpoint = 0
 
-	# chunk the documents
-	splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-	return splitter.split_documents(new_docs)
+	def delete_file_chunks(file: str, keep_hashes: Set[str]):
+		# remove the file from its old chunks, tombstoning chunks no other file contains
+		nonlocal deleted, index_changed
+		for docstore_id in file_index.pop(file, set()):
+			doc = db.docstore.search(docstore_id)
+			if doc.metadata.get("chunk_hash") in keep_hashes:
+				continue
+			courses = {name: course for name, course in file_courses(doc.metadata).items() if name != file}
+			set_file_courses(doc.metadata, courses)
+			if not courses:
+				tombstones.add(docstore_id)
+				deleted += 1
+			index_changed = True
 
-def embed_and_store(docs: List[Document]):
+	def add_oldest_batch():
+		nonlocal db, embedded, batches_since_checkpoint
+		chunks, future = pending.popleft()
+		text_embeddings = list(zip([chunk.page_content for chunk in chunks], future.result()))
+		metadatas = [chunk.metadata for chunk in chunks]
+		start = db.index.ntotal if db is not None else 0
+		if db is None:
+			db = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas)
+			ids = list(db.index_to_docstore_id.values())
+		else:
+			ids = db.add_embeddings(text_embeddings, metadatas=metadatas)
+		for offset, (chunk, docstore_id) in enumerate(zip(chunks, ids)):
+			bm25.add(start + offset, chunk.page_content)
+			indexed_chunks[chunk.metadata["chunk_hash"]] = docstore_id
+			del queued_chunks[chunk.metadata["chunk_hash"]]
+			for file in file_courses(chunk.metadata):
+				file_index.setdefault(file, set()).add(docstore_id)
+		embedded += len(chunks)
+		batches_since_checkpoint += 1
+
+	def submit_batch(executor: ThreadPoolExecutor):
+		nonlocal batch
+		if batch:
+			pending.append((batch, executor.submit(embed_chunks, embeddings, cache, batch)))
+			batch = []
+		# bound the number of batches in memory
+		while len(pending) > workers * 2:
+			add_oldest_batch()
+
+	def checkpoint(executor: ThreadPoolExecutor):
+		nonlocal batches_since_checkpoint, index_changed
+		submit_batch(executor)
+		while pending:
+			add_oldest_batch()
+		if db is not None:
+			save_db(db, tombstones, bm25)
+		if manifest is not None:
+			manifest.update(completed_files)
+			manifest.commit()
+		completed_files.clear()
+		batches_since_checkpoint = 0
+		index_changed = False
+		print(f"Checkpoint: {embedded} chunks embedded and stored in FAISS, {duplicates} duplicates merged, {deleted} deleted.")
+
+	# delete the chunks of files that have been removed from Moodle
+	if live_files is not None:
+		for file in set(file_index) - live_files:
+			print(f"Deleting removed file: {file}")
+			delete_file_chunks(file, set())
+		if manifest is not None:
+			for file in set(manifest) - live_files:
+				del manifest[file]
+				index_changed = True
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for file, entry, chunks in parsed_files:
+			for chunk in chunks:
+				chunk.metadata.setdefault("chunk_hash", chunk_hash(chunk.page_content))
+
+			# a changed file replaces its old chunks
+			if file is not None and file in file_index:
+				delete_file_chunks(file, {chunk.metadata["chunk_hash"] for chunk in chunks})
+
+			for chunk in chunks:
+				key = chunk.metadata["chunk_hash"]
+
+				# store identical content once, tagged with every course it appears in
+				if key in indexed_chunks:
+					docstore_id = indexed_chunks[key]
+					index_changed |= merge_course_tags(db.docstore.search(docstore_id).metadata, chunk.metadata)
+					if docstore_id in tombstones:
+						tombstones.discard(docstore_id) # deleted content that has come back
+						index_changed = True
+					for name in file_courses(chunk.metadata):
+						file_index.setdefault(name, set()).add(docstore_id)
+					duplicates += 1
+					continue
+				if key in queued_chunks:
+					merge_course_tags(queued_chunks[key].metadata, chunk.metadata)
+					duplicates += 1
+					continue
+
+				queued_chunks[key] = chunk
+				batch.append(chunk)
+				if len(batch) >= batch_size:
+					submit_batch(executor)
+			if file is not None:
+				completed_files[file] = entry
+
+			# checkpoint between files, so a checkpoint never holds part of a file
+			if batches_since_checkpoint >= checkpoint_every:
+				checkpoint(executor)
+
+		if batch or pending or completed_files or batches_since_checkpoint or index_changed:
+			checkpoint(executor)
+
+	# drop the deleted chunks from the index once they are a large enough share of it
+	if db is not None and tombstones and len(tombstones) >= COMPACT_RATIO * db.index.ntotal:
+		compact_db(db, tombstones, cache)
+
+	# new chunks are added to the existing index, switch to (or retrain) the approximate index type when needed
+	if db is not None and update_index_type(db, cache, index_type):
+		save_db(db, tombstones, bm25)
+
+	if not embedded:
+		print("No new documents to embed.")
+	return embedded
+
+def embed_and_store(docs: List[Document], index_type: str = INDEX_TYPE):
 	"""
 	Checks the document list against the existing documents. If a document does not exist performs embedding using a
 	given embedding model. Creates an index file for FAISS and saves the embedded documents into the FAISS vector
@@ -113,6 +684,7 @@ def embed_and_store(docs: List[Document]):
 
 	Args:
 		docs (List[Document]): A LangChain representation of the documents as a list storing both text and metadata.
+		index_type (str): The FAISS index type: flat (exact), ivf_flat, ivf_pq or hnsw.
 
 	Returns:
 		None
@@ -121,27 +693,38 @@ def embed_and_store(docs: List[Document]):
 		print("No new documents to embed.")
 		return
 
-	embeddings = HuggingFaceEmbeddings(model_name=EMBED_MODEL)
+	embedded = embed_and_store_files([(None, None, docs)], index_type=index_type)
+	print(f"Embedded and stored {embedded} documents in FAISS.")
 
-	# load or create FAISS index
-	if os.path.exists(os.path.join(VECTOR_DB_DIR, "index.faiss")):
-		db = FAISS.load_local(VECTOR_DB_DIR, embeddings, allow_dangerous_deserialization=True)
-		db.add_documents(docs)
-	else:
-		db = FAISS.from_documents(docs, embeddings)
+if __name__ == "__main__":
+	# compaction pass only, e.g. from a periodic job
+	if "--compact" in sys.argv:
+		embeddings = get_embedder(EMBED_MODEL)
+		db = load_or_create_db(embeddings)
+		if db is not None:
+			compact_db(db, load_tombstones(), ChunkEmbeddingCache(EMBEDDING_CACHE_DIR, embeddings.cache_key))
+		sys.exit(0)
 
-	db.save_local(VECTOR_DB_DIR)
-	print(f"Embedded and stored {len(docs)} documents in FAISS.")
+	# rebuild (and retrain) the index as INGEST_INDEX_TYPE with the current settings
+	if "--rebuild-index" in sys.argv:
+		embeddings = get_embedder(EMBED_MODEL)
+		db = load_or_create_db(embeddings)
+		if db is not None and update_index_type(db, ChunkEmbeddingCache(EMBEDDING_CACHE_DIR, embeddings.cache_key), force=True):
+			save_db(db, load_tombstones())
+		sys.exit(0)
 
-if __name__ == "__main__":
 	# load manifest and Moodle metadata
 	manifest = load_manifest(MANIFEST_PATH)
 
 	with open("moodle_file_metadata.json", "r") as f:
 		moodle_metadata = json.load(f)
 
-	# embed only new or changed files
-	new_docs = load_and_split_new_docs(DOCS_DIR, manifest, moodle_metadata)
-	embed_and_store(new_docs)
-	save_manifest(manifest, MANIFEST_PATH)
+	# embed only new or changed files, streaming chunks from the parser workers into the embedding batches
+	live_files = set(list_document_files(DOCS_DIR))
+	# --rechunk re-chunks every file from the parsed text cache, e.g. after changing INGEST_CHUNK_SIZE
+	parsed_files = iter_new_doc_chunks(DOCS_DIR, manifest, moodle_metadata, rechunk="--rechunk" in sys.argv)
+	embedded = embed_and_store_files(parsed_files, manifest, live_files=live_files)
+	print(f"Embedded and stored {embedded} documents in FAISS.")
 
+	# drop the parsed text of files that have changed or been removed
+	ParsedDocumentCache(PARSED_CACHE_DIR).prune({entry["hash"] for entry in manifest.values()})
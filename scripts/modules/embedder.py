@@ -0,0 +1,228 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Callable
+import numpy as np
+from numpy.typing import NDArray
+from langchain.embeddings.base import Embeddings
+from transformers import AutoTokenizer
+
+EMBED_MODEL = "BAAI/bge-small-en"
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch") # torch, onnx or onnx-int8
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", len(os.sched_getaffinity(0)))) # inference threads, defaults to the cores this process may use
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32")) # texts per forward pass
+EMBED_QUERY_WAIT_MS = float(os.getenv("EMBED_QUERY_WAIT_MS", "5")) # how long a query waits for others to batch with
+EMBED_ONNX_DIR = os.getenv("EMBED_ONNX_DIR", "embedding_model_onnx")
+MAX_LENGTH = 512
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+_embedders = {}
+_embedders_lock = threading.Lock()
+
+
+def cache_key(model_name: str = EMBED_MODEL, backend: str = EMBED_BACKEND) -> str:
+	"""
+	Returns the name vectors embedded by a model and backend are cached under. The fp32 backends produce the same
+	vectors, int8 vectors differ slightly and are cached separately.
+
+	Args:
+		model_name (str): The Hugging Face model name.
+		backend (str): One of BACKENDS.
+
+	Returns:
+		str: The cache key.
+	"""
+	return f"{model_name}:int8" if backend == "onnx-int8" else model_name
+
+def export_onnx(model_name: str, onnx_dir: str, quantize: bool) -> str:
+	"""
+	Exports a Hugging Face encoder to ONNX, and optionally quantizes its weights to int8, the first time it is used.
+
+	Args:
+		model_name (str): The Hugging Face model name.
+		onnx_dir (str): The directory the exported models are kept in.
+		quantize (bool): Whether to return the int8 quantized model.
+
+	Returns:
+		str: The path of the ONNX model.
+	"""
+	import torch
+	from transformers import AutoModel
+
+	model_dir = os.path.join(onnx_dir, model_name.replace("/", "__"))
+	fp32_path = os.path.join(model_dir, "model.onnx")
+	int8_path = os.path.join(model_dir, "model.int8.onnx")
+	os.makedirs(model_dir, exist_ok=True)
+
+	if not os.path.exists(fp32_path):
+		tokenizer = AutoTokenizer.from_pretrained(model_name)
+		model = AutoModel.from_pretrained(model_name).eval()
+		inputs = tokenizer(["export"], return_tensors="pt")
+		names = list(inputs.keys())
+		axes = {name: {0: "batch", 1: "sequence"} for name in names}
+		axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+		torch.onnx.export(model, tuple(inputs[name] for name in names), f"{fp32_path}.tmp", input_names=names,
+			output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=14)
+		os.replace(f"{fp32_path}.tmp", fp32_path)
+
+	if quantize and not os.path.exists(int8_path):
+		from onnxruntime.quantization import quantize_dynamic, QuantType
+		quantize_dynamic(fp32_path, f"{int8_path}.tmp", weight_type=QuantType.QInt8)
+		os.replace(f"{int8_path}.tmp", int8_path)
+
+	return int8_path if quantize else fp32_path
+
+
+class QueryBatcher:
+	"""
+	Collects queries embedded concurrently (e.g. by the query server's threads) into a single forward pass.
+	A query waits at most max_wait seconds for others to arrive, so a lone query is barely delayed while a
+	burst of queries costs about one batch instead of one pass each.
+	"""
+	def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]], max_batch: int = EMBED_BATCH_SIZE, max_wait: float = EMBED_QUERY_WAIT_MS / 1000):
+		self.embed_batch = embed_batch
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.queue = queue.Queue()
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def embed(self, text: str) -> List[float]:
+		"""
+		Embeds a single query, batched with any others waiting.
+
+		Args:
+			text (str): The query.
+
+		Returns:
+			List[float]: The embedding of the query.
+		"""
+		future = Future()
+		self.queue.put((text, future))
+		return future.result()
+
+	def run(self):
+		while True:
+			items = [self.queue.get()]
+			deadline = time.monotonic() + self.max_wait
+			while len(items) < self.max_batch:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				try:
+					items.append(self.queue.get(timeout=remaining))
+				except queue.Empty:
+					break
+			try:
+				vectors = self.embed_batch([text for text, _ in items])
+			except Exception as e:
+				for _, future in items:
+					future.set_exception(e)
+				continue
+			for (_, future), vector in zip(items, vectors):
+				future.set_result(vector)
+
+
+class Embedder(Embeddings):
+	"""
+	The embedding model shared by ingest and the query path, with a pluggable CPU inference backend: PyTorch,
+	ONNX Runtime, or ONNX Runtime with int8 quantized weights. Embeddings use CLS pooling and L2 normalisation,
+	the same as the sentence-transformers configuration of the bge models, so every backend produces
+	(approximately, for int8) the same vectors as HuggingFaceEmbeddings.
+	"""
+	def __init__(self, model_name: str = EMBED_MODEL, backend: str = EMBED_BACKEND, threads: int = EMBED_THREADS, batch_size: int = EMBED_BATCH_SIZE):
+		if backend not in BACKENDS:
+			raise ValueError(f"Unknown embedding backend {backend!r}, expected one of {BACKENDS}")
+		self.model_name = model_name
+		self.backend = backend
+		self.batch_size = batch_size
+		self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+		if backend == "torch":
+			import torch
+			from transformers import AutoModel
+			torch.set_num_threads(threads)
+			self.model = AutoModel.from_pretrained(model_name).eval()
+		else:
+			import onnxruntime
+			options = onnxruntime.SessionOptions()
+			options.intra_op_num_threads = threads
+			options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+			path = export_onnx(model_name, EMBED_ONNX_DIR, quantize=backend == "onnx-int8")
+			self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+			self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+		self.batcher = QueryBatcher(self.embed_documents, batch_size)
+
+	@property
+	def cache_key(self) -> str:
+		return cache_key(self.model_name, self.backend)
+
+	def encode(self, texts: List[str]) -> NDArray[np.float32]:
+		"""
+		Runs one forward pass over a batch of texts.
+
+		Args:
+			texts (List[str]): The texts to embed.
+
+		Returns:
+			NDArray[np.float32]: The normalised CLS embeddings, one row per text.
+		"""
+		inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors="np")
+		if self.backend == "torch":
+			import torch
+			with torch.inference_mode():
+				hidden = self.model(**{name: torch.from_numpy(value) for name, value in inputs.items()}).last_hidden_state.numpy()
+		else:
+			hidden = self.session.run(None, {name: value.astype(np.int64) for name, value in inputs.items() if name in self.input_names})[0]
+		cls = hidden[:, 0]
+		return cls / np.linalg.norm(cls, axis=1, keepdims=True)
+
+	def embed_documents(self, texts: List[str]) -> List[List[float]]:
+		"""
+		Embeds texts in batches of similar length, so little of each batch is padding.
+
+		Args:
+			texts (List[str]): The texts to embed.
+
+		Returns:
+			List[List[float]]: The embeddings, in the same order as the texts.
+		"""
+		order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+		vectors = [None] * len(texts)
+		for start in range(0, len(order), self.batch_size):
+			batch = order[start:start + self.batch_size]
+			for i, vector in zip(batch, self.encode([texts[i] for i in batch])):
+				vectors[i] = vector.tolist()
+		return vectors
+
+	def embed_query(self, text: str) -> List[float]:
+		"""
+		Embeds a query, batched with any queries embedded at the same time.
+
+		Args:
+			text (str): The query.
+
+		Returns:
+			List[float]: The embedding of the query.
+		"""
+		return self.batcher.embed(text)
+
+
+def get_embedder(model_name: str = EMBED_MODEL, backend: str = EMBED_BACKEND) -> Embedder:
+	"""
+	Returns the process-wide embedder for a model and backend, loading it the first time.
+
+	Args:
+		model_name (str): The Hugging Face model name.
+		backend (str): One of BACKENDS.
+
+	Returns:
+		Embedder: The shared embedder.
+	"""
+	with _embedders_lock:
+		key = (model_name, backend)
+		if key not in _embedders:
+			_embedders[key] = Embedder(model_name, backend)
+		return _embedders[key]
@@ -0,0 +1,199 @@
+import os
+import json
+import hashlib
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterator, Tuple, Optional
+
+HASH_ALGORITHM = "blake2b"
+HASH_BLOCK_SIZE = 1024 * 1024 # bytes read at a time while hashing
+HASH_WORKERS = int(os.getenv("INGEST_HASH_WORKERS", "8")) # files hashed at once, hashlib releases the GIL on large reads
+JOURNAL_SUFFIX = ".journal"
+COMPACT_JOURNAL_RATIO = 1.0 # rewrite the snapshot once the journal holds this many records per manifest entry
+
+
+def hash_file(path: str, algorithm: str = HASH_ALGORITHM) -> str:
+	"""
+	Hashes a file, reading it in blocks so large files are never held in memory.
+
+	Args:
+		path (str): The file path of the file to be hashed.
+		algorithm (str): The hashlib algorithm, blake2b or md5 for manifests written before blake2b was used.
+
+	Returns:
+		str: A charset of hexidecimal digits representing the hashed value.
+	"""
+	digest = hashlib.blake2b(digest_size=16) if algorithm == "blake2b" else hashlib.new(algorithm)
+	with open(path, "rb") as f:
+		while block := f.read(HASH_BLOCK_SIZE):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def file_stat(path: str) -> Dict:
+	stat = os.stat(path)
+	return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class FileManifest(MutableMapping):
+	"""
+	The record of which files have been ingested, mapping each filename to its content hash, size and
+	modification time. The manifest is a JSON snapshot plus an append-only journal of changes since the
+	snapshot. commit() appends the changes made since the last commit followed by a commit marker and fsyncs,
+	so a crash mid-run keeps everything committed before it, and a half written batch at the end of the
+	journal is ignored on load. Once the journal grows as large as the manifest it is folded into a new
+	snapshot.
+
+	Snapshots written before the journal was added map filenames straight to md5 hashes; they are loaded as
+	entries without a size or modification time and upgraded the first time each file is checked.
+	"""
+	def __init__(self, path: str):
+		self.path = path
+		self.journal_path = f"{path}{JOURNAL_SUFFIX}"
+		self.entries = {}
+		self.changes = {} # filename -> new entry, or None if removed, since the last commit
+		self.journal_records = 0
+		self.load()
+
+	def load(self):
+		"""
+		Loads the snapshot and replays the committed batches of the journal.
+
+		Returns:
+			None
+		"""
+		if os.path.exists(self.path):
+			with open(self.path, "r") as f:
+				snapshot = json.load(f)
+			self.entries = {file: entry if isinstance(entry, dict) else {"hash": entry, "algorithm": "md5"} for file, entry in snapshot.items()}
+		if not os.path.exists(self.journal_path):
+			return
+
+		batch = {}
+		committed_bytes = 0
+		with open(self.journal_path, "rb") as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					break # a torn write at the end of the journal
+				if not line.endswith(b"\n"):
+					break
+				if "commit" in record:
+					for file, entry in batch.items():
+						if entry is None:
+							self.entries.pop(file, None)
+						else:
+							self.entries[file] = entry
+					self.journal_records += len(batch)
+					batch = {}
+					committed_bytes = f.tell()
+				else:
+					batch[record["file"]] = record.get("entry")
+
+		# drop the uncommitted tail so new batches are appended after the last commit
+		if committed_bytes != os.path.getsize(self.journal_path):
+			with open(self.journal_path, "r+b") as f:
+				f.truncate(committed_bytes)
+
+	def __getitem__(self, file: str) -> Dict:
+		return self.entries[file]
+
+	def __setitem__(self, file: str, entry: Dict):
+		self.entries[file] = entry
+		self.changes[file] = entry
+
+	def __delitem__(self, file: str):
+		del self.entries[file]
+		self.changes[file] = None
+
+	def __iter__(self) -> Iterator[str]:
+		return iter(self.entries)
+
+	def __len__(self) -> int:
+		return len(self.entries)
+
+	def commit(self):
+		"""
+		Appends the changes since the last commit to the journal as one durable batch, compacting the journal
+		into the snapshot once it is large.
+
+		Returns:
+			None
+		"""
+		if not self.changes:
+			return
+		lines = [json.dumps({"file": file, "entry": entry}) for file, entry in self.changes.items()]
+		lines.append(json.dumps({"commit": len(self.changes)}))
+		with open(self.journal_path, "a") as f:
+			f.write("\n".join(lines) + "\n")
+			f.flush()
+			os.fsync(f.fileno())
+		self.journal_records += len(self.changes)
+		self.changes = {}
+		if self.journal_records > COMPACT_JOURNAL_RATIO * max(len(self.entries), 1):
+			self.compact()
+
+	def compact(self):
+		"""
+		Writes every entry to a new snapshot and empties the journal.
+
+		Returns:
+			None
+		"""
+		# write through a temporary file so a crash mid-write can't corrupt the manifest
+		with open(f"{self.path}.tmp", "w") as f:
+			json.dump(self.entries, f, indent=2)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(f"{self.path}.tmp", self.path)
+		# the journal only holds changes already in the snapshot, so replaying it after a crash here is harmless
+		open(self.journal_path, "w").close()
+		self.journal_records = 0
+
+	def is_unchanged(self, file: str, stat: Dict) -> bool:
+		entry = self.entries.get(file)
+		return entry is not None and entry.get("size") == stat["size"] and entry.get("mtime_ns") == stat["mtime_ns"]
+
+
+def detect_changed_files(doc_folder: str, files: List[str], manifest: FileManifest, workers: int = HASH_WORKERS) -> List[Tuple[str, Dict]]:
+	"""
+	Finds the files whose content has changed since they were ingested. A file whose size and modification time
+	match the manifest is unchanged without being read. The others are hashed in parallel, and those whose hash
+	still matches (e.g. re-downloaded but identical) have their new size and modification time committed so they
+	are not hashed again.
+
+	Args:
+		doc_folder (str): The directory the files are in.
+		files (List[str]): The filenames to check.
+		manifest (FileManifest): The manifest of ingested files.
+		workers (int): The number of files hashed at once.
+
+	Returns:
+		List[Tuple[str, Dict]]: The filename and new manifest entry of each new or changed file, to be stored in
+			the manifest once the file has been ingested.
+	"""
+	to_hash = []
+	for file in files:
+		stat = file_stat(os.path.join(doc_folder, file))
+		if not manifest.is_unchanged(file, stat):
+			to_hash.append((file, stat))
+
+	def check(file: str, stat: Dict) -> Tuple[str, Dict, Optional[str]]:
+		path = os.path.join(doc_folder, file)
+		entry = {"hash": hash_file(path), "algorithm": HASH_ALGORITHM, **stat}
+		old = manifest.get(file)
+		if old is None:
+			return file, entry, None
+		old_hash = entry["hash"] if old.get("algorithm", HASH_ALGORITHM) == HASH_ALGORITHM else hash_file(path, old["algorithm"])
+		return file, entry, old_hash if old_hash == old["hash"] else None
+
+	changed = []
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for file, entry, unchanged_hash in executor.map(lambda args: check(*args), to_hash):
+			if unchanged_hash is None:
+				changed.append((file, entry))
+			else:
+				manifest[file] = entry
+	manifest.commit()
+	return changed
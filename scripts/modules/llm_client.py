@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from typing import List, Dict, Iterator, AsyncIterator
+import requests
+from requests.adapters import HTTPAdapter
+
+LLM_MODEL = os.getenv("LLM_MODEL", "llama3.2:3b")
+OLLAMA_ENDPOINTS = os.getenv("OLLAMA_ENDPOINTS", os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")) # comma separated list of Ollama servers
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m") # how long Ollama keeps the model loaded after a request
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "120")) # seconds without a byte from Ollama before a request fails
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2")) # generations running at once on each endpoint
+OLLAMA_MAX_QUEUE = int(os.getenv("OLLAMA_MAX_QUEUE", "32")) # generations waiting for a slot before new ones are refused
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "60")) # seconds a generation may wait for a slot
+OLLAMA_RETRY_AFTER = float(os.getenv("OLLAMA_RETRY_AFTER", "10")) # seconds an endpoint that failed to connect is skipped
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class LLMBusyError(Exception):
+	"""
+	Raised when a generation can't get a slot on any endpoint, because the queue is full or the wait timed out.
+	"""
+
+
+class OllamaEndpoint:
+	"""
+	An Ollama server and its load.
+	"""
+	def __init__(self, base_url: str):
+		self.base_url = base_url.rstrip("/")
+		self.inflight = 0
+		self.completed = 0
+		self.errors = 0
+		self.down_until = 0.0
+
+	def available(self, max_concurrency: int) -> bool:
+		return self.inflight < max_concurrency and self.down_until <= time.monotonic()
+
+
+class LLMClient:
+	"""
+	A shared client for one or more Ollama servers. Requests go through a pooled HTTP session with connect and
+	read timeouts and ask Ollama to keep the model loaded. At most max_concurrency generations run on each
+	endpoint; further generations wait in a bounded queue and are routed to the least loaded endpoint as slots
+	free up. Endpoints that refuse connections are skipped for a while and the generation is retried elsewhere.
+	"""
+	def __init__(self, endpoints: List[str] = None, model: str = LLM_MODEL, keep_alive: str = OLLAMA_KEEP_ALIVE,
+			max_concurrency: int = OLLAMA_MAX_CONCURRENCY, max_queue: int = OLLAMA_MAX_QUEUE, queue_timeout: float = OLLAMA_QUEUE_TIMEOUT,
+			timeout: tuple = (OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)):
+		if endpoints is None:
+			endpoints = [url.strip() for url in OLLAMA_ENDPOINTS.split(",") if url.strip()]
+		self.endpoints = [OllamaEndpoint(url) for url in endpoints]
+		self.model = model
+		self.keep_alive = keep_alive
+		self.max_concurrency = max_concurrency
+		self.max_queue = max_queue
+		self.queue_timeout = queue_timeout
+		self.timeout = timeout
+
+		pool_size = max_concurrency * len(self.endpoints)
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=pool_size)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+
+		self.condition = threading.Condition()
+		self.waiting = 0
+		self.max_waiting = 0
+		self.rejected = 0
+		self.wait_seconds = 0.0
+		self.acquired = 0
+
+	def acquire(self) -> OllamaEndpoint:
+		"""
+		Waits for a free slot and takes it on the least loaded endpoint.
+
+		Returns:
+			OllamaEndpoint: The endpoint to send the generation to.
+		"""
+		start = time.monotonic()
+		with self.condition:
+			if self.waiting >= self.max_queue:
+				self.rejected += 1
+				raise LLMBusyError(f"{self.waiting} generations are already waiting for the LLM")
+			self.waiting += 1
+			self.max_waiting = max(self.max_waiting, self.waiting)
+			try:
+				while True:
+					available = [endpoint for endpoint in self.endpoints if endpoint.available(self.max_concurrency)]
+					if available:
+						endpoint = min(available, key=lambda endpoint: (endpoint.inflight, endpoint.errors))
+						endpoint.inflight += 1
+						self.acquired += 1
+						self.wait_seconds += time.monotonic() - start
+						return endpoint
+					remaining = self.queue_timeout - (time.monotonic() - start)
+					if remaining <= 0:
+						self.rejected += 1
+						raise LLMBusyError(f"No LLM slot became free within {self.queue_timeout}s")
+					# wake up at least every second to notice endpoints coming back up
+					self.condition.wait(min(remaining, 1.0))
+			finally:
+				self.waiting -= 1
+
+	def release(self, endpoint: OllamaEndpoint, error: bool = False, down: bool = False):
+		with self.condition:
+			endpoint.inflight -= 1
+			if error:
+				endpoint.errors += 1
+			else:
+				endpoint.completed += 1
+			if down:
+				endpoint.down_until = time.monotonic() + OLLAMA_RETRY_AFTER
+			self.condition.notify()
+
+	def request_body(self, prompt: str, stream: bool, options: Dict) -> Dict:
+		body = {"model": self.model, "prompt": prompt, "stream": stream, "keep_alive": self.keep_alive}
+		if options:
+			body["options"] = options
+		return body
+
+	def stream(self, prompt: str, **options) -> Iterator[str]:
+		"""
+		Generates a completion, yielding the text as Ollama produces it. If an endpoint refuses the connection the
+		generation is retried on another endpoint.
+
+		Args:
+			prompt (str): The prompt.
+			**options: Ollama model options, e.g. temperature or num_ctx.
+
+		Yields:
+			str: The pieces of the generated text.
+		"""
+		attempts = len(self.endpoints)
+		for attempt in range(attempts):
+			endpoint = self.acquire()
+			error = False
+			down = False
+			started = False
+			try:
+				with self.session.post(f"{endpoint.base_url}/api/generate", json=self.request_body(prompt, True, options),
+						timeout=self.timeout, stream=True) as response:
+					response.raise_for_status()
+					for line in response.iter_lines():
+						if not line:
+							continue
+						frame = json.loads(line)
+						if frame.get("error"):
+							raise RuntimeError(f"Ollama error: {frame['error']}")
+						if frame.get("response"):
+							started = True
+							yield frame["response"]
+						if frame.get("done"):
+							break
+				return
+			except GeneratorExit:
+				# the consumer stopped reading, not an endpoint failure
+				raise
+			except requests.ConnectionError:
+				error = down = True
+				# only retry elsewhere if nothing has been generated yet
+				if started or attempt == attempts - 1:
+					raise
+			except Exception:
+				error = True
+				raise
+			finally:
+				self.release(endpoint, error, down)
+
+	def invoke(self, prompt: str, **options) -> str:
+		"""
+		Generates a completion and returns the whole text.
+
+		Args:
+			prompt (str): The prompt.
+			**options: Ollama model options.
+
+		Returns:
+			str: The generated text.
+		"""
+		return "".join(self.stream(prompt, **options))
+
+	def __call__(self, prompt: str, **options) -> str:
+		return self.invoke(prompt, **options)
+
+	async def astream(self, prompt: str, **options) -> AsyncIterator[str]:
+		"""
+		Async version of stream(), reading from Ollama on a worker thread so the event loop isn't blocked.
+
+		Args:
+			prompt (str): The prompt.
+			**options: Ollama model options.
+
+		Yields:
+			str: The pieces of the generated text.
+		"""
+		iterator = self.stream(prompt, **options)
+		done = object()
+		try:
+			while True:
+				chunk = await asyncio.to_thread(next, iterator, done)
+				if chunk is done:
+					return
+				yield chunk
+		finally:
+			# frees the endpoint slot if the consumer stopped early
+			iterator.close()
+
+	def metrics(self) -> Dict:
+		"""
+		Returns the queue and endpoint counters.
+
+		Returns:
+			Dict: The current and maximum queue depth, rejected generations, average queue wait and the load of each endpoint.
+		"""
+		with self.condition:
+			return {
+				"queue_depth": self.waiting,
+				"max_queue_depth": self.max_waiting,
+				"rejected": self.rejected,
+				"average_wait_seconds": self.wait_seconds / self.acquired if self.acquired else 0.0,
+				"endpoints": {
+					endpoint.base_url: {
+						"inflight": endpoint.inflight,
+						"completed": endpoint.completed,
+						"errors": endpoint.errors,
+						"down": endpoint.down_until > time.monotonic()
+					}
+					for endpoint in self.endpoints
+				}
+			}
+
+
+def get_llm_client() -> LLMClient:
+	"""
+	Returns the process-wide LLM client.
+
+	Returns:
+		LLMClient: The shared LLM client.
+	"""
+	global _client
+	with _client_lock:
+		if _client is None:
+			_client = LLMClient()
+		return _client
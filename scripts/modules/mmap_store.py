@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import shutil
+from collections.abc import Mapping
+from typing import List, Dict, Iterator, Optional, Union
+import numpy as np
+import faiss
+from langchain.vectorstores import FAISS
+from langchain.embeddings.base import Embeddings
+from langchain.docstore.document import Document
+from modules.course_retrieval import document_course_ids, document_course_urls
+
+MMAP_INDEX_FILE = "index.mmap.faiss"
+TEXT_FILE = "docstore_text.bin"
+TEXT_OFFSETS_FILE = "docstore_text_offsets.npy"
+COURSE_OFFSETS_FILE = "docstore_course_offsets.npy"
+COURSE_IDS_FILE = "docstore_course_ids.npy"
+COURSE_URL_IDS_FILE = "docstore_course_url_ids.npy"
+URL_IDS_FILE = "docstore_url_ids.npy"
+START_INDEX_FILE = "docstore_start_index.npy"
+URLS_FILE = "docstore_urls.json"
+MMAP_DIR = "mmap" # each export is a generation directory in here
+MMAP_CURRENT_FILE = "mmap_current" # names the generation readers open, swapped in with one rename
+MMAP_KEEP_GENERATIONS = 2 # the newest generations kept, so a reader that has just read the pointer can still open its files
+
+# map IVF inverted lists, and the vectors of flat indexes on faiss versions that support it, instead of reading them in
+MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+
+class PositionalIds(Mapping):
+	"""
+	The FAISS vector ID -> docstore ID mapping of an exported store. Documents are exported in vector order,
+	so a vector's docstore ID is its own ID and no dictionary has to be built on load.
+	"""
+	def __init__(self, ntotal: int):
+		self.ntotal = ntotal
+
+	def __getitem__(self, faiss_id: int) -> int:
+		if not 0 <= faiss_id < self.ntotal:
+			raise KeyError(faiss_id)
+		return faiss_id
+
+	def __iter__(self) -> Iterator[int]:
+		return iter(range(self.ntotal))
+
+	def __len__(self) -> int:
+		return self.ntotal
+
+
+class ColumnarDocstore:
+	"""
+	A read-only docstore exported from the FAISS docstore and stored by column instead of as pickled Documents.
+	The text of every chunk is one UTF-8 buffer located through an offsets array, the courses of each chunk are
+	an integer column (with offsets, as a chunk shared between courses has several), each chunk's Moodle URL,
+	and its URL in each of its courses, is an index into a table of the distinct URLs, and its character offset in the source file is an integer column. The buffer and columns are memory mapped, so opening the store
+	allocates almost nothing, and a Document is only built for the chunks a search returns.
+	"""
+	def __init__(self, export_dir: str):
+		text_path = os.path.join(export_dir, TEXT_FILE)
+		# numpy can't map an empty file
+		if os.path.getsize(text_path):
+			self.text = np.memmap(text_path, dtype=np.uint8, mode="r")
+		else:
+			self.text = np.empty(0, dtype=np.uint8)
+		self.text_offsets = np.load(os.path.join(export_dir, TEXT_OFFSETS_FILE), mmap_mode="r")
+		self.course_offsets = np.load(os.path.join(export_dir, COURSE_OFFSETS_FILE), mmap_mode="r")
+		self.course_column = np.load(os.path.join(export_dir, COURSE_IDS_FILE), mmap_mode="r")
+		self.course_url_ids = np.load(os.path.join(export_dir, COURSE_URL_IDS_FILE), mmap_mode="r")
+		self.url_ids = np.load(os.path.join(export_dir, URL_IDS_FILE), mmap_mode="r")
+		self.start_index = np.load(os.path.join(export_dir, START_INDEX_FILE), mmap_mode="r")
+		with open(os.path.join(export_dir, URLS_FILE), "r") as f:
+			self.urls = json.load(f)
+
+	def page_content(self, position: int) -> str:
+		return self.text[self.text_offsets[position]:self.text_offsets[position + 1]].tobytes().decode("utf-8")
+
+	def course_ids(self, position: int) -> List[int]:
+		return self.course_column[self.course_offsets[position]:self.course_offsets[position + 1]].tolist()
+
+	def url(self, position: int) -> Optional[str]:
+		url_id = self.url_ids[position]
+		return self.urls[url_id] if url_id >= 0 else None
+
+	def course_urls(self, position: int) -> Dict[int, str]:
+		start, end = self.course_offsets[position], self.course_offsets[position + 1]
+		course_ids = self.course_column[start:end].tolist()
+		return {course_id: self.urls[url_id] for course_id, url_id in zip(course_ids, self.course_url_ids[start:end].tolist()) if url_id >= 0}
+
+	def search(self, docstore_id: Union[int, str]) -> Union[Document, str]:
+		"""
+		Looks up a document by its docstore ID, which is the ID of its vector.
+
+		Args:
+			docstore_id (Union[int, str]): The docstore ID of the document.
+
+		Returns:
+			Union[Document, str]: The document, or an error message if there is no document with that ID.
+		"""
+		position = int(docstore_id)
+		if not 0 <= position < len(self):
+			return f"ID {docstore_id} not found."
+		course_ids = self.course_ids(position)
+		metadata = {
+			"moodle_url": self.url(position),
+			"course_id": course_ids[0] if course_ids else None,
+			"course_ids": course_ids,
+			"course_urls": self.course_urls(position)
+		}
+		if self.start_index[position] >= 0:
+			metadata["start_index"] = int(self.start_index[position])
+		return Document(page_content=self.page_content(position), metadata=metadata)
+
+	def __len__(self) -> int:
+		return len(self.text_offsets) - 1
+
+
+def current_mmap_dir(index_dir: str) -> Optional[str]:
+	"""
+	Finds the directory of the newest complete export.
+
+	Args:
+		index_dir (str): The FAISS index directory.
+
+	Returns:
+		str: The export's directory, or None if the store has not been exported.
+	"""
+	try:
+		with open(os.path.join(index_dir, MMAP_CURRENT_FILE), "r") as f:
+			generation = f.read().strip()
+	except FileNotFoundError:
+		return None
+	path = os.path.join(index_dir, MMAP_DIR, generation)
+	return path if generation and os.path.isdir(path) else None
+
+def export_mmap_store(db: FAISS, index_dir: str):
+	"""
+	Exports a FAISS store to the memory mappable format read by load_mmap_db. Only the metadata used at query time
+	is kept: the Moodle URL, courses, URL in each course and start offset of each chunk. Every export is written
+	to a new generation directory and published by renaming a pointer file naming it, so a reader always opens
+	one complete set of files, never columns from two exports. Processes that have an older generation mapped
+	keep a consistent copy of it.
+
+	Args:
+		db (FAISS): The FAISS vector store.
+		index_dir (str): The FAISS index directory.
+
+	Returns:
+		None
+	"""
+	generation = str(time.time_ns())
+	export_dir = os.path.join(index_dir, MMAP_DIR, generation)
+	os.makedirs(export_dir)
+	paths = {name: os.path.join(export_dir, name) for name in
+		(TEXT_FILE, TEXT_OFFSETS_FILE, COURSE_OFFSETS_FILE, COURSE_IDS_FILE, COURSE_URL_IDS_FILE, URL_IDS_FILE, START_INDEX_FILE, URLS_FILE, MMAP_INDEX_FILE)}
+
+	text_offsets = [0]
+	course_offsets = [0]
+	course_column = []
+	course_url_ids = []
+	url_ids = []
+	start_index = []
+	urls = {} # URL -> index in the URL table
+	with open(paths[TEXT_FILE], "wb") as f:
+		for faiss_id in range(db.index.ntotal):
+			doc = db.docstore.search(db.index_to_docstore_id[faiss_id])
+			text = doc.page_content.encode("utf-8")
+			f.write(text)
+			text_offsets.append(text_offsets[-1] + len(text))
+			url = doc.metadata.get("moodle_url")
+			url_ids.append(urls.setdefault(url, len(urls)) if url else -1)
+			course_urls = document_course_urls(doc)
+			for course_id in sorted(document_course_ids(doc)):
+				course_column.append(course_id)
+				course_url = course_urls.get(course_id, url)
+				course_url_ids.append(urls.setdefault(course_url, len(urls)) if course_url else -1)
+			course_offsets.append(len(course_column))
+			start_index.append(doc.metadata.get("start_index", -1)) # chunks ingested before offsets were recorded have none
+
+	columns = {
+		TEXT_OFFSETS_FILE: np.array(text_offsets, dtype=np.int64),
+		COURSE_OFFSETS_FILE: np.array(course_offsets, dtype=np.int64),
+		COURSE_IDS_FILE: np.array(course_column, dtype=np.int32),
+		COURSE_URL_IDS_FILE: np.array(course_url_ids, dtype=np.int32),
+		URL_IDS_FILE: np.array(url_ids, dtype=np.int32),
+		START_INDEX_FILE: np.array(start_index, dtype=np.int64)
+	}
+	for name, column in columns.items():
+		with open(paths[name], "wb") as f:
+			np.save(f, column)
+	with open(paths[URLS_FILE], "w") as f:
+		json.dump(list(urls), f)
+	faiss.write_index(db.index, paths[MMAP_INDEX_FILE])
+
+	pointer = os.path.join(index_dir, MMAP_CURRENT_FILE)
+	with open(f"{pointer}.tmp", "w") as f:
+		f.write(generation)
+	os.replace(f"{pointer}.tmp", pointer)
+
+	# mapped files stay readable after they are deleted, older generations only have to outlive readers opening them
+	generations = sorted(os.listdir(os.path.join(index_dir, MMAP_DIR)), key=int)
+	for old in generations[:-MMAP_KEEP_GENERATIONS]:
+		shutil.rmtree(os.path.join(index_dir, MMAP_DIR, old), ignore_errors=True)
+	# exports written before generations were added sit directly in the index directory
+	for path in paths:
+		if os.path.exists(os.path.join(index_dir, path)):
+			os.remove(os.path.join(index_dir, path))
+
+def load_mmap_db(index_dir: str, embeddings: Embeddings) -> Optional[FAISS]:
+	"""
+	Opens an exported FAISS store read-only through memory maps, which takes milliseconds and lets several query
+	processes on a host share the index through the page cache instead of each loading its own copy.
+
+	Args:
+		index_dir (str): The FAISS index directory.
+		embeddings (Embeddings): The embedding model the index was built with.
+
+	Returns:
+		FAISS: The FAISS vector store, or None if the store has not been exported.
+	"""
+	# exports written before generations were added fall back to the pickle until the next ingest
+	export_dir = current_mmap_dir(index_dir)
+	if export_dir is None:
+		return None
+	index = faiss.read_index(os.path.join(export_dir, MMAP_INDEX_FILE), MMAP_FLAGS)
+	return FAISS(embeddings, index, ColumnarDocstore(export_dir), PositionalIds(index.ntotal))
@@ -1,11 +1,15 @@
 import os
 import logging
+import datetime
+import threading
 from typing import List, Dict
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.errors import ConnectionFailure, BulkWriteError
+from bson.binary import Binary
 import numpy as np
 from numpy.typing import NDArray
 from dotenv import load_dotenv
+from modules.chunk_cache import chunk_hash
 
 
 load_dotenv()
@@ -15,7 +19,39 @@ MONGODB_DATABASE: str = os.getenv('MONGODB_DATABASE') #e.g., "mydatabase"
 MONGODB_COLLECTION_EMBEDDINGS: str = os.getenv('MONGODB_COLLECTION_CONTEXTEMBEDDINGS') # e.g., "embeddings"
 MONGODB_COLLECTION_CONVERSATIONS: str = os.getenv('MONGODB_COLLECTION_CONVERSATIONS')  # e.g., "conversations"
 MONGODB_COLLECTION_USERS: str = os.getenv('MONGODB_COLLECTION_USERS')  # e.g., "users"
+MONGODB_MAX_POOL_SIZE: int = int(os.getenv('MONGODB_MAX_POOL_SIZE', '50')) # connections per server in the shared client's pool
+MONGODB_TIMEOUT_MS: int = int(os.getenv('MONGODB_TIMEOUT_MS', '5000')) # server selection and connect timeout
+MONGODB_BATCH_SIZE: int = int(os.getenv('MONGODB_BATCH_SIZE', '500')) # writes sent to the server in one bulk_write
 
+_clients = {}
+_clients_lock = threading.Lock()
+_indexed_collections = set()
+
+
+def get_mongodb_client(connection_string: str = MONGODB_SERVER) -> MongoClient:
+	"""
+	Returns the process-wide client for a MongoDB server, creating it the first time. MongoClient is thread safe
+	and pools its connections, so every caller in the process shares one pool instead of opening new connections.
+
+	Args:
+		connection_string (str): The MongoDB connection URL string (defaults to localhost on port 27017)
+
+	Returns:
+		MongoClient: The shared client.
+	"""
+	with _clients_lock:
+		client = _clients.get(connection_string)
+		if client is None:
+			client = MongoClient(connection_string, maxPoolSize=MONGODB_MAX_POOL_SIZE,
+				serverSelectionTimeoutMS=MONGODB_TIMEOUT_MS, connectTimeoutMS=MONGODB_TIMEOUT_MS)
+
+			# check the initial connection before going further
+			# primary node/main node refers to read and write node (secondary nodes are read only)
+			if not client.is_primary:
+				client.close()
+				raise ConnectionError('Failed to connect to MongoDB server. Server cannot be reached.')
+			_clients[connection_string] = client
+		return client
 
 def mongodb_connection(db_name: str, collection_name: str, connection_string: str = MONGODB_SERVER) -> object:
 	"""
@@ -27,32 +63,112 @@ def mongodb_connection(db_name: str, collection_name: str, connection_string: st
 		connection_string (str): The MongoDB connection URL string (defaults to localhost on port 27017)
 
 	Returns:
-		Collection (object): The collection database connection.    
+		Collection (object): The collection database connection.
 	"""
 	try:
-		# establish MongoDB client connection
-		client = MongoClient(connection_string)
-
-		# check the initial connection before going further
-		# primary node/main node refers to read and write node (secondary nodes are read only)
-		if not client.is_primary:
-			raise ConnectionError('Failed to connect to MongoDB server. Server cannot be reached.')
-
-		# access the database and the collection
+		# access the database and the collection through the shared client
+		client = get_mongodb_client(connection_string)
 		db = client[db_name]
 		collection = db[collection_name]
 
-		return collection    
+		return collection
 	except ConnectionFailure as e:
 		logging.error(f'Connection Error: {e}')
 
-def store_data_in_mongodb(context_data: List[Dict[str, str]], context_embeddings: NDArray[np.float32]) -> None:
+def encode_embedding(embedding: NDArray[np.float32]) -> Binary:
+	"""
+	Packs an embedding as little-endian float32 bytes, a quarter of the size of a BSON array of doubles.
+
+	Args:
+		embedding (NDArray[np.float32]): The embedding vector.
+
+	Returns:
+		Binary: The packed embedding.
+	"""
+	return Binary(np.asarray(embedding, dtype='<f4').tobytes())
+
+def decode_embedding(value) -> NDArray[np.float32]:
+	"""
+	Unpacks an embedding stored by encode_embedding, or stored as a list of floats before embeddings were packed.
+
+	Args:
+		value (Binary | list): The stored embedding.
+
+	Returns:
+		NDArray[np.float32]: The embedding vector.
 	"""
-	Store context data and embeddings in MongoDB.
+	if isinstance(value, (bytes, bytearray)):
+		return np.frombuffer(value, dtype='<f4')
+	return np.asarray(value, dtype=np.float32)
+
+def migrate_legacy_embeddings(collection, batch_size: int = MONGODB_BATCH_SIZE) -> Dict[str, int]:
+	"""
+	Backfills the chunk hash of documents stored before chunks were keyed by hash, and deletes those that
+	duplicate a document already stored with a hash (e.g. from a re-run of the ingest), so they are updated in
+	place from then on instead of being kept next to the new copies. Relies on the unique course and chunk hash
+	index: a backfill that collides with it is a duplicate.
+
+	Args:
+		collection (Collection): The context embeddings collection.
+		batch_size (int): The number of documents updated in one round trip.
+
+	Returns:
+		Dict[str, int]: The number of legacy documents 'backfilled' and 'deleted'.
+	"""
+	counts = {'backfilled': 0, 'deleted': 0}
+	legacy = collection.find({'chunk_hash': {'$exists': False}}, {'context': 1})
+	while True:
+		documents = [document for _, document in zip(range(batch_size), legacy)]
+		if not documents:
+			break
+		operations = [UpdateOne({'_id': document['_id']}, {'$set': {'chunk_hash': chunk_hash(document['context'])}}) for document in documents]
+		duplicates = []
+		try:
+			result = collection.bulk_write(operations, ordered=False)
+			counts['backfilled'] += result.modified_count
+		except BulkWriteError as e:
+			counts['backfilled'] += e.details.get('nModified', 0)
+			duplicates = [documents[error['index']]['_id'] for error in e.details.get('writeErrors', []) if error.get('code') == 11000]
+		if duplicates:
+			counts['deleted'] += collection.delete_many({'_id': {'$in': duplicates}}).deleted_count
+	if counts['backfilled'] or counts['deleted']:
+		print(f"Migrated legacy context embeddings ({counts['backfilled']} given a chunk hash, {counts['deleted']} duplicates deleted).")
+	return counts
+
+def ensure_embedding_indexes(collection):
+	"""
+	Creates the indexes of the context embeddings collection once per process: a unique key of course and chunk
+	hash, so storing the same chunk again updates it instead of adding a copy, and course, creation time and ID, so a
+	course's embeddings can be read back in the order they were added. Documents stored before chunk hashes were
+	added are then migrated with migrate_legacy_embeddings.
+
+	Args:
+		collection (Collection): The context embeddings collection.
+
+	Returns:
+		None
+	"""
+	if collection.full_name in _indexed_collections:
+		return
+	# documents stored before chunk hashes were added have none, leave them out of the unique key
+	collection.create_index([('course_id', ASCENDING), ('chunk_hash', ASCENDING)], unique=True,
+		partialFilterExpression={'chunk_hash': {'$exists': True}})
+	collection.create_index([('course_id', ASCENDING), ('createdAt', ASCENDING), ('_id', ASCENDING)])
+	migrate_legacy_embeddings(collection)
+	_indexed_collections.add(collection.full_name)
+
+def store_data_in_mongodb(context_data: List[Dict[str, str]], context_embeddings: NDArray[np.float32], batch_size: int = MONGODB_BATCH_SIZE,
+		collection=None) -> None:
+	"""
+	Store context data and embeddings in MongoDB. Chunks are upserted by course and chunk hash in unordered batches,
+	so a re-run updates the existing documents instead of duplicating them, and embeddings are stored as packed
+	float32 binary.
 
 	Args:
 		context_data (List[Dict[str, str]]): Contextual data with text and URLs.
 		context_embeddings (NDArray[np.float32]): Corresponding vectorised context embeddings.
+		batch_size (int): The number of chunks written in one round trip.
+		collection (Collection): The collection to store to, the context embeddings collection if not given.
 
 	Returns:
 		None
@@ -60,21 +176,37 @@ def store_data_in_mongodb(context_data: List[Dict[str, str]], context_embeddings
 
 	try:
 		# mongodb collection connection
-		collection = mongodb_connection(MONGODB_DATABASE, MONGODB_COLLECTION_EMBEDDINGS)
-
-		# insert context data and corresponding embeddings into MongoDB
-		for idx, context in enumerate(context_data):#
-			document = {   
-				'context': context['context'],
-				'moodle_url': context['moodle_url'],
-				'course_id': context['course_id'],
-				'embedding': context_embeddings[idx].tolist(),
-				'createdAt': __import__('datetime').datetime.utcnow()
-			}
-			collection.insert_one(document)
-		print('Context embeddings stored successfully in MongoDB.') # terminal message
+		if collection is None:
+			collection = mongodb_connection(MONGODB_DATABASE, MONGODB_COLLECTION_EMBEDDINGS)
+		ensure_embedding_indexes(collection)
+
+		# upsert context data and corresponding embeddings into MongoDB, one round trip per batch
+		created_at = datetime.datetime.utcnow()
+		upserted = modified = 0
+		for start in range(0, len(context_data), batch_size):
+			operations = []
+			for idx in range(start, min(start + batch_size, len(context_data))):
+				context = context_data[idx]
+				key = {'course_id': context['course_id'], 'chunk_hash': chunk_hash(context['context'])}
+				document = {
+					'context': context['context'],
+					'moodle_url': context['moodle_url'],
+					'embedding': encode_embedding(context_embeddings[idx])
+				}
+				# createdAt is only set on insert, so re-storing an unchanged chunk doesn't make it look new
+				operations.append(UpdateOne(key, {'$set': document, '$setOnInsert': {'createdAt': created_at}}, upsert=True))
+			try:
+				result = collection.bulk_write(operations, ordered=False)
+				upserted += result.upserted_count
+				modified += result.modified_count
+			except BulkWriteError as e:
+				# unordered writes carry on past a failed document, report the failures and keep going
+				upserted += e.details.get('nUpserted', 0)
+				modified += e.details.get('nModified', 0)
+				logging.error(f'{len(e.details.get("writeErrors", []))} context embeddings failed to store: {e.details.get("writeErrors", [])[:1]}')
+		print(f'Context embeddings stored successfully in MongoDB ({upserted} new, {modified} updated).') # terminal message
 	# error handling
 	except ConnectionError as e:
 		logging.error(f'Connection Error: {e}')
 	except Exception as e:
-		logging.error(f'The following error occurred while storing data: {e}')
\ No newline at end of file
+		logging.error(f'The following error occurred while storing data: {e}')
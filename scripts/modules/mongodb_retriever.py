@@ -0,0 +1,249 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Iterable, Optional
+import numpy as np
+from numpy.typing import NDArray
+from langchain.docstore.document import Document
+from modules.mongodb_functions import mongodb_connection, decode_embedding, MONGODB_DATABASE, MONGODB_COLLECTION_EMBEDDINGS
+
+MONGODB_RETRIEVER_CACHE_MB = float(os.getenv("MONGODB_RETRIEVER_CACHE_MB", "512")) # course matrices kept in memory
+MONGODB_RETRIEVER_REFRESH = float(os.getenv("MONGODB_RETRIEVER_REFRESH", "30")) # seconds between checks for new chunks of a course
+MONGODB_RETRIEVER_FULL_RELOAD = float(os.getenv("MONGODB_RETRIEVER_FULL_RELOAD", "3600")) # seconds between full reloads, which pick up updated and deleted chunks
+PROJECTION = {"context": 1, "moodle_url": 1, "course_id": 1, "chunk_hash": 1, "embedding": 1, "createdAt": 1}
+
+_retriever = None
+_retriever_lock = threading.Lock()
+
+
+class CourseMatrix:
+	"""
+	The chunks of one course: their normalised embeddings as one contiguous float32 matrix, with the text and URL
+	of each row. Rows are appended as new chunks arrive, growing the matrix by doubling so appends are cheap.
+	"""
+	def __init__(self, course_id: int):
+		self.course_id = course_id
+		self.matrix = None
+		self.rows = 0
+		self.texts = []
+		self.urls = []
+		self.keys = []
+		self.ids = set() # MongoDB IDs of the rows, so a chunk is never added twice
+		self.watermark = None # (createdAt, _id) of the newest row, the cursor incremental loads resume from
+		self.refreshed = 0.0
+		self.loaded = 0.0
+
+	@property
+	def vectors(self) -> NDArray[np.float32]:
+		return self.matrix[:self.rows] if self.matrix is not None else np.empty((0, 0), dtype=np.float32)
+
+	@property
+	def nbytes(self) -> int:
+		return self.matrix.nbytes if self.matrix is not None else 0
+
+	def append(self, documents: Iterable[Dict]) -> int:
+		"""
+		Appends chunks read from MongoDB.
+
+		Args:
+			documents (Iterable[Dict]): The chunk documents, in (createdAt, _id) order.
+
+		Returns:
+			int: The number of chunks appended.
+		"""
+		vectors = []
+		for document in documents:
+			if document["_id"] in self.ids:
+				continue
+			self.ids.add(document["_id"])
+			vectors.append(decode_embedding(document["embedding"]))
+			self.texts.append(document["context"])
+			self.urls.append(document.get("moodle_url"))
+			self.keys.append(document.get("chunk_hash") or str(document["_id"]))
+			position = (document["createdAt"], document["_id"])
+			self.watermark = position if self.watermark is None else max(self.watermark, position)
+		if not vectors:
+			return 0
+
+		new = np.vstack(vectors).astype(np.float32)
+		new /= np.maximum(np.linalg.norm(new, axis=1, keepdims=True), 1e-12)
+		if self.matrix is None or self.rows + len(new) > len(self.matrix):
+			grown = np.empty((max(self.rows + len(new), 2 * self.rows, 64), new.shape[1]), dtype=np.float32)
+			if self.rows:
+				grown[:self.rows] = self.matrix[:self.rows]
+			self.matrix = grown
+		self.matrix[self.rows:self.rows + len(new)] = new
+		self.rows += len(new)
+		return len(new)
+
+
+class MongoDBRetriever:
+	"""
+	Searches the context embeddings stored in MongoDB, so every app node can serve the same corpus without a copy
+	of the FAISS files. The embeddings of each requested course are loaded into a contiguous float32 matrix and
+	searched with one matrix-vector product. Matrices are kept in an LRU cache bounded by memory, and refreshed
+	incrementally: every MONGODB_RETRIEVER_REFRESH seconds only chunks after the newest cached chunk in (createdAt,
+	_id) order are read, with a full reload every MONGODB_RETRIEVER_FULL_RELOAD seconds to pick up updated and deleted chunks.
+	"""
+	def __init__(self, collection=None, cache_mb: float = MONGODB_RETRIEVER_CACHE_MB, refresh: float = MONGODB_RETRIEVER_REFRESH,
+			full_reload: float = MONGODB_RETRIEVER_FULL_RELOAD):
+		self.collection = collection if collection is not None else mongodb_connection(MONGODB_DATABASE, MONGODB_COLLECTION_EMBEDDINGS)
+		self.cache_bytes = cache_mb * 1024 * 1024
+		self.refresh_interval = refresh
+		self.full_reload_interval = full_reload
+		self.courses = OrderedDict() # course ID -> CourseMatrix, least recently used first
+		self.lock = threading.Lock()
+		self.course_locks = {}
+		self.hits = 0
+		self.loads = 0
+		self.refreshes = 0
+		self.evictions = 0
+
+	def course_filter(self, course_id: int) -> Dict:
+		# course IDs are stored as they came from the Moodle metadata, which may be a string or a number
+		return {"course_id": {"$in": [course_id, str(course_id)]}}
+
+	def load_course(self, course_id: int, course: Optional[CourseMatrix]) -> CourseMatrix:
+		"""
+		Loads a course's chunks, or only the chunks created since the newest one already loaded.
+
+		Args:
+			course_id (int): The course ID.
+			course (CourseMatrix): The cached matrix of the course, or None to load it from scratch.
+
+		Returns:
+			CourseMatrix: The course's matrix.
+		"""
+		now = time.monotonic()
+		if course is None or now - course.loaded >= self.full_reload_interval:
+			course = CourseMatrix(course_id)
+			course.loaded = now
+			query = self.course_filter(course_id)
+			with self.lock:
+				self.loads += 1
+		else:
+			query = self.course_filter(course_id)
+			if course.watermark:
+				# every chunk stored in one call shares a createdAt, so the _id breaks the tie instead of re-reading the batch
+				created_at, last_id = course.watermark
+				query["$or"] = [{"createdAt": {"$gt": created_at}}, {"createdAt": created_at, "_id": {"$gt": last_id}}]
+			with self.lock:
+				self.refreshes += 1
+		added = course.append(self.collection.find(query, PROJECTION).sort([("createdAt", 1), ("_id", 1)]))
+		course.refreshed = now
+		if added:
+			logging.info(f"Loaded {added} chunks of course {course_id} from MongoDB ({course.rows} in memory).")
+		return course
+
+	def get_course(self, course_id: int) -> CourseMatrix:
+		"""
+		Returns a course's matrix from the cache, loading or refreshing it when needed.
+
+		Args:
+			course_id (int): The course ID.
+
+		Returns:
+			CourseMatrix: The course's matrix.
+		"""
+		with self.lock:
+			course = self.courses.get(course_id)
+			if course is not None:
+				self.courses.move_to_end(course_id)
+			course_lock = self.course_locks.setdefault(course_id, threading.Lock())
+		if course is not None and time.monotonic() - course.refreshed < self.refresh_interval:
+			with self.lock:
+				self.hits += 1
+			return course
+
+		# one loader per course, concurrent queries for the same course wait for it
+		with course_lock:
+			with self.lock:
+				current = self.courses.get(course_id)
+			if current is not None and time.monotonic() - current.refreshed < self.refresh_interval:
+				return current
+			course = self.load_course(course_id, current)
+			with self.lock:
+				self.courses[course_id] = course
+				self.courses.move_to_end(course_id)
+				self.evict()
+			return course
+
+	def evict(self):
+		# drop the least recently used courses until the cache fits, always keeping the newest one
+		total = sum(course.nbytes for course in self.courses.values())
+		while total > self.cache_bytes and len(self.courses) > 1:
+			_, course = self.courses.popitem(last=False)
+			total -= course.nbytes
+			self.evictions += 1
+
+	def search(self, query_vector: List[float], course_ids: Iterable[int], k: int) -> List[Document]:
+		"""
+		Finds the chunks most similar to a query in the given courses by cosine similarity.
+
+		Args:
+			query_vector (List[float]): The embedding of the query.
+			course_ids (Iterable[int]): The courses to search.
+			k (int): The number of chunks to return.
+
+		Returns:
+			List[Document]: Up to k chunks, most similar first, with their moodle_url, course_id and score in the metadata.
+		"""
+		query = np.array(query_vector, dtype=np.float32)
+		query /= max(float(np.linalg.norm(query)), 1e-12)
+
+		candidates = []
+		for course_id in course_ids:
+			course = self.get_course(course_id)
+			vectors = course.vectors
+			if not course.rows:
+				continue
+			scores = vectors @ query
+			top = np.argpartition(-scores, k - 1)[:k] if course.rows > k else np.arange(course.rows)
+			candidates.extend((float(scores[i]), course, int(i)) for i in top)
+
+		# the same chunk may be in several courses, keep its best score
+		docs = []
+		seen = set()
+		for score, course, row in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+			if course.keys[row] in seen:
+				continue
+			seen.add(course.keys[row])
+			docs.append(Document(page_content=course.texts[row],
+				metadata={"moodle_url": course.urls[row], "course_id": course.course_id, "score": score}))
+			if len(docs) == k:
+				break
+		return docs
+
+	def stats(self) -> Dict[str, float]:
+		"""
+		Returns the cache counters.
+
+		Returns:
+			Dict[str, float]: The courses and chunks cached, their size, and the cache hits, loads, refreshes and evictions.
+		"""
+		with self.lock:
+			return {
+				"courses": len(self.courses),
+				"chunks": sum(course.rows for course in self.courses.values()),
+				"megabytes": sum(course.nbytes for course in self.courses.values()) / (1024 * 1024),
+				"hits": self.hits,
+				"loads": self.loads,
+				"refreshes": self.refreshes,
+				"evictions": self.evictions
+			}
+
+
+def get_mongodb_retriever() -> MongoDBRetriever:
+	"""
+	Returns the process-wide MongoDB retriever.
+
+	Returns:
+		MongoDBRetriever: The shared retriever.
+	"""
+	global _retriever
+	with _retriever_lock:
+		if _retriever is None:
+			_retriever = MongoDBRetriever()
+		return _retriever
@@ -1,5 +1,13 @@
 import os
+import json
+import time
+import threading
+import email.utils
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+
+DOWNLOAD_STATE_FILE = '.download_state.json'
 
 def get_course_contents(moodle_server: str, auth_token: str, course_id: int) -> dict:
 	"""
@@ -31,6 +39,84 @@ def get_course_contents(moodle_server: str, auth_token: str, course_id: int) ->
 		print(f'An error occurred: {e}')
 		return {'error': str(e)}
 
+def get_site_info(moodle_server: str, auth_token: str) -> dict:
+	"""
+	Fetch the site and user information for a given Moodle API token.
+
+	Args:
+		moodle_server (str): The base URL of the Moodle REST API server.
+		auth_token (str): The authentication token for the Moodle API.
+
+	Returns:
+		dict: The response from the Moodle API, in JSON format, including the 'userid' of the token's user.
+	"""
+	params = {
+		'wstoken': auth_token,
+		'wsfunction': 'core_webservice_get_site_info',
+		'moodlewsrestformat': 'json'
+	}
+
+	try:
+		response = requests.get(moodle_server, params=params)
+		response.raise_for_status()
+		return response.json()
+	except requests.exceptions.RequestException as e:
+		print(f'An error occurred: {e}')
+		return {'error': str(e)}
+
+def get_user_courses(moodle_server: str, auth_token: str, user_id: int) -> list:
+	"""
+	Fetch the courses a Moodle user is enrolled in.
+
+	Args:
+		moodle_server (str): The base URL of the Moodle REST API server.
+		auth_token (str): The authentication token for the Moodle API.
+		user_id (int): The ID of the user to retrieve the courses of.
+
+	Returns:
+		list: The courses from the Moodle API, in JSON format, or an empty list if the request failed.
+	"""
+	params = {
+		'wstoken': auth_token,
+		'wsfunction': 'core_enrol_get_users_courses',
+		'userid': user_id,
+		'moodlewsrestformat': 'json'
+	}
+
+	try:
+		response = requests.get(moodle_server, params=params)
+		response.raise_for_status()
+		return response.json()
+	except requests.exceptions.RequestException as e:
+		print(f'An error occurred: {e}')
+		return []
+
+def get_all_courses(moodle_server: str, auth_token: str) -> list:
+	"""
+	Fetch every course on the Moodle site. Requires a token with site-wide course access.
+
+	Args:
+		moodle_server (str): The base URL of the Moodle REST API server.
+		auth_token (str): The authentication token for the Moodle API.
+
+	Returns:
+		list: The courses from the Moodle API, in JSON format, or an empty list if the request failed.
+	"""
+	params = {
+		'wstoken': auth_token,
+		'wsfunction': 'core_course_get_courses',
+		'moodlewsrestformat': 'json'
+	}
+
+	try:
+		response = requests.get(moodle_server, params=params)
+		response.raise_for_status()
+		# the site itself is returned as course 1 with the 'site' format
+		return [course for course in response.json() if course.get('format') != 'site']
+	except requests.exceptions.RequestException as e:
+		print(f'An error occurred: {e}')
+		return []
+
 def get_moodle_file_urls(course_contents: dict) -> list:
 	"""
 	Extract the file URL(s) from a Moodle course contents.
@@ -51,6 +137,30 @@ def get_moodle_file_urls(course_contents: dict) -> list:
 					file_urls.append(file['fileurl']) # the extracted file URL
 	return file_urls
    
+def get_moodle_file_info(course_contents: dict) -> list:
+	"""
+	Extract the file URL(s) from a Moodle course contents along with the size and modification time
+	Moodle reports for each file, so unchanged files can be skipped when downloading.
+
+	Args:
+		course_contents (dict): The JSON response from the Moodle API containing the course contents.
+
+	Returns:
+		list: A list of dictionaries with the 'fileurl', 'filename', 'filesize' and 'timemodified' of each file.
+	"""
+	file_info = []
+	for section in course_contents:
+		for module in section['modules']:
+			if module['modname'] in ['resource', 'file']:
+				for file in module['contents']:
+					file_info.append({
+						'fileurl': file['fileurl'],
+						'filename': file['fileurl'].split('/')[-1].split('?')[0],
+						'filesize': file.get('filesize'),
+						'timemodified': file.get('timemodified')
+					})
+	return file_info
+
 def modify_moodle_file_urls(file_urls: list, course_id:int) -> dict:
 	"""
 	Clean and structure Moodle file URLs by removing unneeded query parameters.
@@ -66,46 +176,284 @@ def modify_moodle_file_urls(file_urls: list, course_id:int) -> dict:
 	modified_file_urls = {}
 	for url in file_urls:
 		filename = url.split('/')[-1].split('?')[0] # separate the filename from the URL
+		if filename in modified_file_urls:
+			continue # only the first of several files sharing a name is downloaded
 		modified_file_urls[filename]= {
 			'url': url.split('?')[0], # remove the SQL query from the url (e.g ?forcedowload=1)
 			'course_id': course_id
 		}
 	return modified_file_urls
 
-def download_moodle_files(file_urls: list, token: str, output_dir: str = 'ingested_moodle_data'):
+class DownloadDeadlineExceeded(Exception):
+	"""
+	Raised when a download is stopped because the ingest's time budget ran out. The partial file is kept, so the
+	download resumes from where it stopped on the next run.
+	"""
+
+
+def load_download_state(output_dir: str) -> dict:
 	"""
-	Download files from Moodle using given URLs and save them to a local store.
+	Load the size and modification time of the files previously downloaded to a directory.
 
 	Args:
-		file_urls (list): A list of file URLs to download data from.
-		auth_token (str): The authentication token for the Moodle API.
-		output_dir (str): The directory where the downloaded files will be saved. Default is 'ingested_moodle_data'.
+		output_dir (str): The directory the files were downloaded to.
+
+	Returns:
+		dict: A dictionary of filenames to their Moodle 'filesize' and 'timemodified'.
+	"""
+	path = os.path.join(output_dir, DOWNLOAD_STATE_FILE)
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			return json.load(f)
+	return {}
+
+def save_download_state(state: dict, output_dir: str):
+	"""
+	Atomically save the size and modification time of the downloaded files.
+
+	Args:
+		state (dict): A dictionary of filenames to their Moodle 'filesize' and 'timemodified'.
+		output_dir (str): The directory the files were downloaded to.
 
 	Returns:
 		None
 	"""
-	
+	path = os.path.join(output_dir, DOWNLOAD_STATE_FILE)
+	# a temporary file per process and thread, so concurrent savers never rename each other's file
+	tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+	with open(tmp_path, 'w') as f:
+		json.dump(state, f, indent=4)
+	os.replace(tmp_path, path)
+
+def load_part_version(partpath: str) -> dict:
+	"""
+	Load the version of a file a partial download was started from, recorded alongside the partial file.
+
+	Args:
+		partpath (str): The path of the partial download.
+
+	Returns:
+		dict: The Moodle 'filesize' and 'timemodified' and the server's 'etag' and 'last_modified', or None if
+		no version was recorded.
+	"""
+	try:
+		with open(f'{partpath}.json', 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+def save_part_version(partpath: str, version: dict):
+	with open(f'{partpath}.json', 'w') as f:
+		json.dump(version, f)
+
+def discard_part(partpath: str):
+	for path in (partpath, f'{partpath}.json'):
+		if os.path.exists(path):
+			os.remove(path)
+
+def resume_validator(recorded: dict, file: dict) -> str:
+	"""
+	Works out the If-Range validator to resume a partial download with, so the server only sends the rest of the
+	file if it is still the version the partial download was started from.
+
+	Args:
+		recorded (dict): The version the partial download was started from, from load_part_version.
+		file (dict): The file being downloaded, as returned by get_moodle_file_info.
+
+	Returns:
+		str: The ETag or date to send as If-Range, or None if the partial download can't safely be resumed.
+	"""
+	if not recorded or recorded.get('filesize') != file.get('filesize') or recorded.get('timemodified') != file.get('timemodified'):
+		return None
+	# weak ETags can't be used with If-Range
+	if recorded.get('etag') and not recorded['etag'].startswith('W/'):
+		return recorded['etag']
+	if recorded.get('last_modified'):
+		return recorded['last_modified']
+	if recorded.get('timemodified'):
+		return email.utils.formatdate(recorded['timemodified'], usegmt=True)
+	return None
+
+def download_moodle_file(session: requests.Session, file: dict, token: str, output_dir: str, chunk_size: int = 1024 * 1024,
+		max_retries: int = 3, backoff: float = 1.0, deadline: float = None) -> int:
+	"""
+	Download a single file from Moodle, streaming it to a temporary file in chunks and renaming it into place
+	once complete. An interrupted download is resumed from where it stopped with an HTTP Range request, and
+	failed attempts are retried with exponential backoff. The version a partial file was started from is
+	recorded next to it, and it is only resumed while the file is unchanged on Moodle, with If-Range so the
+	server sends the whole file instead if it has changed since.
+
+	Args:
+		session (requests.Session): The pooled HTTP session to download with.
+		file (dict): The file to download, as returned by get_moodle_file_info.
+		token (str): The authentication token for the Moodle API.
+		output_dir (str): The directory where the file will be saved.
+		chunk_size (int): The number of bytes read from the response and written to disk at a time.
+		max_retries (int): The number of times a failed download is retried.
+		backoff (float): The delay in seconds before the first retry, doubled for each further retry.
+		deadline (float): The time.monotonic() time to stop downloading at, raising DownloadDeadlineExceeded. No
+			limit if not given.
+
+	Returns:
+		int: The number of bytes downloaded.
+	"""
+	# append the token to the file URL to create the authenticated query
+	url = file['fileurl']
+	download_url = f'{url}&token={token}' if '?' in url else f'{url}?token={token}'
+	filepath = os.path.join(output_dir, file['filename'])
+	partpath = f'{filepath}.part'
+
+	for attempt in range(max_retries + 1):
+		# bytes of this attempt only, an earlier failed attempt's bytes are either kept in the partial file or discarded
+		downloaded = 0
+		try:
+			# resume a partial download, only if the file hasn't changed on Moodle since it was started
+			offset = 0
+			headers = {}
+			if os.path.exists(partpath):
+				validator = resume_validator(load_part_version(partpath), file)
+				if validator:
+					offset = os.path.getsize(partpath)
+					headers['Range'] = f'bytes={offset}-'
+					headers['If-Range'] = validator
+				else:
+					discard_part(partpath)
+
+			with session.get(download_url, headers=headers, stream=True, timeout=(10, 60)) as response:
+				if response.status_code == 416:
+					# nothing left to download, the partial file is complete if it is as large as the file on Moodle
+					if file.get('filesize') and offset == file['filesize']:
+						os.replace(partpath, filepath)
+						discard_part(partpath)
+						return downloaded
+					# otherwise the partial file is stale or corrupt, discard it and retry from the beginning
+					discard_part(partpath)
+					raise requests.exceptions.HTTPError(f'Range from byte {offset} not satisfiable, restarting the download', response=response)
+				response.raise_for_status()  # HTTP error check
+
+				if response.status_code == 206:
+					# only append if the server sent the bytes straight after the partial file
+					content_range = response.headers.get('Content-Range', '')
+					start = content_range.split(' ')[-1].split('-')[0]
+					if not offset or start != str(offset):
+						discard_part(partpath)
+						raise requests.exceptions.HTTPError(f'Expected bytes from {offset}, got {content_range or "no Content-Range"}, restarting the download', response=response)
+					mode = 'ab'
+				else:
+					# the server ignored the range (or the file changed), start again from the beginning
+					mode = 'wb'
+					save_part_version(partpath, {
+						'filesize': file.get('filesize'),
+						'timemodified': file.get('timemodified'),
+						'etag': response.headers.get('ETag'),
+						'last_modified': response.headers.get('Last-Modified')
+					})
+				with open(partpath, mode) as part:
+					for chunk in response.iter_content(chunk_size=chunk_size):
+						part.write(chunk)
+						downloaded += len(chunk)
+						if deadline is not None and time.monotonic() >= deadline:
+							raise DownloadDeadlineExceeded(f"Stopped downloading {file['filename']} at the time budget")
+
+			os.replace(partpath, filepath)
+			discard_part(partpath)
+			return downloaded
+		except (requests.exceptions.RequestException, OSError) as e:
+			if attempt == max_retries:
+				raise
+			delay = backoff * 2 ** attempt
+			if deadline is not None and time.monotonic() + delay >= deadline:
+				raise DownloadDeadlineExceeded(f"No time left to retry {file['filename']}") from e
+			print(f"Retrying {file['filename']} in {delay}s after error: {e}")
+			time.sleep(delay)
+
+def download_moodle_files(file_urls: list, token: str, output_dir: str = 'ingested_moodle_data', max_workers: int = 4,
+		chunk_size: int = 1024 * 1024, max_retries: int = 3, backoff: float = 1.0, deadline: float = None) -> dict:
+	"""
+	Download files from Moodle using given URLs and save them to a local store. Files are downloaded in parallel
+	over a pooled session, and files whose Moodle size and modification time haven't changed since the last
+	download are skipped.
+
+	Args:
+		file_urls (list): A list of file URLs to download data from, or file dictionaries from get_moodle_file_info.
+		token (str): The authentication token for the Moodle API.
+		output_dir (str): The directory where the downloaded files will be saved. Default is 'ingested_moodle_data'.
+		max_workers (int): The maximum number of files downloaded at once.
+		chunk_size (int): The number of bytes read from a response and written to disk at a time.
+		max_retries (int): The number of times a failed download is retried.
+		backoff (float): The delay in seconds before the first retry, doubled for each further retry.
+		deadline (float): The time.monotonic() time to stop at, files not finished by then are left for the next run.
+
+	Returns:
+		dict: Download metrics, the number of files 'downloaded', 'skipped', 'failed' and 'unfinished', the 'bytes'
+		downloaded, the 'seconds' taken and the 'throughput' in bytes per second.
+	"""
+
 	# create the output directory if it doesn't already exist
 	if not os.path.exists(output_dir):
 		os.makedirs(output_dir)
 
-	for url in file_urls:
+	# accept plain URLs as well as file dictionaries
+	files = {}
+	for file in file_urls:
+		if isinstance(file, str):
+			file = {'fileurl': file, 'filename': file.split('/')[-1].split('?')[0], 'filesize': None, 'timemodified': None}
+		# files sharing a name would write the same path, keep the first as the metadata does
+		if file['filename'] in files:
+			print(f"Skipping duplicate filename: {file['fileurl']}")
+			continue
+		files[file['filename']] = file
+
+	state = load_download_state(output_dir)
+	metrics = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'unfinished': 0, 'bytes': 0}
+	lock = threading.Lock()
+	start = time.monotonic()
+
+	def download(file: dict):
+		filename = file['filename']
+		filepath = os.path.join(output_dir, filename)
+		version = {'filesize': file.get('filesize'), 'timemodified': file.get('timemodified')}
+
+		# skip files that haven't changed on Moodle since they were downloaded
+		if file.get('timemodified') and state.get(filename) == version and os.path.exists(filepath):
+			with lock:
+				metrics['skipped'] += 1
+			print(f'Skipping unchanged file: {filename}')
+			return
+
+		if deadline is not None and time.monotonic() >= deadline:
+			with lock:
+				metrics['unfinished'] += 1
+			return
+
 		try:
-			# append the token to the file URL to create the authenticated query
-			download_url = f'{url}&token={token}'
-			
-			# send the get request to download the file
-			file_response = requests.get(download_url)
-			file_response.raise_for_status()  # HTTP error check
-			
-			# split the filename and assign the file path
-			filename = url.split('/')[-1].split('?')[0]
-			filepath = os.path.join(output_dir, filename)
-			
-			#write the file to the given path
-			with open(filepath, 'wb') as file:
-				file.write(file_response.content)
-			
-			print(f'Downloaded: {filename}') # terminal outputs for status
-		except requests.exceptions.RequestException as e:
-			print(f"Failed to download {url}: {e}") # catch any failed downloads
+			downloaded = download_moodle_file(session, file, token, output_dir, chunk_size, max_retries, backoff, deadline)
+		except DownloadDeadlineExceeded as e:
+			with lock:
+				metrics['unfinished'] += 1
+			print(e)
+			return
+		except (requests.exceptions.RequestException, OSError) as e:
+			with lock:
+				metrics['failed'] += 1
+			print(f"Failed to download {file['fileurl']}: {e}") # catch any failed downloads
+			return
+
+		with lock:
+			metrics['downloaded'] += 1
+			metrics['bytes'] += downloaded
+			state[filename] = version
+			save_download_state(state, output_dir)
+		print(f'Downloaded: {filename}') # terminal outputs for status
+
+	# one pooled session shared by the workers so connections are reused between files
+	with requests.Session() as session:
+		adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			list(executor.map(download, files.values()))
+
+	metrics['seconds'] = time.monotonic() - start
+	metrics['throughput'] = metrics['bytes'] / metrics['seconds'] if metrics['seconds'] else 0.0
+	return metrics
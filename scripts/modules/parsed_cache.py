@@ -0,0 +1,88 @@
+import os
+import gzip
+import json
+from importlib import metadata
+from typing import List, Optional, Set
+from langchain.docstore.document import Document
+
+PARSER_REVISION = "1" # bump when the parsing code changes in a way that changes its output
+
+
+def parser_version() -> str:
+	"""
+	Identifies the parser, so text parsed by a different Unstructured release or parsing code is parsed again.
+
+	Returns:
+		str: The parser version.
+	"""
+	try:
+		unstructured_version = metadata.version("unstructured")
+	except metadata.PackageNotFoundError:
+		unstructured_version = "unknown"
+	return f"unstructured-{unstructured_version}-r{PARSER_REVISION}"
+
+
+class ParsedDocumentCache:
+	"""
+	A persistent cache of the documents Unstructured parses from each file, keyed by the file's content hash
+	and the parser version, so chunking, metadata and embedding can be re-run without parsing again. Each file's
+	documents are stored as gzipped JSON lines of their text and parser metadata, written through a temporary
+	file so worker processes can fill the cache concurrently.
+	"""
+	def __init__(self, cache_dir: str, version: str = None):
+		self.cache_dir = cache_dir
+		self.version = version or parser_version()
+		os.makedirs(cache_dir, exist_ok=True)
+
+	def path(self, file_hash: str) -> str:
+		return os.path.join(self.cache_dir, self.version, file_hash[:2], f"{file_hash}.jsonl.gz")
+
+	def get(self, file_hash: str) -> Optional[List[Document]]:
+		"""
+		Loads the parsed documents of a file.
+
+		Args:
+			file_hash (str): The content hash of the file.
+
+		Returns:
+			List[Document]: The parsed documents, or None if the file hasn't been parsed by this parser version.
+		"""
+		try:
+			with gzip.open(self.path(file_hash), "rt", encoding="utf-8") as f:
+				return [Document(**json.loads(line)) for line in f]
+		except (FileNotFoundError, EOFError, OSError, ValueError):
+			return None
+
+	def put(self, file_hash: str, docs: List[Document]):
+		"""
+		Stores the parsed documents of a file.
+
+		Args:
+			file_hash (str): The content hash of the file.
+			docs (List[Document]): The documents parsed from the file.
+
+		Returns:
+			None
+		"""
+		path = self.path(file_hash)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with gzip.open(f"{path}.{os.getpid()}.tmp", "wt", encoding="utf-8") as f:
+			for doc in docs:
+				f.write(json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}, default=str) + "\n")
+		os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+	def prune(self, keep_hashes: Set[str]):
+		"""
+		Deletes the cached documents of files that are no longer ingested and of older parser versions.
+
+		Args:
+			keep_hashes (Set[str]): The content hashes of the files to keep.
+
+		Returns:
+			None
+		"""
+		for root, _, files in os.walk(self.cache_dir):
+			current = os.path.relpath(root, self.cache_dir).split(os.sep)[0] == self.version
+			for name in files:
+				if not current or name.split(".")[0] not in keep_hashes:
+					os.remove(os.path.join(root, name))
@@ -1,19 +1,163 @@
-from typing import List, Dict
+import os
+import re
+import json
 import datetime
+import threading
+from typing import List, Dict, Optional
+import numpy as np
 
-def get_hardcoded_responses() -> Dict[str, str]:
-    return {
-        "hello": "I'm TigersAI, a chatbot assistant. Please ask me a question and I'll see if I can help!",
-        "hi": "I'm TigersAI, a chatbot assistant. Please ask me a question and I'll see if I can help!",
-        "hey": "I'm TigersAI, a chatbot assistant. Please ask me a question and I'll see if I can help!",
-        "how are you": "I'm just a bot, but thanks for asking! How can I assist you?",
-        "how are you?": "I'm just a bot, but thanks for asking! How can I assist you?",
-        "what is the current date?": f"{datetime.datetime.now()}",
-        "what is the current date": f"{datetime.datetime.now()}",
-        "what is the current time?": f"{datetime.datetime.now()}",
-        "what is the current time": f"{datetime.datetime.now()}"
-        #etc
-    }
+INTENT_THRESHOLD = float(os.getenv("INTENT_THRESHOLD", "0.9")) # cosine similarity to an intent centroid needed to answer without the LLM
+INTENT_THRESHOLDS_FILE = os.getenv("INTENT_THRESHOLDS_FILE", "intent_thresholds.json") # per-intent thresholds written by intent_calibration.py
+GREETING_RESPONSE = "I'm TigersAI, a chatbot assistant. Please ask me a question and I'll see if I can help!"
+
+# canned intents, answered without retrieval or the LLM. response is called when the intent is matched so dynamic
+# answers like the time are current, and threshold overrides INTENT_THRESHOLD for intents that are costly to get wrong.
+# thresholds calibrated by intent_calibration.py against course questions override both
+INTENTS = {
+    'greeting': {
+        'examples': ['hello', 'hi', 'hey', 'hi there', 'hello!', 'hey there', 'good morning', 'good afternoon', 'good evening', 'greetings', 'yo'],
+        'response': lambda: GREETING_RESPONSE,
+    },
+    'wellbeing': {
+        'examples': ['how are you', 'how are you?', "how's it going", 'how are you doing today', "what's up", 'are you ok'],
+        'response': lambda: "I'm just a bot, but thanks for asking! How can I assist you?",
+    },
+    'date': {
+        'examples': ['what is the current date', 'what is the current date?', "what's the date today", 'what day is it', "today's date", 'what is the date'],
+        'response': lambda: f"Today is {datetime.datetime.now():%A %d %B %Y}.",
+    },
+    'time': {
+        'examples': ['what is the current time', 'what is the current time?', 'what time is it', "what's the time", 'current time please', 'tell me the time'],
+        'response': lambda: f"It is {datetime.datetime.now():%H:%M}.",
+    },
+    'thanks': {
+        'examples': ['thanks', 'thank you', 'thank you so much', 'thanks a lot', 'cheers', 'great, thanks', 'ok thanks'],
+        'response': lambda: "You're welcome! Let me know if there's anything else I can help with.",
+    },
+    'out_of_scope': {
+        'examples': ["what's the weather like today", 'tell me a joke', 'who won the football last night', 'what should I eat for dinner',
+            'recommend me a movie', 'who is the president', 'sing me a song', 'what is the meaning of life'],
+        'response': lambda: "I can only help with questions about your course material. Please ask me something about your courses!",
+        'threshold': 0.93,
+    },
+}
+
+def normalise_query(query: str) -> str:
+    # lowercase and drop punctuation at the ends, so "Hi!" and "hi" match the same example
+    return re.sub(r"\s+", " ", query.lower()).strip(" \t\n!?.,")
+
+class IntentRouter:
+    """
+    Answers canned and off-topic queries before retrieval. A query that is one of an intent's examples is answered
+    without embedding it; otherwise the query embedding is compared with the centroid of each intent's example
+    embeddings in one matrix product, and answered by the closest intent if it is similar enough. The example
+    embeddings are computed once, when the router is created.
+    """
+    def __init__(self, embeddings, intents: Dict = INTENTS, threshold: float = INTENT_THRESHOLD, calibrated: Dict[str, float] = None):
+        self.intents = intents
+        self.names = list(intents)
+        self.exact = {normalise_query(example): name for name, intent in intents.items() for example in intent['examples']}
+        calibrated = calibrated or {}
+        self.thresholds = np.array([calibrated.get(name, intent.get('threshold', threshold)) for name, intent in intents.items()], dtype=np.float32)
+
+        examples = [example for intent in intents.values() for example in intent['examples']]
+        vectors = np.asarray(embeddings.embed_documents(examples), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        centroids = []
+        start = 0
+        for intent in intents.values():
+            centroid = vectors[start:start + len(intent['examples'])].mean(axis=0)
+            centroids.append(centroid / np.linalg.norm(centroid))
+            start += len(intent['examples'])
+        self.centroids = np.vstack(centroids)
+        self.lock = threading.Lock()
+        self.routed = {name: 0 for name in self.names}
+        self.exact_hits = 0
+        self.passed = 0
+
+    def match_exact(self, query: str) -> Optional[str]:
+        """
+        Answers a query that is exactly one of the intent examples, without embedding it.
+
+        Args:
+            query (str): The user's input question.
+
+        Returns:
+            str: The response, or None if the query isn't an example.
+        """
+        name = self.exact.get(normalise_query(query))
+        if name is None:
+            return None
+        with self.lock:
+            self.exact_hits += 1
+            self.routed[name] += 1
+        return self.intents[name]['response']()
+
+    def match_vector(self, query_vector: List[float]) -> Optional[str]:
+        """
+        Answers a query whose embedding is close enough to an intent centroid.
+
+        Args:
+            query_vector (List[float]): The embedding of the query.
+
+        Returns:
+            str: The response, or None if the query needs retrieval and the LLM.
+        """
+        vector = np.asarray(query_vector, dtype=np.float32)
+        scores = self.centroids @ (vector / np.linalg.norm(vector))
+        best = int(np.argmax(scores))
+        if scores[best] < self.thresholds[best]:
+            with self.lock:
+                self.passed += 1
+            return None
+        with self.lock:
+            self.routed[self.names[best]] += 1
+        return self.intents[self.names[best]]['response']()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the routing counters.
+
+        Returns:
+            Dict[str, int]: The queries answered by each intent, those matched exactly and those passed on to retrieval.
+        """
+        with self.lock:
+            return {**self.routed, 'exact_matches': self.exact_hits, 'passed_to_retrieval': self.passed}
+
+_router = None
+_router_lock = threading.Lock()
+
+def load_intent_thresholds(path: str = INTENT_THRESHOLDS_FILE) -> Dict[str, float]:
+    """
+    Loads the per-intent thresholds written by intent_calibration.py.
+
+    Args:
+        path (str): The path of the thresholds file.
+
+    Returns:
+        Dict[str, float]: The threshold of each calibrated intent, empty if the intents haven't been calibrated.
+    """
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+def get_intent_router(embeddings) -> IntentRouter:
+    """
+    Returns the process-wide intent router, embedding the intent examples the first time and using the calibrated
+    thresholds if there are any.
+
+    Args:
+        embeddings (Embeddings): The embedding model queries are embedded with.
+
+    Returns:
+        IntentRouter: The shared intent router.
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = IntentRouter(embeddings, calibrated=load_intent_thresholds())
+        return _router
 
 def get_anchor_points_and_negatives() -> Dict[str, Dict[str, List[str]]]:
     return {
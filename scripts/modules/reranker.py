@@ -0,0 +1,153 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import List, Dict
+from langchain.docstore.document import Document
+from modules.chunk_cache import chunk_hash
+
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50")) # candidates retrieved (after the course filter) for reranking
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "5")) # documents kept after reranking
+RERANK_LATENCY_CAP_MS = float(os.getenv("RERANK_LATENCY_CAP_MS", "300")) # longer than this and vector order is used instead
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "50000")) # (query, chunk) scores kept
+MAX_LENGTH = 512
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+class CrossEncoderReranker:
+	"""
+	Reorders retrieved candidates by scoring each (query, chunk) pair with a small cross-encoder on the CPU. All
+	uncached pairs are scored in one batched forward pass, scores are cached by query and chunk text, and if
+	scoring takes longer than the latency cap the candidates are returned in vector order instead. A pass that
+	overruns the cap still finishes in the background and fills the cache. Only one pass is submitted at a time:
+	a query waits for the running pass within its own latency budget and otherwise falls back, so passes never
+	queue up behind one that overran.
+	"""
+	def __init__(self, model_name: str = RERANK_MODEL, top_n: int = RERANK_TOP_N, latency_cap_ms: float = RERANK_LATENCY_CAP_MS, cache_size: int = RERANK_CACHE_SIZE):
+		import torch
+		from transformers import AutoTokenizer, AutoModelForSequenceClassification
+		self.torch = torch
+		self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+		self.model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+		self.top_n = top_n
+		self.latency_cap = latency_cap_ms / 1000
+		self.cache_size = cache_size
+		self.cache = OrderedDict() # (query, chunk hash) -> score, least recently used first
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		self.slot = threading.Semaphore(1) # held from submitting a pass until it finishes, even after a timeout
+		self.reranked = 0
+		self.fallbacks = 0
+		self.busy_fallbacks = 0
+		self.cache_hits = 0
+		self.scored = 0
+
+	def score_pairs(self, query: str, keys: List[str], texts: List[str]) -> Dict[str, float]:
+		"""
+		Scores (query, chunk) pairs in one forward pass and caches the scores.
+
+		Args:
+			query (str): The normalised query.
+			keys (List[str]): The hashes of the chunks.
+			texts (List[str]): The texts of the chunks.
+
+		Returns:
+			Dict[str, float]: The score of each chunk hash.
+		"""
+		inputs = self.tokenizer([query] * len(texts), texts, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors="pt")
+		with self.torch.inference_mode():
+			logits = self.model(**inputs).logits
+		scores = dict(zip(keys, logits[:, 0].tolist()))
+		with self.lock:
+			self.scored += len(keys)
+			for key, score in scores.items():
+				self.cache[(query, key)] = score
+				self.cache.move_to_end((query, key))
+			while len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+		return scores
+
+	def rerank(self, query: str, docs: List[Document]) -> List[Document]:
+		"""
+		Reorders retrieved candidates by cross-encoder score and keeps the best top_n.
+
+		Args:
+			query (str): The user's input question.
+			docs (List[Document]): The retrieved candidates, in vector order.
+
+		Returns:
+			List[Document]: The top_n best scoring candidates, or the first top_n in vector order if scoring
+				exceeded the latency cap.
+		"""
+		if len(docs) <= 1:
+			return docs
+		start = time.perf_counter()
+		query = " ".join(query.lower().split())
+		keys = [chunk_hash(doc.page_content) for doc in docs]
+
+		scores = {}
+		with self.lock:
+			for key in keys:
+				if (query, key) in self.cache:
+					scores[key] = self.cache[(query, key)]
+					self.cache.move_to_end((query, key))
+			self.cache_hits += len(scores)
+
+		missing = {key: doc.page_content for key, doc in zip(keys, docs) if key not in scores}
+		if missing:
+			if not self.slot.acquire(timeout=max(0.0, self.latency_cap - (time.perf_counter() - start))):
+				with self.lock:
+					self.fallbacks += 1
+					self.busy_fallbacks += 1
+				return docs[:self.top_n]
+			future = self.executor.submit(self.score_pairs, query, list(missing), list(missing.values()))
+			future.add_done_callback(lambda _: self.slot.release())
+			try:
+				scores.update(future.result(timeout=max(0.0, self.latency_cap - (time.perf_counter() - start))))
+			except TimeoutError:
+				with self.lock:
+					self.fallbacks += 1
+				logging.warning(f"Reranking {len(missing)} candidates exceeded {self.latency_cap * 1000:.0f}ms, using vector order.")
+				return docs[:self.top_n]
+
+		with self.lock:
+			self.reranked += 1
+		order = sorted(range(len(docs)), key=lambda i: scores[keys[i]], reverse=True)
+		return [docs[i] for i in order[:self.top_n]]
+
+	def stats(self) -> Dict[str, float]:
+		"""
+		Returns the reranking counters.
+
+		Returns:
+			Dict[str, float]: The queries reranked, the fallbacks to vector order (and those because a pass was already
+				running), the cached and scored pairs.
+		"""
+		with self.lock:
+			return {
+				"reranked": self.reranked,
+				"fallbacks": self.fallbacks,
+				"busy_fallbacks": self.busy_fallbacks,
+				"cache_hits": self.cache_hits,
+				"pairs_scored": self.scored,
+				"cache_entries": len(self.cache)
+			}
+
+
+def get_reranker() -> CrossEncoderReranker:
+	"""
+	Returns the process-wide reranker, loading the cross-encoder the first time.
+
+	Returns:
+		CrossEncoderReranker: The shared reranker.
+	"""
+	global _reranker
+	with _reranker_lock:
+		if _reranker is None:
+			_reranker = CrossEncoderReranker()
+		return _reranker
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import datetime
+from typing import Dict, List, Tuple
+import numpy as np
+from modules.mongodb_functions import get_mongodb_client, store_data_in_mongodb, MONGODB_SERVER, MONGODB_BATCH_SIZE
+
+# loads synthetic chunks into a scratch database on a local mongod and compares per-document list inserts
+# with batched float32 upserts, e.g. python mongodb_benchmark.py 20000
+BENCHMARK_SERVER = os.getenv("BENCHMARK_MONGODB_SERVER", MONGODB_SERVER or "localhost:27017")
+BENCHMARK_DATABASE = os.getenv("BENCHMARK_MONGODB_DATABASE", "tigersai_benchmark") # dropped after the run
+BENCHMARK_CHUNKS = 10000
+BENCHMARK_COURSES = 20
+EMBEDDING_DIM = 384
+
+
+def synthetic_chunks(count: int, seed: int = 0) -> Tuple[List[Dict[str, str]], np.ndarray]:
+	"""
+	Generates chunks and normalised embeddings shaped like the ingested course material.
+
+	Args:
+		count (int): The number of chunks.
+		seed (int): The random seed.
+
+	Returns:
+		Tuple[List[Dict[str, str]], np.ndarray]: The context data and its embeddings.
+	"""
+	rng = np.random.default_rng(seed)
+	context_data = [{
+		"context": f"chunk {i} " + "lorem ipsum dolor sit amet " * 18,
+		"moodle_url": f"https://moodle.example/pluginfile.php/{i // 40}/file.pdf",
+		"course_id": str(i % BENCHMARK_COURSES)
+	} for i in range(count)]
+	embeddings = rng.standard_normal((count, EMBEDDING_DIM)).astype(np.float32)
+	embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+	return context_data, embeddings
+
+def collection_size(db, name: str) -> int:
+	return db.command("collStats", name)["size"]
+
+def run_benchmark(count: int = BENCHMARK_CHUNKS):
+	"""
+	Stores the same chunks with one insert_one per chunk and embeddings as lists of floats, as the ingest used to,
+	then with store_data_in_mongodb, twice to time an idempotent re-run, and prints the throughput and size of each.
+
+	Args:
+		count (int): The number of chunks to store.
+
+	Returns:
+		None
+	"""
+	client = get_mongodb_client(BENCHMARK_SERVER)
+	client.drop_database(BENCHMARK_DATABASE)
+	db = client[BENCHMARK_DATABASE]
+	context_data, embeddings = synthetic_chunks(count)
+	results = {}
+
+	try:
+		start = time.perf_counter()
+		legacy = db["legacy_embeddings"]
+		for idx, context in enumerate(context_data):
+			legacy.insert_one({**context, "embedding": embeddings[idx].tolist(), "createdAt": datetime.datetime.utcnow()})
+		results["insert_one, list of doubles"] = (time.perf_counter() - start, collection_size(db, "legacy_embeddings"))
+
+		for run in ("bulk upsert, float32 binary", "bulk upsert re-run"):
+			start = time.perf_counter()
+			store_data_in_mongodb(context_data, embeddings, collection=db["embeddings"])
+			results[run] = (time.perf_counter() - start, collection_size(db, "embeddings"))
+		assert db["embeddings"].count_documents({}) == count, "re-running the upsert duplicated documents"
+	finally:
+		client.drop_database(BENCHMARK_DATABASE)
+
+	print(f"{count} chunks, {EMBEDDING_DIM} dimensions, batch size {MONGODB_BATCH_SIZE}")
+	print(f"{'method':<32}{'seconds':>10}{'chunks/s':>12}{'size MB':>10}")
+	for name, (seconds, size) in results.items():
+		print(f"{name:<32}{seconds:>10.2f}{count / seconds:>12.0f}{size / 1e6:>10.1f}")
+
+if __name__ == "__main__":
+	run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else BENCHMARK_CHUNKS)
@@ -3,12 +3,14 @@ import os
 import json
 import base64
 from typing import Tuple
-from langchain.llms import Ollama
-from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
 from langchain.vectorstores import FAISS
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.evaluation import PairwiseStringEvaluator
+from modules.course_retrieval import parse_course_ids, document_course_ids, RETRIEVAL_NPROBE, RETRIEVAL_EF_SEARCH
+from modules.ann_index import set_search_defaults
+from modules.mmap_store import load_mmap_db
+from modules.embedder import get_embedder
+from modules.llm_client import get_llm_client
 
 #use the previously made vector embedding directory
 VECTOR_DB_DIR = "faiss_index"
@@ -24,11 +26,19 @@ QA_PROMPT = PromptTemplate(
 	Answer:"""
 )
 
+#load the FAISS index once, memory mapped if it has been exported
+def load_db(index_dir):
+	"""Load the FAISS index using the same embedding model."""
+	embeddings = get_embedder("BAAI/bge-small-en")
+	db = load_mmap_db(index_dir, embeddings) or FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+	set_search_defaults(db.index, RETRIEVAL_NPROBE, RETRIEVAL_EF_SEARCH)
+	return db
+
 #make a retriever using FAISS, using the same embedding model, using similarity
-def get_retriever(index_dir, k=10):
+def get_retriever(index_dir, k=10, db=None):
 	"""Create a retriever using FAISS index."""
-	embeddings = HuggingFaceEmbeddings(model_name="BAAI/bge-small-en")
-	db = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+	if db is None:
+		db = load_db(index_dir)
 	return db.as_retriever(search_type="similarity", search_kwargs={"k": k})
 
 
@@ -39,23 +49,19 @@ def get_answer_from_retriever(retriever, query, accessible_courses=None):
 
 	# filter documents by accessible courses if needed (defaults to none)
 	if accessible_courses:
-		all_docs = [doc for doc in all_docs if any(course in doc.metadata.get("course_id", "") for course in accessible_courses)]
+		course_ids = parse_course_ids(accessible_courses)
+		all_docs = [doc for doc in all_docs if document_course_ids(doc) & course_ids]
+	else:
+		# deleted chunks stay in the index until --compact runs, with no courses left
+		all_docs = [doc for doc in all_docs if document_course_ids(doc)]
 
 	if not all_docs:
 		print("Response: No relevant content found.")
 		return "Sorry, could not find relevant information for your question."
 
 	# llm to generate answer
-	llm = Ollama(model="llama3.2:3b")
-	qa_chain = RetrievalQA.from_chain_type(
-		llm=llm,
-		retriever=retriever,
-		return_source_documents=True,
-		chain_type_kwargs={"prompt": QA_PROMPT}
-	)
-
-	# generate the answer
-	response = qa_chain.combine_documents_chain.run(input_documents=all_docs, question=query)
+	context = "\n\n".join(doc.page_content for doc in all_docs)
+	response = get_llm_client().invoke(QA_PROMPT.format(context=context, question=query))
 	return response.strip()
 
 
@@ -64,7 +70,7 @@ def get_answer_from_retriever(retriever, query, accessible_courses=None):
 class LLMBasedPairwiseEvaluator(PairwiseStringEvaluator):
 	def __init__(self, llm=None):
 		# use a default local llm if no llm provided as argument
-		self.llm = llm or Ollama(model="llama3.2:3b")
+		self.llm = llm or get_llm_client()
 	
 	#evaluate two responses against each other
 	def _evaluate_string_pairs(self, response_pair: Tuple[str, str], query: str, context: str) -> Tuple[float, str]:
@@ -109,8 +115,9 @@ class LLMBasedPairwiseEvaluator(PairwiseStringEvaluator):
 
 def qa_with_pairwise_evaluation(query: str, accessible_courses: list):
 	# create two different retrievers with different params
-	retriever_1 = get_retriever(VECTOR_DB_DIR, k=10)  # default retriever
-	retriever_2 = get_retriever(VECTOR_DB_DIR, k=5)  # another retriever with fewer results to work with
+	db = load_db(VECTOR_DB_DIR)  # shared by both retrievers
+	retriever_1 = get_retriever(VECTOR_DB_DIR, k=10, db=db)  # default retriever
+	retriever_2 = get_retriever(VECTOR_DB_DIR, k=5, db=db)  # another retriever with fewer results to work with
 
 	# get llm response from both retrievers
 	answer_1 = get_answer_from_retriever(retriever_1, query, accessible_courses=None)
@@ -0,0 +1,383 @@
+import os
+import json
+import logging
+import asyncio
+import threading
+from typing import Dict, AsyncIterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from langchain_response import (VECTOR_DB_DIR, EMBED_MODEL, RETRIEVAL_MODE, RERANK, CONTEXT_PACKING, NO_CONTENT_RESPONSE, PROFANITY_RESPONSE, load_vector_db, load_llm, retrieve_documents,
+	build_prompt, source_urls, format_sources, format_response, astream_qa_with_retriever, profanity_filter)
+from modules.prompting import get_intent_router
+from modules.course_retrieval import load_course_index, parse_course_ids
+from modules.bm25_index import load_bm25_index
+from modules.context_packing import get_context_packer
+from modules.reranker import get_reranker
+from modules.llm_client import LLMBusyError
+from modules.admission import AdmissionController, AdmissionRejected
+from modules.embedder import get_embedder
+from modules.answer_cache import SemanticAnswerCache, read_index_version
+
+
+load_dotenv()
+
+# globals for the query server
+RAG_SERVER_HOST: str = os.getenv("RAG_SERVER_HOST", "127.0.0.1")
+RAG_SERVER_PORT: int = int(os.getenv("RAG_SERVER_PORT", "5005"))
+RAG_SERVER_MAX_INFLIGHT: int = int(os.getenv("RAG_SERVER_MAX_INFLIGHT", "4")) # concurrent queries being answered
+RAG_SERVER_QUEUE_TIMEOUT: float = float(os.getenv("RAG_SERVER_QUEUE_TIMEOUT", "30")) # seconds to wait for a free slot
+RAG_SERVER_WARMUP_LLM: bool = os.getenv("RAG_SERVER_WARMUP_LLM", "true").lower() == "true"
+
+# globals for the semantic answer cache
+ANSWER_CACHE_THRESHOLD: float = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")) # cosine similarity needed for a hit
+ANSWER_CACHE_MAX_ENTRIES: int = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL: float = float(os.getenv("ANSWER_CACHE_TTL", "3600")) # seconds
+ANSWER_CACHE_MAX_BYTES: int = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+class RAGService:
+	"""
+	Holds the embedding model, FAISS index and LLM client for the lifetime of the process so
+	each query only pays for retrieval and generation. Answers are cached by query similarity,
+	and the index is reloaded in the background when the ingest changes it.
+	"""
+	def __init__(self, max_inflight: int = RAG_SERVER_MAX_INFLIGHT):
+		self.embeddings = None
+		self.router = None
+		self.db = None
+		self.course_index = None
+		self.bm25 = None
+		self.index_version = None
+		self.llm = None
+		self.error = None
+		self.ready = threading.Event()
+		self.admission = AdmissionController(max_inflight, queue_timeout=RAG_SERVER_QUEUE_TIMEOUT)
+		self.reload_lock = threading.Lock()
+		self.cache = SemanticAnswerCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_BYTES)
+
+	def warm_up(self):
+		"""
+		Loads the embedding model, the FAISS index (unless searching MongoDB) and the LLM client, then runs a query through
+		each of them so the first student request does not pay the cold start.
+
+		Returns:
+			None
+		"""
+		try:
+			self.embeddings = get_embedder(EMBED_MODEL)
+			self.router = get_intent_router(self.embeddings) # embeds the intent examples
+			if RETRIEVAL_MODE == "mongodb":
+				# the chunks are read from MongoDB course by course, there are no index files to load
+				from modules.mongodb_retriever import get_mongodb_retriever
+				get_mongodb_retriever()
+				self.embeddings.embed_query("warm up") # loads the embedding weights
+			else:
+				self.index_version = read_index_version(VECTOR_DB_DIR)
+				self.db = load_vector_db(self.embeddings)
+				self.db.similarity_search("warm up", k=1) # loads the embedding weights and pages in the index
+				self.course_index = load_course_index(self.db, VECTOR_DB_DIR)
+				if RETRIEVAL_MODE == "hybrid":
+					self.bm25 = load_bm25_index(self.db, VECTOR_DB_DIR)
+			if RERANK:
+				get_reranker().rerank("warm up", [Document(page_content="warm up"), Document(page_content="cross-encoder")])
+			if CONTEXT_PACKING:
+				get_context_packer() # loads the tokenizer
+			self.llm = load_llm()
+			if RAG_SERVER_WARMUP_LLM:
+				self.llm.invoke("Hello") # makes ollama load the model into memory
+			self.ready.set()
+			logging.info("RAG service is ready.")
+		except Exception as e:
+			self.error = str(e)
+			logging.error(f"RAG service warm up failed: {e}")
+
+	def check_index_version(self):
+		"""
+		Starts a background reload of the FAISS index if the ingest has changed it since it was loaded.
+
+		Returns:
+			None
+		"""
+		# in mongodb mode the retriever refreshes each course itself and cached answers expire by their TTL
+		if RETRIEVAL_MODE == "mongodb":
+			return
+		if read_index_version(VECTOR_DB_DIR) != self.index_version and self.reload_lock.acquire(blocking=False):
+			threading.Thread(target=self.reload_index, daemon=True).start()
+
+	def reload_index(self):
+		"""
+		Loads the current FAISS index, course index and BM25 index, swaps them in and drops the answers cached
+		from the previous index.
+
+		Returns:
+			None
+		"""
+		try:
+			index_version = read_index_version(VECTOR_DB_DIR)
+			db = load_vector_db(self.embeddings)
+			course_index = load_course_index(db, VECTOR_DB_DIR)
+			bm25 = load_bm25_index(db, VECTOR_DB_DIR) if RETRIEVAL_MODE == "hybrid" else None
+			self.db, self.course_index, self.bm25, self.index_version = db, course_index, bm25, index_version
+			self.cache.clear()
+			logging.info(f"Reloaded index version {index_version}.")
+		except Exception as e:
+			logging.error(f"Failed to reload the index: {e}")
+		finally:
+			self.reload_lock.release()
+
+	def filter_query(self, query: str) -> str:
+		"""
+		Checks a query against the profanity filter and the intent examples, before it is embedded.
+
+		Args:
+			query (str): The user's input question.
+
+		Returns:
+			str: The response to send back without querying the LLM, or None if the query needs an LLM answer.
+		"""
+		# profanity filtering
+		if profanity_filter(query):
+			return PROFANITY_RESPONSE
+
+		# canned responses for queries that are exactly an intent example, e.g. "hi"
+		response = self.router.match_exact(query)
+		if response is not None:
+			return f"<p>{response}</p>"
+		return None
+
+	def answer(self, query: str, accessible_courses: list, token: str) -> str:
+		"""
+		Answers a user query in the same way as langchain_response.py does from the command line,
+		returning a cached answer when a similar query has already been answered for the same courses.
+
+		Args:
+			query (str): The user's input question.
+			accessible_courses (list): A list of course IDs the user has access to.
+			token (str): The users moodle access token.
+
+		Returns:
+			str: The response to send back to the user.
+		"""
+		filtered_response = self.filter_query(query)
+		if filtered_response is not None:
+			return filtered_response
+
+		self.check_index_version()
+		db, course_index, bm25, index_version = self.db, self.course_index, self.bm25, self.index_version
+		course_ids = parse_course_ids(accessible_courses)
+		query_vector = self.embeddings.embed_query(query)
+		routed_response = self.router.match_vector(query_vector)
+		if routed_response is not None:
+			return f"<p>{routed_response}</p>"
+		cached = self.cache.lookup(query_vector, course_ids, index_version)
+		if cached is not None:
+			return format_response(cached.answer, cached.source_urls, token)
+
+		docs = retrieve_documents(query, course_ids, db, course_index, query_vector, bm25)
+		if not docs:
+			return NO_CONTENT_RESPONSE
+		response = self.llm.invoke(build_prompt(docs, query))
+		answer = f"**Answer:**\n\n{response.strip()}"
+		self.cache.store(query_vector, course_ids, index_version, answer, source_urls(docs))
+		return format_response(answer, source_urls(docs), token)
+
+	async def astream_answer(self, query: str, accessible_courses: list, token: str) -> AsyncIterator[Dict[str, str]]:
+		"""
+		Streaming version of answer(), yielding the frames of astream_qa_with_retriever.
+
+		Args:
+			query (str): The user's input question.
+			accessible_courses (list): A list of course IDs the user has access to.
+			token (str): The users moodle access token.
+
+		Yields:
+			Dict[str, str]: The response frames, {"type": "token" | "sources", "content": str}.
+		"""
+		filtered_response = self.filter_query(query)
+		if filtered_response is not None:
+			yield {"type": "token", "content": filtered_response}
+			return
+
+		self.check_index_version()
+		db, course_index, bm25, index_version = self.db, self.course_index, self.bm25, self.index_version
+		course_ids = parse_course_ids(accessible_courses)
+		query_vector = await asyncio.to_thread(self.embeddings.embed_query, query)
+		routed_response = self.router.match_vector(query_vector)
+		if routed_response is not None:
+			yield {"type": "token", "content": f"<p>{routed_response}</p>"}
+			return
+		cached = self.cache.lookup(query_vector, course_ids, index_version)
+		if cached is not None:
+			yield {"type": "token", "content": cached.answer}
+			yield {"type": "sources", "content": "\n\n" + format_sources(cached.source_urls, token)}
+			return
+
+		docs = await asyncio.to_thread(retrieve_documents, query, course_ids, db, course_index, query_vector, bm25)
+		answer_parts = []
+		async for frame in astream_qa_with_retriever(query, course_ids, token, llm=self.llm, docs=docs):
+			if frame["type"] == "token":
+				answer_parts.append(frame["content"])
+			yield frame
+		if docs:
+			self.cache.store(query_vector, course_ids, index_version, "".join(answer_parts).strip(), source_urls(docs))
+
+	def metrics(self) -> Dict[str, Dict[str, float]]:
+		"""
+		Returns the service counters.
+
+		Returns:
+			Dict[str, Dict[str, float]]: The counters grouped by component.
+		"""
+		metrics = {"admission": self.admission.stats(), "answer_cache": self.cache.stats()}
+		if self.router is not None:
+			metrics["intent_router"] = self.router.stats()
+		if self.llm is not None:
+			metrics["llm"] = self.llm.metrics()
+		if RERANK:
+			metrics["reranker"] = get_reranker().stats()
+		if CONTEXT_PACKING:
+			metrics["context_packing"] = get_context_packer().stats()
+		if RETRIEVAL_MODE == "mongodb" and self.ready.is_set():
+			from modules.mongodb_retriever import get_mongodb_retriever
+			metrics["mongodb_retriever"] = get_mongodb_retriever().stats()
+		return metrics
+
+
+class RAGRequestHandler(BaseHTTPRequestHandler):
+	"""
+	HTTP handler exposing the RAG service:
+		GET  /health - the process is up.
+		GET  /ready  - the models and index are loaded and queries can be answered.
+		GET  /metrics - the service counters, e.g. queue wait and service times or answer cache hits and misses.
+		POST /query  - answer a query, body: {"query": str, "courses": list, "token": str, "user_id": str, "role": str}.
+			Returns 503 when the service is overloaded and 429 when the user is over their rate limit, both
+			with a Retry-After header.
+		POST /query/stream - answer a query as newline delimited JSON frames while it is generated,
+			ending with a {"type": "done"} frame (or {"type": "error"} if generation failed).
+	"""
+	service: RAGService = None
+
+	def send_json(self, status: int, body: dict, headers: dict = None):
+		payload = json.dumps(body).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(payload)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def do_GET(self):
+		if self.path == "/health":
+			self.send_json(200, {"status": "ok"})
+		elif self.path == "/ready":
+			if self.service.ready.is_set():
+				self.send_json(200, {"status": "ready"})
+			else:
+				self.send_json(503, {"status": "warming up", "error": self.service.error})
+		elif self.path == "/metrics":
+			self.send_json(200, self.service.metrics())
+		else:
+			self.send_json(404, {"error": "Not found"})
+
+	def do_POST(self):
+		if self.path not in ("/query", "/query/stream"):
+			return self.send_json(404, {"error": "Not found"})
+		if not self.service.ready.is_set():
+			return self.send_json(503, {"error": "Service is warming up"}, {"Retry-After": "5"})
+
+		try:
+			length = int(self.headers.get("Content-Length", 0))
+			body = json.loads(self.rfile.read(length) or b"{}")
+			query = str(body["query"])
+		except (ValueError, KeyError) as e:
+			return self.send_json(400, {"error": f"Invalid request body: {e}"})
+		accessible_courses = body.get("courses") or []
+		token = str(body.get("token", ""))
+		user_id = str(body.get("user_id") or "") or None
+		role = body.get("role")
+
+		# bound the number of queries being answered at once, the rest wait for a free slot by priority or are shed
+		try:
+			ticket = self.service.admission.acquire(user_id, role)
+		except AdmissionRejected as e:
+			status = 429 if e.rate_limited else 503
+			return self.send_json(status, {"error": str(e), "retry_after": e.retry_after}, {"Retry-After": str(e.retry_after)})
+		try:
+			if self.path == "/query/stream":
+				self.stream_answer(query, accessible_courses, token)
+			else:
+				self.send_answer(query, accessible_courses, token)
+		finally:
+			self.service.admission.release(ticket)
+
+	def send_answer(self, query: str, accessible_courses: list, token: str):
+		try:
+			response = self.service.answer(query, accessible_courses, token)
+		except LLMBusyError as e:
+			logging.warning(f"Refused query: {e}")
+			return self.send_json(503, {"error": "Service is busy"}, {"Retry-After": "5"})
+		except Exception as e:
+			logging.error(f"Failed to answer query: {e}")
+			return self.send_json(500, {"error": "Internal Server Error"})
+		self.send_json(200, {"response": response})
+
+	def stream_answer(self, query: str, accessible_courses: list, token: str):
+		# no content length, the response ends when the connection is closed
+		self.send_response(200)
+		self.send_header("Content-Type", "application/x-ndjson")
+		self.send_header("Cache-Control", "no-cache")
+		self.end_headers()
+
+		def write_frame(frame: Dict[str, str]):
+			self.wfile.write((json.dumps(frame) + "\n").encode("utf-8"))
+
+		async def pump():
+			async for frame in self.service.astream_answer(query, accessible_courses, token):
+				write_frame(frame)
+
+		try:
+			asyncio.run(pump())
+			write_frame({"type": "done"})
+		except (BrokenPipeError, ConnectionResetError):
+			logging.info("Client disconnected while streaming an answer.")
+		except LLMBusyError as e:
+			logging.warning(f"Refused query: {e}")
+			write_frame({"type": "error", "content": "Service is busy, please try again shortly."})
+		except Exception as e:
+			logging.error(f"Failed to stream answer: {e}")
+			write_frame({"type": "error", "content": "Internal Server Error"})
+
+
+def run_server(host: str = RAG_SERVER_HOST, port: int = RAG_SERVER_PORT, max_inflight: int = RAG_SERVER_MAX_INFLIGHT):
+	"""
+	Starts the RAG query server. The server accepts connections straight away so /health can be
+	polled, while the models are loaded in the background and /ready reports when it's done.
+
+	Args:
+		host (str): The interface to listen on.
+		port (int): The port to listen on.
+		max_inflight (int): The maximum number of queries answered concurrently.
+
+	Returns:
+		None
+	"""
+	service = RAGService(max_inflight)
+	RAGRequestHandler.service = service
+	threading.Thread(target=service.warm_up, daemon=True).start()
+
+	server = ThreadingHTTPServer((host, port), RAGRequestHandler)
+	server.daemon_threads = True
+	logging.info(f"RAG server listening on {host}:{port}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+if __name__ == "__main__":
+	logging.basicConfig(level=logging.INFO)
+	run_server()